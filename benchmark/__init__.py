@@ -0,0 +1,4 @@
+# ============================================
+# Package: Benchmark of the whole pipeline on synthetic worlds
+# Run it from the project folder: python -m benchmark [previous results .json]
+# ============================================
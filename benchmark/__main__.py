@@ -0,0 +1,124 @@
+# ============================================
+# Benchmark of the whole pipeline on synthetic worlds
+# Generates worlds, measures each stage and checks per second of audibility calculation
+# for each count of CPU cores and saves results to folderBENCHMARK.
+# Results of the previous version can be compared: python -m benchmark BENCHMARK/benchmark-....json
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import sys # Command line arguments
+import os # Environment of measured processes
+import subprocess # Run measured processes and compiler
+import multiprocessing as mp # Count of CPU cores
+import platform # Describe the computer
+import time # Tracking the execution time
+import json # Save and load results
+from pathlib import Path # Crossplatform pathing
+from loguru import logger # Write log
+
+# Own core modules
+import benchmark.settings as bcfg # Benchmark settings defenition
+import benchmark.world # Generator of synthetic worlds
+
+# Folder of the project with modules
+folderProject = Path(__file__).resolve().parent.parent
+
+
+# ============================================
+# Get version of the project: git commit and mark of uncommitted changes
+# ============================================
+def GetVersion():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=folderProject,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=folderProject,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if changes else '')
+
+# ============================================
+# Build C shared library audibility.so from the current source in the folder of the world
+# ============================================
+def BuildLibrary(folder):
+    source = str(folderProject / 'modules' / 'audibility.c')
+    subprocess.run([arg.replace('{source}', source) for arg in bcfg.CompileCommand], cwd=folder, check=True)
+
+# ============================================
+# Measure all stages of the pipeline in a separate process on the world in the folder
+# Returns dict with results of the run
+# ============================================
+def MeasureWorld(folder, cores):
+    fileResult = Path(folder, 'stages.json').resolve()
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(folderProject), os.environ.get('PYTHONPATH')])))
+    subprocess.run([sys.executable, '-m', 'benchmark.stages', str(cores), str(fileResult)],
+                   cwd=folder, env=environment, check=True)
+    with open(fileResult) as file:
+        return json.load(file)
+
+# ============================================
+# Compare checks per second with the previous results of the same worlds and counts of CPU cores
+# Returns count of regressions
+# ============================================
+def CompareResults(results, filePrevious):
+    with open(filePrevious) as file:
+        previous = json.load(file)
+    runsPrevious = {(run['world'], run['cores']): run for run in previous['runs']}
+    regressions = 0
+    for run in results['runs']:
+        runPrevious = runsPrevious.get((run['world'], run['cores']))
+        if runPrevious is None:
+            continue
+        ratio = run['checks_per_second'] / max(runPrevious['checks_per_second'], 1e-9)
+        message = "World '{}', {} cores: {:.0f} checks/sec, {:+.1%} against version {}".format(
+                  run['world'], run['cores'], run['checks_per_second'], ratio-1, previous['version'])
+        if ratio < 1 - bcfg.toleranceRegression:
+            regressions = regressions + 1
+            logger.error(message)
+        else:
+            logger.success(message)
+    return regressions
+
+
+# Only for main process
+if __name__ == '__main__':
+    results = {'version': GetVersion(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'cpu_count': mp.cpu_count(), 'runs': []}
+    logger.info("Benchmark of version {} on {} CPU cores", results['version'], results['cpu_count'])
+
+    for name, params in bcfg.Worlds.items():
+
+        # Generate the world and build the library
+        folder = Path('.', bcfg.folderBENCHMARK, name)
+        start = time.perf_counter()
+        countBuildings = benchmark.world.GenerateWorld(folder, params)
+        BuildLibrary(folder)
+        logger.success("World '{}' generated: {} buildings, {:.1f} seconds", name, countBuildings, time.perf_counter()-start)
+
+        # Measure the world with each count of CPU cores
+        measured = set()
+        for cores in bcfg.BenchmarkCores:
+            if (cores if cores > 0 else mp.cpu_count()) in measured:
+                continue
+            run = MeasureWorld(folder, cores)
+            measured.add(run['cores'])
+            run['world'] = name
+            run['params'] = params
+            results['runs'].append(run)
+            logger.success("World '{}', {} cores: {:.0f} checks/sec. {}", name, run['cores'], run['checks_per_second'],
+                           ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in run['stages'].items()))
+
+    # Save results
+    fileResults = Path('.', bcfg.folderBENCHMARK, f"benchmark-{results['version']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(fileResults, 'w') as file:
+        json.dump(results, file, indent=4)
+    logger.success("Results saved to {}", fileResults)
+
+    # Compare with previous results
+    if len(sys.argv) > 1:
+        if CompareResults(results, sys.argv[1]) > 0:
+            sys.exit(1)
@@ -0,0 +1,33 @@
+# ============================================
+# Module: Benchmark settings
+# ============================================
+
+# Path to files and folders
+folderBENCHMARK = 'BENCHMARK' # Subfolder (in current folder) with generated worlds and results of benchmark (.json)
+
+# Synthetic worlds to generate and measure: name: parameters of the world
+# 'size' - edge of the square world, meters
+# 'density' - part of city blocks (20x20 meters) with buildings, from 0 to 1
+# 'floors' - maximum count of floors of buildings
+# 'living' - part of living buildings, from 0 to 1
+# 'roughness' - amplitude of hills of the earth's surface, meters
+# 'megaphones' - count of megaphones
+# 'seed' - seed of random numbers generator: the same seed gives the same world
+Worlds = {
+    'small': {'size': 600, 'density': 0.35, 'floors': 10, 'living': 0.6, 'roughness': 10, 'megaphones': 4, 'seed': 1},
+    'dense': {'size': 1000, 'density': 0.7, 'floors': 16, 'living': 0.6, 'roughness': 5, 'megaphones': 8, 'seed': 2},
+    'hills': {'size': 1000, 'density': 0.3, 'floors': 5, 'living': 0.8, 'roughness': 40, 'megaphones': 8, 'seed': 3},
+}
+
+# Counts of CPU cores to measure audibility calculation. 0 - all CPU cores of the computer
+BenchmarkCores = [1, 2, 4, 0]
+
+# Command to build the C shared library audibility.so from the current source for each world.
+# {source} is replaced by the path of modules/audibility.c
+CompileCommand = ['gcc', '-O2', '-shared', '-fPIC', '-o', 'audibility.so', '{source}', '-lm']
+
+# Allowed decline of checks per second against the previous results, part. Default value is 0.1
+toleranceRegression = 0.1
+
+# Debug log detail level of measured pipeline. Default value is "WARNING"
+logLevel = "WARNING"
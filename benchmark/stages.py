@@ -0,0 +1,63 @@
+# ============================================
+# Module: Measure stages of the pipeline on one world
+# Runs in a separate process in the folder of the world: python -m benchmark.stages <cores> <results .json>
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import sys # Command line arguments
+import time # Tracking the execution time
+import json # Save results
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import benchmark.settings as bcfg # Benchmark settings defenition
+
+# Settings of the measured run must be changed before other modules are loaded
+cfg.logLevel = bcfg.logLevel
+cfg.AudibilityCores = int(sys.argv[1])
+cfg.intervalCheckpoint = 0 # Checkpoints are not measured
+cfg.flagAudibilityCache = False # All megaphones are calculated
+
+import modules.environment as env # Environment defenition
+import modules.bounds # Read raster and DEM data and calculate wolrd bounds
+import modules.earth # Read raster and DEM data and generate the earth's surface
+import modules.buildings # Generate voxels for earth ground vector buildings
+import modules.megaphones # Load megaphones points and calculate audibility level
+import modules.audibility # Multiprocessing audibility calculation
+
+
+# ============================================
+# Run all stages of the pipeline and measure time of each stage, seconds
+# ============================================
+def MeasureStages():
+    stages = {}
+    for name, stage in (('ReadWorldBounds', modules.bounds.ReadWorldBounds),
+                        ('GenerateEarthSurface', modules.earth.GenerateEarthSurface),
+                        ('GenerateBuildings', modules.buildings.GenerateBuildings),
+                        ('PrepareLivingBuffer', modules.earth.PrepareLivingBuffer),
+                        ('LoadMegaphones', modules.megaphones.LoadMegaphones),
+                        ('clearMemory', env.clearMemory),
+                        ('CalculateAudibility', modules.audibility.CalculateAudibility)):
+        start = time.perf_counter()
+        stage()
+        stages[name] = time.perf_counter() - start
+    return stages
+
+
+# Only for main process
+if __name__ == '__main__':
+    stages = MeasureStages()
+    result = {
+        'cores': modules.audibility.GetCoresCount(),
+        'stages': stages,
+        'bounds': [int(bound) for bound in env.bounds],
+        'voxels': int(env.countVoxels),
+        'megaphones': int(env.countMegaphones),
+        'checks': int(env.totalChecks),
+        'checks_per_second': env.totalChecks / max(stages['CalculateAudibility'], 1e-9)
+    }
+    with open(sys.argv[2], 'w') as file:
+        json.dump(result, file, indent=4)
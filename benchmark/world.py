@@ -0,0 +1,96 @@
+# ============================================
+# Module: Generator of synthetic worlds
+# Writes raster, DEM, buildings and megaphones in the same folders and formats as real input data
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Random numbers and matrices of rasters
+import tifffile # Write GeoTIFF files
+import geopandas as gpd # For vector objects
+from shapely.geometry import Point, box # Geometries of megaphones and buildings
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+
+# Top-left corner of all synthetic worlds in Web-Mercator's coordinates (ESPG:3857), meters
+originX = 4200000.0
+originY = 7500000.0
+
+# Size of city blocks with one building and pixel sizes of rasters, meters
+sizeBlock = 20
+sizeRasterPixel = 4
+sizeDEMPixel = 30
+
+
+# ============================================
+# Get GeoTIFF tags of the north-up raster in Web-Mercator's coordinates:
+# pixel scale, tie point of the top-left corner and keys of ESPG:3857 projection
+# ============================================
+def GetGeoTags(scale, x, y):
+    return [(33550, 'd', 3, (scale, scale, 0.0), False),
+            (33922, 'd', 6, (0, 0, 0, x, y, 0), False),
+            (34735, 'H', 16, (1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, 3857), False)]
+
+# ============================================
+# Generate heights of the earth's surface: smooth hills from several random waves
+# with amplitude of roughness and small noise of DEM
+# ============================================
+def GenerateHeights(rng, x, y, roughness):
+    heights = np.full(x.shape, 150.0)
+    for wave in range(4):
+        angle = rng.uniform(0, np.pi)
+        length = rng.uniform(200, 800)
+        phase = rng.uniform(0, 2*np.pi)
+        heights = heights + roughness/4 * np.sin((x*np.cos(angle) + y*np.sin(angle)) * 2*np.pi/length + phase)
+    return (heights + rng.normal(0, roughness/50 + 0.01, x.shape)).astype(np.float32)
+
+# ============================================
+# Generate synthetic world in the folder by its parameters (see Worlds in benchmark settings)
+# ============================================
+def GenerateWorld(folder, params):
+    rng = np.random.default_rng(params['seed'])
+    size = params['size']
+    for subfolder in (cfg.folderRASTER, cfg.folderDEM, cfg.folderBUILDINGS, cfg.folderMEGAPHONES, cfg.folderOUTPUT):
+        Path(folder, subfolder).mkdir(parents=True, exist_ok=True)
+
+    # Raster background of the map defines bounds of the world
+    countPixels = int(np.ceil(size / sizeRasterPixel))
+    raster = rng.integers(0, 255, (countPixels, countPixels, 3), dtype=np.uint8)
+    tifffile.imwrite(Path(folder, cfg.folderRASTER, 'raster.tif'), raster, photometric='rgb',
+                     extratags=GetGeoTags(size/countPixels, originX, originY))
+
+    # DEM covers the raster with margins
+    margin = 2*sizeDEMPixel
+    countPixels = int(np.ceil((size + 2*margin) / sizeDEMPixel))
+    x, y = np.meshgrid(np.arange(countPixels)*sizeDEMPixel, np.arange(countPixels)*sizeDEMPixel)
+    tifffile.imwrite(Path(folder, cfg.folderDEM, 'dem.tif'), GenerateHeights(rng, x, y, params['roughness']),
+                     extratags=GetGeoTags(sizeDEMPixel, originX-margin, originY+margin))
+
+    # Buildings: one rectangular building in some city blocks
+    polygons = []
+    floors = []
+    flats = []
+    for i in range(int(size // sizeBlock)):
+        for j in range(int(size // sizeBlock)):
+            if rng.random() >= params['density']:
+                continue
+            width = rng.uniform(6, sizeBlock-5)
+            height = rng.uniform(6, sizeBlock-5)
+            x = originX + i*sizeBlock + rng.uniform(1, sizeBlock-width-1)
+            y = originY - j*sizeBlock - rng.uniform(1, sizeBlock-height-1)
+            polygons.append(box(x, y-height, x+width, y))
+            floors.append(int(rng.integers(1, params['floors']+1)))
+            flats.append(floors[-1] * int(width*height // 40) if rng.random() < params['living'] else 0)
+    gdfBuildings = gpd.GeoDataFrame({'floors': floors, 'flats': flats}, geometry=polygons, crs='EPSG:3857')
+    gdfBuildings.to_file(Path(folder, cfg.folderBUILDINGS, 'buildings.geojson'), driver='GeoJSON')
+
+    # Megaphones in the central part of the world
+    points = [Point(originX + rng.uniform(0.1, 0.9)*size, originY - rng.uniform(0.1, 0.9)*size)
+              for k in range(params['megaphones'])]
+    gdfMegaphones = gpd.GeoDataFrame(geometry=points, crs='EPSG:3857')
+    gdfMegaphones.to_file(Path(folder, cfg.folderMEGAPHONES, 'megaphones.geojson'), driver='GeoJSON')
+    return len(polygons)
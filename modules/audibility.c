@@ -5,6 +5,81 @@
 */
 
 #include <math.h>
+#include <stdlib.h>
+#include <time.h>
+
+/**
+ * @brief Reasons to finish the check of audibility of the destination voxel, used by the instrumented mode.
+ */
+enum {
+    EXIT_AUDIBLE = 0, // The voxel is just audible or its sound level can not be improved
+    EXIT_DISTANCE, // The result is found by the distance only
+    EXIT_SAME_BUILDING, // The source and the destination are in the same building
+    EXIT_TERRAIN, // The segment is blocked by the earth's surface
+    EXIT_BUILDING, // The segment is blocked by an extraneous building
+    EXIT_CLEAR, // There are no obstacles on the segment
+    EXIT_KNOWN, // Visibility was found earlier by the sweep or by the walk to the building column
+    COUNT_EXITS
+};
+
+#define COUNT_STEPS_BINS 24 // Bins of the histogram of steps: 0 steps, 1, 2-3, 4-7, ..., 2^22 and more steps
+#define SIZE_STATS (2 + COUNT_EXITS + COUNT_STEPS_BINS) // Values of statistics for each megaphone
+#define SIZE_SPAN 3 // Values of each span of a row of cells of zones: x, first y and count of cells
+
+/**
+ * @brief Counters of the instrumented mode, collected by the task in its own memory 
+ * and added to the shared memory at the end of the task.
+ */
+typedef struct {
+    unsigned long long steps; // Total count of steps along all walked segments
+    unsigned long long exits[COUNT_EXITS]; // Count of checks for each reason to finish the check
+    unsigned long long histogram[COUNT_STEPS_BINS]; // Count of walked segments by the count of their steps
+} audibility_stats;
+
+/**
+ * @brief Counts the reason to finish the check of audibility.
+ *
+ * @param stats Pointer to the counters (NULL if the instrumented mode is off).
+ * @param reason The reason to finish the check.
+ * @return void
+ */
+static inline void count_exit(audibility_stats *stats, unsigned int reason) {
+    if (stats != NULL) {
+        stats->exits[reason]++;
+    }
+}
+
+/**
+ * @brief Counts the walked segment in the histogram of steps.
+ *
+ * @param stats Pointer to the counters (NULL if the instrumented mode is off).
+ * @param steps The count of steps along the segment.
+ * @return void
+ */
+static inline void count_steps(audibility_stats *stats, unsigned long steps) {
+    if (stats != NULL) {
+        stats->steps += steps;
+        unsigned int bin = 0;
+        while ((steps > 0) && (bin < COUNT_STEPS_BINS - 1)) {
+            steps >>= 1;
+            bin++;
+        }
+        stats->histogram[bin]++;
+    }
+}
+
+/**
+ * @brief Retrieves the count of values of statistics of the instrumented mode for each megaphone:
+ * nanoseconds of calculation, total count of steps, counts of checks for each reason to finish the check 
+ * (already audible, distance, same building, terrain, building, clear, known visibility) 
+ * and the histogram of steps of walked segments.
+ *
+ * @return unsigned int count of values for each megaphone.
+ */
+unsigned int get_audibility_stats_size(void) {
+    return SIZE_STATS;
+}
+
 /**
  * @brief Retrieves integer vertical coordinate of the first voxel of building in (x, y) cell with UIB=uib. uib cannot be negative. Do not use this function for a cells without buildings.
  *
@@ -32,147 +107,1446 @@ unsigned short get_first_building_voxel(unsigned int x, unsigned int y,
 }
 
 /**
- * @brief Check audibility on destination voxel with integer coordinates (xDst, yDst, zDst)
- * from megaphone on source voxel with integer coordinates (xSrc, ySrc, zSrc)
- * uibDst - UIB of building on checked destination voxel, -1 if not exists
- * uibSrc - UIB of building, where is source megaphone based
+ * @brief Check if the intermediate voxel with integer coordinates (x, y, z) is an obstacle for the sound:
+ * it is inside an extraneous building (not the source and not the destination one) or under the earth's surface.
+ *
+ * @param x The x-coordinate of the intermediate voxel.
+ * @param y The y-coordinate of the intermediate voxel.
+ * @param z The z-coordinate of the intermediate voxel.
+ * @param uib_dst The unique identificator of the destination building (if exists).
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @return unsigned char 1 if the voxel is inside an extraneous building, 2 if it is under the earth's surface, 0 otherwise.
+ */
+static inline unsigned char is_obstacle(signed long x, signed long y, signed long z,
+    signed long uib_dst, signed long uib_src,
+    unsigned int bounds_y, signed short *ground, signed long *uibs,
+    unsigned int building_size, unsigned short *buildings,
+    unsigned char building_ground_mode) {
+
+    signed long uib = uibs[x * bounds_y + y];
+
+    // if intermediate voxel does not belong to source or destination buildings
+    if ((uib >= 0) && (uib != uib_src) && (uib != uib_dst)) {
+        // If there is an extraneous building on the intermediate voxel, check if the intermediate voxel is higher than the building
+        if (z < (get_first_building_voxel(x, y, uib, bounds_y, ground, building_size, buildings, building_ground_mode) + buildings[uib * building_size] )) {
+            return 1;
+        }
+    }
+
+    // If there is no building there, check if the intermediate voxel is higher than the earth's surface
+    if (uib < 0) {
+        if (z < ( ground[x * bounds_y + y] -1 )) { // -1 for smoothing out the steps of the earth's surface
+            return 2;
+        }
+    }
+
+    return 0;
+}
+
+/**
+ * @brief State of the exact traversal of the (x, y) grid cells crossed by the segment
+ * between two cells centers (Amanatides-Woo algorithm).
+ * The cells centers have integer coordinates, so cells borders are placed on the half-integer coordinates.
+ * All decisions are made with integer arithmetic: the segment crosses the next x-border at
+ * t = (2*kx+1) / (2*|dx|) and the next y-border at t = (2*ky+1) / (2*|dy|),
+ * so we compare err_x = (2*kx+1)*|dy| and err_y = (2*ky+1)*|dx| instead of float values of t.
+ */
+typedef struct {
+    signed long x, y; // Coordinates of the current cell
+    signed long x_end, y_end; // Coordinates of the last cell
+    signed long step_x, step_y; // Direction of moving along the axes: -1, 0 or +1
+    signed long adx, ady; // Absolute distances along the axes
+    signed long kx, ky; // Count of crossed x-borders and y-borders
+    signed long err_x, err_y; // Integer numerators to compare crossings of the next x-border and y-border
+    double t_in, t_out; // Parameters of the segment at the entry and at the exit of the current cell
+} grid_ray;
+
+/**
+ * @brief Calculates the parameter t of the segment at the exit of the current cell.
+ *
+ * @param ray Pointer to the traversal state.
+ * @return double parameter t in [0, 1].
+ */
+static inline double grid_ray_exit(grid_ray *ray) {
+    double t_x = (ray->adx > 0) ? (2.0 * ray->kx + 1.0) / (2.0 * ray->adx) : 1.0;
+    double t_y = (ray->ady > 0) ? (2.0 * ray->ky + 1.0) / (2.0 * ray->ady) : 1.0;
+    double t = fmin(t_x, t_y);
+    return (t > 1.0 ? 1.0 : t);
+}
+
+/**
+ * @brief Initializes the traversal of the grid cells from the source cell to the destination cell.
+ * The current cell after initialization is the source cell.
+ *
+ * @param ray Pointer to the traversal state.
+ * @param x_src The x-coordinate of the source cell.
+ * @param y_src The y-coordinate of the source cell.
+ * @param x_dst The x-coordinate of the destination cell.
+ * @param y_dst The y-coordinate of the destination cell.
+ * @return void
+ */
+static inline void grid_ray_init(grid_ray *ray, signed long x_src, signed long y_src,
+    signed long x_dst, signed long y_dst) {
+    ray->x = x_src;
+    ray->y = y_src;
+    ray->x_end = x_dst;
+    ray->y_end = y_dst;
+    ray->step_x = (x_dst > x_src) - (x_dst < x_src);
+    ray->step_y = (y_dst > y_src) - (y_dst < y_src);
+    ray->adx = labs(x_dst - x_src);
+    ray->ady = labs(y_dst - y_src);
+    ray->kx = 0;
+    ray->ky = 0;
+    ray->err_x = ray->ady;
+    ray->err_y = ray->adx;
+    ray->t_in = 0.0;
+    ray->t_out = grid_ray_exit(ray);
+}
+
+/**
+ * @brief Moves to the next cell crossed by the segment.
+ * If the segment passes exactly through the corner of cells, it moves diagonally.
+ *
+ * @param ray Pointer to the traversal state.
+ * @return unsigned char 1 if moved to the next cell, 0 if the current cell is the last one.
+ */
+static inline unsigned char grid_ray_next(grid_ray *ray) {
+    if ((ray->x == ray->x_end) && (ray->y == ray->y_end)) {
+        return 0;
+    }
+    if (ray->err_x <= ray->err_y) {
+        if (ray->err_x == ray->err_y) {
+            ray->y += ray->step_y;
+            ray->ky++;
+            ray->err_y += 2 * ray->adx;
+        }
+        ray->x += ray->step_x;
+        ray->kx++;
+        ray->err_x += 2 * ray->ady;
+    } else {
+        ray->y += ray->step_y;
+        ray->ky++;
+        ray->err_y += 2 * ray->adx;
+    }
+    ray->t_in = ray->t_out;
+    ray->t_out = grid_ray_exit(ray);
+    return 1;
+}
+
+/**
+ * @brief Moves to the first cell crossed by the segment outside the current block of cells.
+ * Blocks are aligned squares with the side of 2^level cells. 
+ * Count of crossed x-borders and y-borders up to the exit of the block is found with integer arithmetic, 
+ * so the result is the same as after the calls of grid_ray_next() cell by cell.
+ *
+ * @param ray Pointer to the traversal state.
+ * @param level Level of the block: its side is 2^level cells.
+ * @return unsigned char 1 if moved to the next cell, 0 if the last cell is inside the current block.
+ */
+static inline unsigned char grid_ray_skip_block(grid_ray *ray, unsigned int level) {
+    signed long bx = ray->x >> level;
+    signed long by = ray->y >> level;
+    if (((ray->x_end >> level) == bx) && ((ray->y_end >> level) == by)) {
+        return 0;
+    }
+
+    // Index of the x-border and y-border crossings at the exit of the block
+    signed long exit_x = -1, exit_y = -1;
+    if (ray->step_x != 0) {
+        exit_x = ray->kx + (ray->step_x > 0 ? ((bx + 1) << level) - 1 - ray->x : ray->x - (bx << level));
+    }
+    if (ray->step_y != 0) {
+        exit_y = ray->ky + (ray->step_y > 0 ? ((by + 1) << level) - 1 - ray->y : ray->y - (by << level));
+    }
+
+    // Compare crossings: t = (2*k+1) / (2*|d|)
+    signed long err_x = (exit_x >= 0 ? (2 * exit_x + 1) * ray->ady : -1);
+    signed long err_y = (exit_y >= 0 ? (2 * exit_y + 1) * ray->adx : -1);
+    if ((err_y < 0) || ((err_x >= 0) && (err_x < err_y))) {
+        // Exit through the x-border. Count y-borders crossed not later than it
+        ray->kx = exit_x + 1;
+        ray->ky = (ray->ady > 0 && err_x >= ray->adx ? (err_x - ray->adx) / (2 * ray->adx) + 1 : 0);
+        ray->t_in = (2.0 * exit_x + 1.0) / (2.0 * ray->adx);
+    } else if ((err_x < 0) || (err_y < err_x)) {
+        // Exit through the y-border. Count x-borders crossed not later than it
+        ray->ky = exit_y + 1;
+        ray->kx = (ray->adx > 0 && err_y >= ray->ady ? (err_y - ray->ady) / (2 * ray->ady) + 1 : 0);
+        ray->t_in = (2.0 * exit_y + 1.0) / (2.0 * ray->ady);
+    } else {
+        // Exit through the corner of the block
+        ray->kx = exit_x + 1;
+        ray->ky = exit_y + 1;
+        ray->t_in = (2.0 * exit_x + 1.0) / (2.0 * ray->adx);
+    }
+    ray->x = ray->x_end - ray->step_x * (ray->adx - ray->kx);
+    ray->y = ray->y_end - ray->step_y * (ray->ady - ray->ky);
+    ray->err_x = (2 * ray->kx + 1) * ray->ady;
+    ray->err_y = (2 * ray->ky + 1) * ray->adx;
+    ray->t_out = grid_ray_exit(ray);
+    return 1;
+}
+
+/**
+ * @brief Hierarchical pyramid of obstacles heights.
+ * Level 0 contains height of obstacle for each cell of the world: vertical coordinate of the first voxel 
+ * over the building for the cells with buildings, and the earth's surface level -1 for other cells.
+ * Intermediate voxel with vertical coordinate z is an obstacle only if z < height of its cell.
+ * Each next level contains maximum of the four cells (2x2 block) of the previous level.
+ * All levels are stored in the one linear array one by one.
+ * There are no levels of minimum heights: the segment always reaches a block at its current cell, which is checked
+ * at level 0. So a block, whose minimum is higher than the segment, never stops the walk earlier than this cell.
+ * Also the minimum can not exclude cells of the source and the destination buildings, which are not obstacles.
+ */
+typedef struct {
+    signed short *heights; // Pointer to the linear array of all levels
+    unsigned int levels; // Count of levels
+    unsigned long offset[32]; // Index of the first element of each level
+    unsigned long size_x[32]; // The x-dimension size of each level
+    unsigned long size_y[32]; // The y-dimension size of each level
+} height_pyramid;
+
+/**
+ * @brief Calculates dimensions of all levels of the obstacles heights pyramid.
+ *
+ * @param pyramid Pointer to the pyramid structure to fill.
+ * @param heights Pointer to the linear array of all levels (can be NULL).
+ * @param bounds_x The x-dimension size of the world.
+ * @param bounds_y The y-dimension size of the world.
+ * @return unsigned long total count of elements of all levels.
+ */
+unsigned long init_height_pyramid(height_pyramid *pyramid, signed short *heights,
+    unsigned int bounds_x, unsigned int bounds_y) {
+    unsigned long size = 0;
+    unsigned int level = 0;
+    unsigned long size_x = bounds_x;
+    unsigned long size_y = bounds_y;
+    while (level < 32) {
+        pyramid->offset[level] = size;
+        pyramid->size_x[level] = size_x;
+        pyramid->size_y[level] = size_y;
+        size += size_x * size_y;
+        level++;
+        if ((size_x <= 1) && (size_y <= 1)) {
+            break;
+        }
+        size_x = (size_x + 1) / 2;
+        size_y = (size_y + 1) / 2;
+    }
+    pyramid->levels = level;
+    pyramid->heights = heights;
+    return size;
+}
+
+/**
+ * @brief Retrieves total count of elements of all levels of the obstacles heights pyramid.
+ *
+ * @param bounds_x The x-dimension size of the world.
+ * @param bounds_y The y-dimension size of the world.
+ * @return unsigned long count of elements.
+ */
+unsigned long get_height_pyramid_size(unsigned int bounds_x, unsigned int bounds_y) {
+    height_pyramid pyramid;
+    return init_height_pyramid(&pyramid, NULL, bounds_x, bounds_y);
+}
+
+/**
+ * @brief Retrieves the height of the obstacles of the cell (x, y) of the level of the pyramid.
+ *
+ * @param pyramid Pointer to the obstacles heights pyramid.
+ * @param level The level of the pyramid: 0 - cells of the world, next levels - blocks of 2^level x 2^level cells.
+ * @param x The x-coordinate of the cell (the block) of the level.
+ * @param y The y-coordinate of the cell (the block) of the level.
+ * @return signed short height of obstacles.
+ */
+static inline signed short get_pyramid_height(height_pyramid *pyramid, unsigned int level, unsigned long x, unsigned long y) {
+    return pyramid->heights[pyramid->offset[level] + x * pyramid->size_y[level] + y];
+}
+
+/**
+ * @brief Fills all levels of the obstacles heights pyramid. 
+ * Call it once, when ground levels and buildings of the world are ready.
+ *
+ * @param heights Pointer to the linear array of all levels (use get_height_pyramid_size() to allocate it).
+ * @param bounds_x The x-dimension size of the world.
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @return void
+ */
+void build_height_pyramid(signed short *heights, unsigned int bounds_x, unsigned int bounds_y,
+    signed short *ground, signed long *uibs, unsigned int building_size, unsigned short *buildings,
+    unsigned char building_ground_mode) {
+
+    height_pyramid pyramid;
+    init_height_pyramid(&pyramid, heights, bounds_x, bounds_y);
+
+    // Level 0: obstacles heights of cells
+    for (unsigned long x = 0; x < bounds_x; x++) {
+        for (unsigned long y = 0; y < bounds_y; y++) {
+            signed long uib = uibs[x * bounds_y + y];
+            signed short *height = heights + x * bounds_y + y;
+            if (uib >= 0) {
+                *height = get_first_building_voxel(x, y, uib, bounds_y, ground, 
+                    building_size, buildings, building_ground_mode) + buildings[uib * building_size];
+            } else {
+                *height = ground[x * bounds_y + y] - 1;
+            }
+        }
+    }
+
+    // Next levels: maximum of 2x2 blocks of the previous level
+    for (unsigned int level = 1; level < pyramid.levels; level++) {
+        unsigned long prev_x = pyramid.size_x[level - 1];
+        unsigned long prev_y = pyramid.size_y[level - 1];
+        for (unsigned long x = 0; x < pyramid.size_x[level]; x++) {
+            for (unsigned long y = 0; y < pyramid.size_y[level]; y++) {
+                signed short height = get_pyramid_height(&pyramid, level - 1, 2 * x, 2 * y);
+                if ((2 * x + 1 < prev_x) && (get_pyramid_height(&pyramid, level - 1, 2 * x + 1, 2 * y) > height)) {
+                    height = get_pyramid_height(&pyramid, level - 1, 2 * x + 1, 2 * y);
+                }
+                if ((2 * y + 1 < prev_y) && (get_pyramid_height(&pyramid, level - 1, 2 * x, 2 * y + 1) > height)) {
+                    height = get_pyramid_height(&pyramid, level - 1, 2 * x, 2 * y + 1);
+                }
+                if ((2 * x + 1 < prev_x) && (2 * y + 1 < prev_y) && 
+                    (get_pyramid_height(&pyramid, level - 1, 2 * x + 1, 2 * y + 1) > height)) {
+                    height = get_pyramid_height(&pyramid, level - 1, 2 * x + 1, 2 * y + 1);
+                }
+                heights[pyramid.offset[level] + x * pyramid.size_y[level] + y] = height;
+            }
+        }
+    }
+}
+
+/**
+ * @brief Finds the highest level of the pyramid, whose block with the current cell of the segment 
+ * has no obstacles on the rest part of the segment inside this block.
+ *
+ * @param pyramid Pointer to the obstacles heights pyramid.
+ * @param ray Pointer to the traversal state of the segment.
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param inv_dx The inverse distance (1/dx) between source and destination voxels along x-axis.
+ * @param inv_dy The inverse distance (1/dy) between source and destination voxels along y-axis.
+ * @param dz The distance between source and destination voxels along z-axis.
+ * @return unsigned int level of the block to skip, 0 if no one block can be skipped.
+ */
+static inline unsigned int find_empty_level(height_pyramid *pyramid, grid_ray *ray,
+    signed long x_src, signed long y_src, signed long z_src, double inv_dx, double inv_dy, double dz) {
+
+    // For ascending segment the lowest point is always at the entry of the current cell
+    double z_entry = z_src + ray->t_in * dz;
+    unsigned int found = 0;
+    for (unsigned int level = 1; level < pyramid->levels; level++) {
+
+        // Block of the current cell
+        signed long bx = ray->x >> level;
+        signed long by = ray->y >> level;
+
+        // The lowest point of the segment inside the block: from the entry of the current cell to the exit of the block
+        double z_low = z_entry;
+        if (dz < 0) {
+            double t_exit = 1.0;
+            if (ray->step_x != 0) {
+                double border_x = (ray->step_x > 0 ? ((bx + 1) << level) : (bx << level)) - 0.5;
+                t_exit = fmin(t_exit, (border_x - x_src) * inv_dx);
+            }
+            if (ray->step_y != 0) {
+                double border_y = (ray->step_y > 0 ? ((by + 1) << level) : (by << level)) - 0.5;
+                t_exit = fmin(t_exit, (border_y - y_src) * inv_dy);
+            }
+            z_low = z_src + t_exit * dz;
+        }
+
+        // The lowest point of the segment (after rounding) must be not lower than all obstacles of the block
+        signed short height = get_pyramid_height(pyramid, level, bx, by);
+        if (z_low - 0.5 < height) {
+            break;
+        }
+        found = level;
+    }
+    return found;
+}
+
+/**
+ * @brief Walks along the segment between source voxel (x_src, y_src, z_src) and destination voxel (x_dst, y_dst, z_dst)
+ * and checks, if there are no obstacles: extraneous buildings or the earth's surface.
+ *
+ * @param x_dst The x-coordinate of the destination voxel.
+ * @param y_dst The y-coordinate of the destination voxel.
+ * @param z_dst The z-coordinate of the destination voxel.
+ * @param uib_dst The unique identificator of the destination building (if exists).
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @param size_step The step size for checking audibility of voxels.
+ * @param traversal_mode Mode to walk along the segment between source and destination voxels:
+ *       0 - fixed steps of size_step voxels along the longest axis
+ *       1 - exact traversal of each (x, y) cell crossed by the segment
+ * @param pyramid Pointer to the obstacles heights pyramid (can be NULL): its level 0 is checked before buildings and 
+ *        the earth's surface, whole empty blocks are skipped with exact traversal.
+ * @param stats Pointer to the counters of the instrumented mode (NULL if it is off).
+ * @return unsigned char 1 if there are no obstacles, 0 otherwise.
+ */
+static inline unsigned char is_segment_clear(signed long x_dst, signed long y_dst, signed long z_dst, signed long uib_dst, 
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src, 
+    unsigned int bounds_y, signed short *ground, signed long *uibs, 
+    unsigned int building_size, unsigned short *buildings, 
+    unsigned char building_ground_mode, double size_step, unsigned char traversal_mode,
+    height_pyramid *pyramid, audibility_stats *stats) {
+
+    double dx = x_dst - x_src;
+    double dy = y_dst - y_src;
+    double dz = z_dst - z_src;
+    unsigned long steps = 0; // Count of steps for the instrumented mode
+
+    if (traversal_mode == 0) {
+
+        // Find the maximum distance along the axes
+        double max_axis_distance = fmax(fmax(fabs(dx), fabs(dy)), fabs(dz)); 
+        // Calculate step size on the longest axis to check audibility of voxels
+        double step = size_step / max_axis_distance; 
+
+        // Analyze segment between source and destination voxels
+        // We move in small steps along the segment and check for extraneous buildings or the earth's surface.
+        double t = 0.0;
+        while (t <= 1.0) {
+
+            // Calculate coordinates of the Intermediate voxel (x, y, z) on the segment
+            signed long x = round(x_src + t * dx);
+            signed long y = round(y_src + t * dy);
+            signed long z = round(z_src + t * dz);
+
+            steps++;
+
+            // Obstacles can be only lower than the height of the cell
+            unsigned char obstacle = 0;
+            if ((pyramid == NULL) || (z < get_pyramid_height(pyramid, 0, x, y))) {
+                obstacle = is_obstacle(x, y, z, uib_dst, uib_src, bounds_y, ground, uibs,
+                                       building_size, buildings, building_ground_mode);
+            }
+            if (obstacle) {
+                count_steps(stats, steps);
+                count_exit(stats, obstacle == 2 ? EXIT_TERRAIN : EXIT_BUILDING);
+                return 0;
+            }
+
+            t += step; // Go to the next step on the segment
+        }
+
+    } else {
+
+        // Analyze segment between source and destination voxels
+        // We visit each (x, y) cell crossed by the segment exactly once
+        // and check the lowest point of the segment inside this cell.
+        grid_ray ray;
+        grid_ray_init(&ray, x_src, y_src, x_dst, y_dst);
+        double inv_dx = 1.0 / dx;
+        double inv_dy = 1.0 / dy;
+        unsigned char more = 1;
+        signed long failed_x = -1, failed_y = -1; // The last 2x2 block which can not be skipped
+        while (more) {
+            steps++;
+
+            // Skip the whole block of cells without obstacles
+            if ((pyramid != NULL) && (((ray.x >> 1) != failed_x) || ((ray.y >> 1) != failed_y))) {
+                unsigned int level = find_empty_level(pyramid, &ray, x_src, y_src, z_src, inv_dx, inv_dy, dz);
+                if (level == 0) {
+                    failed_x = ray.x >> 1;
+                    failed_y = ray.y >> 1;
+                } else {
+                    more = grid_ray_skip_block(&ray, level);
+                    continue;
+                }
+            }
+
+            signed long z = round(z_src + (dz > 0 ? ray.t_in : ray.t_out) * dz);
+
+            // Obstacles can be only lower than the height of the cell
+            if ((pyramid == NULL) || (z < get_pyramid_height(pyramid, 0, ray.x, ray.y))) {
+                unsigned char obstacle = is_obstacle(ray.x, ray.y, z, uib_dst, uib_src, bounds_y, ground, uibs,
+                                                     building_size, buildings, building_ground_mode);
+                if (obstacle) {
+                    count_steps(stats, steps);
+                    count_exit(stats, obstacle == 2 ? EXIT_TERRAIN : EXIT_BUILDING);
+                    return 0;
+                }
+            }
+
+            more = grid_ray_next(&ray);
+        }
+
+    }
+
+    count_steps(stats, steps);
+    count_exit(stats, EXIT_CLEAR);
+    return 1;
+}
+
+/**
+ * @brief Check audibility on destination voxel without the traversal of the segment: by the previous value, 
+ * the distance, the common building and the known visibility. Parameters are the same as check_audibility().
+ *
+ * @param target Pointer to the code of audibility of the destination voxel, if the segment is clear.
+ * @return signed char the code of audibility or 0 if the segment must be traversed.
+ */
+static inline signed char check_audibility_without_traversal(signed long x_dst, signed long y_dst, signed long z_dst, 
+    signed long uib_dst, signed long x_src, signed long y_src, signed long z_src, signed long uib_src, 
+    unsigned char flag_calculate_audibility, double possible_distance_int, double scale_z,
+    signed char known_visibility, signed char audibility_prev, unsigned char *target, audibility_stats *stats) {
+
+    // Voxel is just audible. Nothing to check
+    if (audibility_prev > 1) {
+        count_exit(stats, EXIT_AUDIBLE);
+        return audibility_prev;
+    }
+
+    // Calculate distance between source and destination voxels in horizontal voxel's edges
+    double dx = x_dst - x_src;
+    double dy = y_dst - y_src;
+    double dz = (z_dst - z_src) * scale_z;
+    double distance = sqrt(dx * dx + dy * dy + dz * dz);
+
+    
+    // Check, if we can not improve audibility of the destination voxel
+    if ((distance > possible_distance_int) && (audibility_prev > 0)) {
+        count_exit(stats, EXIT_DISTANCE);
+        return audibility_prev;
+    }
+
+    // Avoid division by zero
+    if (distance == 0) { 
+        count_exit(stats, EXIT_CLEAR);
+        return 2;
+    }
+    
+    // Check if the distance is greater than the distance of possible audibility in the buildings
+    *target = 1;
+    if (distance <= possible_distance_int) { 
+        *target = 2;
+    }
+
+    // Check if we do not need to calculate audibility
+    if (flag_calculate_audibility == 0) {
+        count_exit(stats, EXIT_DISTANCE);
+        return *target;
+    }
+
+    // Common building is audibility by default
+    if ((uib_src >= 0) && (uib_dst == uib_src)) {
+        count_exit(stats, EXIT_SAME_BUILDING);
+        return *target;
+    }
+
+    // Visibility was found earlier without traversal
+    if (known_visibility >= 0) {
+        count_exit(stats, EXIT_KNOWN);
+        if (known_visibility == 0) {
+            // If previous audibility was better, return it
+            return (audibility_prev > 0 ? audibility_prev : -1);
+        }
+        return *target;
+    }
+
+    return 0;
+}
+
+/**
+ * @brief Check audibility on destination voxel with integer coordinates (xDst, yDst, zDst)
+ * from megaphone on source voxel with integer coordinates (xSrc, ySrc, zSrc)
+ * uibDst - UIB of building on checked destination voxel, -1 if not exists
+ * uibSrc - UIB of building, where is source megaphone based
+ *
+ * @param x_dst The x-coordinate of the destination voxel.
+ * @param y_dst The y-coordinate of the destination voxel.
+ * @param z_dst The z-coordinate of the destination voxel.
+ * @param uib_dst The unique identificator of the destination building (if exists).
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings:
+ *       0 - each voxel of building positioned at its own ground level
+ *       1..n - each voxel of building positioned at the common level for the entire building
+ * @param size_step The step size for checking audibility of voxels.
+ * @param traversal_mode Mode to walk along the segment between source and destination voxels:
+ *       0 - fixed steps of size_step voxels along the longest axis
+ *       1 - exact traversal of each (x, y) cell crossed by the segment
+ * @param pyramid Pointer to the obstacles heights pyramid to skip empty blocks with exact traversal (can be NULL).
+ * @param flag_calculate_audibility Flag to calculate audibility (1) or not (0).
+ * @param possible_distance_int The distance of possible audibility in the buildings, horizontal voxel's edges.
+ * @param scale_z The ratio of the vertical and the horizontal voxel's edges: differences of z-coordinates
+ *        are multiplied by it to get distances.
+ * @param known_visibility Visibility of the destination voxel if it is already known (e.g. from the sweep):
+ *       -1 - unknown, the segment must be traversed
+ *       0 - there are obstacles between source and destination voxels
+ *       1 - there are no obstacles between source and destination voxels
+ * @param audibility_prev The previous value of audibility of the destination voxel.
+ * @param stats Pointer to the counters of the instrumented mode (NULL if it is off).
+ * @return signed char:
+ * 2 if the destination voxel is audible and distance between them and sound source is less than possible_distance_int,
+ * 1 if the destination voxel is audible but distance between them and sound source is more than possible_distance_int,
+ * -1 otherwise.
+ */
+signed char check_audibility(signed long x_dst, signed long y_dst, signed long z_dst, signed long uib_dst, 
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src, 
+    unsigned int bounds_y, signed short *ground, signed long *uibs, 
+    unsigned int building_size, unsigned short *buildings, 
+    unsigned char building_ground_mode, double size_step, unsigned char traversal_mode,
+    height_pyramid *pyramid, unsigned char flag_calculate_audibility, double possible_distance_int, double scale_z,
+    signed char known_visibility, signed char audibility_prev, audibility_stats *stats) {
+
+    // Find the result without the traversal, if it is possible
+    unsigned char target = 1;
+    signed char result = check_audibility_without_traversal(x_dst, y_dst, z_dst, uib_dst, x_src, y_src, z_src, uib_src,
+        flag_calculate_audibility, possible_distance_int, scale_z, known_visibility, audibility_prev, &target, stats);
+    if (result != 0) {
+        return result;
+    }
+
+    // If there are obstacles between source and destination voxels, previous audibility can be better
+    if (!is_segment_clear(x_dst, y_dst, z_dst, uib_dst, x_src, y_src, z_src, uib_src,
+                          bounds_y, ground, uibs, building_size, buildings, 
+                          building_ground_mode, size_step, traversal_mode, pyramid, stats)) {
+        return (audibility_prev > 0 ? audibility_prev : -1);
+    }
+
+    // If no obstacles were found, the destination voxel is audible
+    return target;
+}
+
+/**
+ * @brief Calculates the code of the sound level of the megaphone at the distance without obstacles.
+ * Codes of sound levels: 0 - not checked, 1 - there are obstacles, 
+ * 2..65535 - sound level in hundredths of dBA, rounded down (levels lower than 0.02 dBA are stored as 2).
+ *
+ * @param distance The distance between megaphone and destination voxel, in horizontal voxel's edges.
+ * @param level_megaphone The sound power of the megaphone, dBA.
+ * @param size_voxel The voxel's edge size, meters.
+ * @return unsigned short code of the sound level.
+ */
+static inline unsigned short get_sound_level(double distance, double level_megaphone, double size_voxel) {
+    if (distance <= 0) {
+        return 65535;
+    }
+    // Round down: the level reaches a threshold exactly when the distance is within the radius of this threshold
+    double level = floor(100.0 * (level_megaphone - 20.0 * log10(distance * size_voxel)));
+    return (unsigned short)fmin(fmax(level, 2.0), 65535.0);
+}
+
+/**
+ * @brief Restrict the destination cell to the beams of the horns of the directional megaphone and the short rear lobes behind them.
+ * Several horns on the same source position (a roof or a mast) are calculated as one megaphone:
+ * the destination cell gets the best of them. Outside all beams the megaphone works as a weaker one: 
+ * its sound power is reduced by the smallest rear_attenuation of its horns,
+ * so all distances of possible audibility are multiplied by the same factor.
+ *
+ * @param dx The offset of the destination cell from the megaphone cell along the x axis (to the east), in voxels.
+ * @param dy The offset of the destination cell from the megaphone cell along the y axis (to the south), in voxels.
+ * @param count_horns The count of horns of the megaphone.
+ * @param horns_azimuth Pointer to the array of azimuths of the axes of the beams, degrees clockwise from the north.
+ * @param horns_width Pointer to the array of widths of the beams, degrees: 0 or 360 for the omnidirectional horn.
+ * @param horns_rear Pointer to the array of sound declines outside the beams, dBA (negative values).
+ * @param possible_distance_ext The distance of possible audibility on the streets, in voxels.
+ * @param distance_int Pointer to the distance of possible audibility in the buildings, in voxels (reduced outside the beams).
+ * @param level_source Pointer to the sound power of the megaphone, dBA (reduced outside the beams).
+ * @return 1 if the destination cell can be reached by the sound, 0 otherwise.
+ */
+static inline unsigned char apply_beam(double dx, double dy, unsigned int count_horns, float *horns_azimuth,
+    float *horns_width, float *horns_rear, double possible_distance_ext, double *distance_int, double *level_source) {
+
+    // The north is directed against the y axis of the world. The cell of the megaphone is always in the beam
+    if ((dx == 0) && (dy == 0)) {
+        return 1;
+    }
+    double bearing = atan2(dx, -dy) * (180.0 / M_PI);
+    double rear_attenuation = -INFINITY;
+    for (unsigned int h = 0; h < count_horns; h++) {
+        if ((horns_width[h] <= 0) || (horns_width[h] >= 360) ||
+            (fabs(fmod(bearing - horns_azimuth[h] + 540.0, 360.0) - 180.0) <= horns_width[h] / 2.0)) {
+            return (hypot(dx, dy) <= possible_distance_ext);
+        }
+        rear_attenuation = fmax(rear_attenuation, horns_rear[h]);
+    }
+    double factor = pow(10.0, rear_attenuation / 20.0);
+    *distance_int = *distance_int * factor;
+    *level_source = *level_source + rear_attenuation;
+    return (hypot(dx, dy) <= possible_distance_ext * factor);
+}
+
+/**
+ * @brief Check sound level on destination voxel with integer coordinates (xDst, yDst, zDst)
+ * from megaphone on source voxel with integer coordinates (xSrc, ySrc, zSrc).
+ * The same as check_audibility(), but returns the maximum received sound level instead of the audibility code.
+ *
+ * @param x_dst The x-coordinate of the destination voxel.
+ * @param y_dst The y-coordinate of the destination voxel.
+ * @param z_dst The z-coordinate of the destination voxel.
+ * @param uib_dst The unique identificator of the destination building (if exists).
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @param size_step The step size for checking audibility of voxels.
+ * @param traversal_mode Mode to walk along the segment: 0 - fixed steps, 1 - exact traversal.
+ * @param pyramid Pointer to the obstacles heights pyramid to skip empty blocks with exact traversal (can be NULL).
+ * @param flag_calculate_audibility Flag to calculate audibility (1) or not (0).
+ * @param level_megaphone The sound power of the megaphone, dBA.
+ * @param size_voxel The horizontal voxel's edge size, meters.
+ * @param scale_z The ratio of the vertical and the horizontal voxel's edges.
+ * @param known_visibility Visibility of the destination voxel if it is already known: -1 - unknown, 0 - blocked, 1 - visible.
+ * @param level_prev The previous code of the sound level of the destination voxel.
+ * @param stats Pointer to the counters of the instrumented mode (NULL if it is off).
+ * @return unsigned short the new code of the sound level.
+ */
+unsigned short check_sound_level(signed long x_dst, signed long y_dst, signed long z_dst, signed long uib_dst, 
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src, 
+    unsigned int bounds_y, signed short *ground, signed long *uibs, 
+    unsigned int building_size, unsigned short *buildings, 
+    unsigned char building_ground_mode, double size_step, unsigned char traversal_mode,
+    height_pyramid *pyramid, unsigned char flag_calculate_audibility, 
+    double level_megaphone, double size_voxel, double scale_z,
+    signed char known_visibility, unsigned short level_prev, audibility_stats *stats) {
+
+    double dx = x_dst - x_src;
+    double dy = y_dst - y_src;
+    double dz = (z_dst - z_src) * scale_z;
+    unsigned short level = get_sound_level(sqrt(dx * dx + dy * dy + dz * dz), level_megaphone, size_voxel);
+
+    // Check, if we can not improve the sound level of the destination voxel
+    if (level_prev >= level) {
+        count_exit(stats, EXIT_AUDIBLE);
+        return level_prev;
+    }
+
+    // Check if we do not need to calculate audibility
+    if (flag_calculate_audibility == 0) {
+        count_exit(stats, EXIT_DISTANCE);
+        return level;
+    }
+
+    // Common building is audibility by default
+    if ((uib_src >= 0) && (uib_dst == uib_src)) {
+        count_exit(stats, EXIT_SAME_BUILDING);
+        return level;
+    }
+
+    // Check visibility, if it is not known yet
+    if (known_visibility >= 0) {
+        count_exit(stats, EXIT_KNOWN);
+    } else {
+        known_visibility = is_segment_clear(x_dst, y_dst, z_dst, uib_dst, x_src, y_src, z_src, uib_src,
+                                            bounds_y, ground, uibs, building_size, buildings, 
+                                            building_ground_mode, size_step, traversal_mode, pyramid, stats);
+    }
+    if (known_visibility == 0) {
+        return (level_prev > 1 ? level_prev : 1);
+    }
+    return level;
+}
+
+/**
+ * @brief Find the lowest floor of the building column on destination cell (x_dst, y_dst), 
+ * which has no obstacles on the segment to the megaphone on source voxel (x_src, y_src, z_src).
+ * The (x, y) path is walked only once for all floors. The lowest point of the segment in each cell rises 
+ * together with the destination floor, so if a floor is blocked by the cell, all lower floors are blocked too.
+ * The candidate floor is raised each time, when the current cell is an obstacle for it.
+ * Points of the segments are calculated in the same way as in check_audibility(), 
+ * so with exact traversal results are the same as after separate check of each floor.
+ * With fixed steps the step size is the smallest one among all floors.
+ *
+ * @param x_dst The x-coordinate of the destination cell.
+ * @param y_dst The y-coordinate of the destination cell.
+ * @param z_start The z-coordinate of the first floor of the destination building.
+ * @param floor_first The lowest floor to check.
+ * @param floor_last The highest floor to check.
+ * @param uib_dst The unique identificator of the destination building.
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param ground Pointer to the signed short array with ground levels.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param building_size The size of each building entry in the buildings array.
+ * @param buildings Pointer to unsigned short array of building information.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @param size_step The step size for checking audibility of voxels.
+ * @param traversal_mode Mode to walk along the segment: 0 - fixed steps, 1 - exact traversal.
+ * @param pyramid Pointer to the obstacles heights pyramid to skip empty blocks with exact traversal (can be NULL).
+ * @param stats Pointer to the counters of the instrumented mode (NULL if it is off). 
+ *       The walk is counted in the histogram of steps, checks of floors are counted later with known visibility.
+ * @return signed long the lowest visible floor, floor_last+1 if all floors are blocked.
+ */
+signed long find_first_visible_floor(signed long x_dst, signed long y_dst, signed long z_start,
+    signed long floor_first, signed long floor_last, signed long uib_dst,
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    unsigned int bounds_y, signed short *ground, signed long *uibs,
+    unsigned int building_size, unsigned short *buildings,
+    unsigned char building_ground_mode, double size_step, unsigned char traversal_mode,
+    height_pyramid *pyramid, audibility_stats *stats) {
+
+    double dx = x_dst - x_src;
+    double dy = y_dst - y_src;
+    signed long floor = floor_first;
+    unsigned long steps = 0; // Count of steps for the instrumented mode
+
+    if (traversal_mode == 0) {
+
+        // The smallest step among all floors: the longest axis distance is the biggest for the lowest or the highest floor
+        double dz_first = z_start + floor_first - z_src;
+        double dz_last = z_start + floor_last - z_src;
+        double max_axis_distance = fmax(fmax(fabs(dx), fabs(dy)), fmax(fabs(dz_first), fabs(dz_last)));
+        double step = size_step / max_axis_distance;
+
+        double t = 0.0;
+        while (t <= 1.0) {
+            signed long x = round(x_src + t * dx);
+            signed long y = round(y_src + t * dy);
+            steps++;
+
+            // Raise the candidate floor while the intermediate voxel is an obstacle for it
+            while (floor <= floor_last) {
+                double dz = z_start + floor - z_src;
+                signed long z = round(z_src + t * dz);
+                if ((pyramid != NULL) && (z >= get_pyramid_height(pyramid, 0, x, y))) {
+                    break;
+                }
+                if (!is_obstacle(x, y, z, uib_dst, uib_src, bounds_y, ground, uibs,
+                                 building_size, buildings, building_ground_mode)) {
+                    break;
+                }
+                floor++;
+            }
+            if (floor > floor_last) {
+                count_steps(stats, steps);
+                return floor;
+            }
+
+            t += step;
+        }
+
+    } else {
+
+        grid_ray ray;
+        grid_ray_init(&ray, x_src, y_src, x_dst, y_dst);
+        double inv_dx = 1.0 / dx;
+        double inv_dy = 1.0 / dy;
+        unsigned char more = 1;
+        signed long failed_x = -1, failed_y = -1; // The last 2x2 block which can not be skipped
+        while (more) {
+            steps++;
+
+            // Skip the whole block of cells without obstacles for the candidate floor (and for all higher floors)
+            if ((pyramid != NULL) && (((ray.x >> 1) != failed_x) || ((ray.y >> 1) != failed_y))) {
+                unsigned int level = find_empty_level(pyramid, &ray, x_src, y_src, z_src, inv_dx, inv_dy, 
+                    (double)(z_start + floor - z_src));
+                if (level == 0) {
+                    failed_x = ray.x >> 1;
+                    failed_y = ray.y >> 1;
+                } else {
+                    more = grid_ray_skip_block(&ray, level);
+                    continue;
+                }
+            }
+
+            // Raise the candidate floor while the lowest point of its segment in the cell is an obstacle
+            while (floor <= floor_last) {
+                double dz = z_start + floor - z_src;
+                signed long z = round(z_src + (dz > 0 ? ray.t_in : ray.t_out) * dz);
+                if ((pyramid != NULL) && (z >= get_pyramid_height(pyramid, 0, ray.x, ray.y))) {
+                    break;
+                }
+                if (!is_obstacle(ray.x, ray.y, z, uib_dst, uib_src, bounds_y, ground, uibs,
+                                 building_size, buildings, building_ground_mode)) {
+                    break;
+                }
+                floor++;
+            }
+            if (floor > floor_last) {
+                count_steps(stats, steps);
+                return floor;
+            }
+
+            more = grid_ray_next(&ray);
+        }
+
+    }
+
+    count_steps(stats, steps);
+    return floor;
+}
+
+/**
+ * @brief Calculates visibility of the earth's surface squares around the source voxel in one radial sweep.
+ * Segments are traced from the source cell to each cell on the perimeter of the square [-radius, +radius] 
+ * around it. Along each segment we carry the running maximum of the elevation angle (slope) of obstacles: 
+ * extraneous buildings tops and the earth's surface. Square is visible if the slope to its ground level 
+ * is not less than the running maximum, collected before this square. Square is visible if it is visible 
+ * along the segment, which passes closest to its center. Squares with buildings are not reliable: their own building is not excluded.
  *
- * @param x_dst The x-coordinate of the destination voxel.
- * @param y_dst The y-coordinate of the destination voxel.
- * @param z_dst The z-coordinate of the destination voxel.
- * @param uib_dst The unique identificator of the destination building (if exists).
  * @param x_src The x-coordinate of the source voxel.
  * @param y_src The y-coordinate of the source voxel.
  * @param z_src The z-coordinate of the source voxel.
  * @param uib_src The unique identificator of the source building (if exists).
+ * @param radius The half-size of the square around the source cell (in cells).
+ * @param visible Pointer to the (2*radius+1)*(2*radius+1) array for results, initialized by 0 values:
+ *       1 - square is visible, -1 - square is not visible, 0 - square was not reached by the sweep.
+ * @param offsets Pointer to the (2*radius+1)*(2*radius+1) array of distances between the squares centers 
+ *       and the segments used to find their visibility.
+ * @param bounds_x The x-dimension size of the world.
  * @param bounds_y The y-dimension size of the world.
  * @param ground Pointer to the signed short array with ground levels.
  * @param uibs Pointer to the signed long array of building identificators.
  * @param building_size The size of each building entry in the buildings array.
  * @param buildings Pointer to unsigned short array of building information.
- * @param building_ground_mode Mode to determine ground point of buildings:
- *       0 - each voxel of building positioned at its own ground level
- *       1..n - each voxel of building positioned at the common level for the entire building
- * @param size_step The step size for checking audibility of voxels.
- * @param flag_calculate_audibility Flag to calculate audibility (1) or not (0).
- * @param possible_distance_int The distance of possible audibility in the buildings.
- * @param audibility_prev The previous value of audibility of the destination voxel.
- * @return signed char:
- * 2 if the destination voxel is audible and distance between them and sound source is less than possible_distance_int,
- * 1 if the destination voxel is audible but distance between them and sound source is more than possible_distance_int,
- * -1 otherwise.
+ * @param building_ground_mode Mode to determine ground point of buildings.
+ * @return void
  */
-signed char check_audibility(signed long x_dst, signed long y_dst, signed long z_dst, signed long uib_dst, 
-    signed long x_src, signed long y_src, signed long z_src, signed long uib_src, 
-    unsigned int bounds_y, signed short *ground, signed long *uibs, 
-    unsigned int building_size, unsigned short *buildings, 
-    unsigned char building_ground_mode, double size_step, 
-    unsigned char flag_calculate_audibility, double possible_distance_int,
-    signed char audibility_prev) {
+void sweep_visibility(signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    signed long radius, signed char *visible, float *offsets,
+    unsigned int bounds_x, unsigned int bounds_y, signed short *ground, signed long *uibs,
+    unsigned int building_size, unsigned short *buildings,
+    unsigned char building_ground_mode) {
 
-    // Voxel is just audible. Nothing to check
-    if (audibility_prev > 1) {
-        return audibility_prev;
+    signed long side = 2 * radius + 1;
+
+    // Loop through cells of the perimeter
+    for (signed long k = 0; k < 8 * radius; k++) {
+
+        // Coordinates of the perimeter cell: go around the square side by side
+        signed long x_end, y_end;
+        if (k < 2 * radius) {
+            x_end = x_src - radius + k;
+            y_end = y_src - radius;
+        } else if (k < 4 * radius) {
+            x_end = x_src + radius;
+            y_end = y_src - radius + (k - 2 * radius);
+        } else if (k < 6 * radius) {
+            x_end = x_src + radius - (k - 4 * radius);
+            y_end = y_src + radius;
+        } else {
+            x_end = x_src - radius;
+            y_end = y_src + radius - (k - 6 * radius);
+        }
+
+        // Go along the segment from the source cell and carry maximum slope of obstacles
+        double slope_max = -INFINITY;
+        double length = sqrt((double)((x_end - x_src) * (x_end - x_src) + (y_end - y_src) * (y_end - y_src)));
+        grid_ray ray;
+        grid_ray_init(&ray, x_src, y_src, x_end, y_end);
+        while (grid_ray_next(&ray)) {
+
+            // Stop at the border of the world
+            if ((ray.x < 0) || (ray.y < 0) || (ray.x >= bounds_x) || (ray.y >= bounds_y)) {
+                break;
+            }
+
+            signed long dx = ray.x - x_src;
+            signed long dy = ray.y - y_src;
+            double distance = sqrt((double)(dx * dx + dy * dy));
+            signed short z_ground = ground[ray.x * bounds_y + ray.y];
+            signed long uib = uibs[ray.x * bounds_y + ray.y];
+
+            // Visibility of the square: segment to the square must be not lower than all obstacles before.
+            // Use the segment, which passes closest to the center of the square
+            signed long idx = (dx + radius) * side + (dy + radius);
+            float offset = fabs((double)(dx * (y_end - y_src) - dy * (x_end - x_src))) / length;
+            if ((visible[idx] == 0) || (offset < offsets[idx])) {
+                offsets[idx] = offset;
+                visible[idx] = ((z_ground - z_src) / distance >= slope_max ? 1 : -1);
+            }
+
+            // Height of obstacle on this cell: the same rounding rules as in is_obstacle()
+            double height;
+            if (uib >= 0) {
+                if (uib == uib_src) {
+                    continue; // Source building is not an obstacle
+                }
+                height = get_first_building_voxel(ray.x, ray.y, uib, bounds_y, ground, 
+                    building_size, buildings, building_ground_mode) + buildings[uib * building_size] - 0.5;
+            } else {
+                height = z_ground - 1.5;
+            }
+            // The steepest slope is at the entry to the cell for higher obstacles and at the exit for lower ones
+            double slope = (height - z_src) / ((height > z_src ? ray.t_in : ray.t_out) * length);
+            if (slope > slope_max) {
+                slope_max = slope;
+            }
+        }
     }
+}
 
-    // Calculate distance between source and destination voxels
-    double dx = x_dst - x_src;
-    double dy = y_dst - y_src;
-    double dz = z_dst - z_src;
-    double distance = sqrt(dx * dx + dy * dy + dz * dz);
+/**
+ * @brief Merges two audibility values and returns the best of them. 
+ * Values are ordered as: 0 (unknown) < -1 (no) < 1 (only on the streets) < 2 (on the streets and in the buildings).
+ *
+ * @param a The first audibility value.
+ * @param b The second audibility value.
+ * @return signed char the best audibility value.
+ */
+static inline signed char merge_audibility(signed char a, signed char b) {
+    if (a == 0) {
+        return b;
+    }
+    if (b == 0) {
+        return a;
+    }
+    return (a > b ? a : b);
+}
 
-    
-    // Check, if we can not improve audibility of the destination voxel
-    if ((distance > possible_distance_int) && (audibility_prev > 0)) {
-        return audibility_prev;
+/**
+ * @brief Atomically merges audibility value into the shared memory, 
+ * so concurrent merges from other processes are never lost.
+ *
+ * @param shared Pointer to the audibility value in the shared memory.
+ * @param value The audibility value to merge.
+ * @return void
+ */
+static inline void merge_audibility_shared(signed char *shared, signed char value) {
+    signed char old = __atomic_load_n(shared, __ATOMIC_RELAXED);
+    signed char merged = merge_audibility(old, value);
+    while ((merged != old) && 
+           !__atomic_compare_exchange_n(shared, &old, merged, 1, __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+        merged = merge_audibility(old, value);
     }
+}
 
-    // Avoid division by zero
-    if (distance == 0) { 
-        return 2;
+/**
+ * @brief Retrieves the previous audibility value of the square or voxel. 
+ * With private buffers it is the best of the private value and the current shared one:
+ * shared value is only a hint to skip the checks, which can not improve the final result.
+ *
+ * @param shared Pointer to the audibility value in the shared memory.
+ * @param own Pointer to the audibility value in the private buffer, NULL if private buffers are not used.
+ * @return signed char the previous audibility value.
+ */
+static inline signed char get_audibility(signed char *shared, signed char *own) {
+    if (own == NULL) {
+        return *shared;
     }
-    
-    // Check if the distance is greater than the distance of possible audibility in the buildings
-    unsigned char target = 1;
-    if (distance <= possible_distance_int) { 
-        target = 2;
+    return merge_audibility(*own, __atomic_load_n(shared, __ATOMIC_RELAXED));
+}
+
+/**
+ * @brief Stores the audibility value of the square or voxel into the private buffer (if used) or into the shared memory.
+ *
+ * @param shared Pointer to the audibility value in the shared memory.
+ * @param own Pointer to the audibility value in the private buffer, NULL if private buffers are not used.
+ * @param value The audibility value to store.
+ * @return void
+ */
+static inline void set_audibility(signed char *shared, signed char *own, signed char value) {
+    if (own == NULL) {
+        *shared = value;
+    } else {
+        *own = value;
     }
+}
 
-    // Check if we do not need to calculate audibility
-    if (flag_calculate_audibility == 0) {
-        return target;
+/**
+ * @brief Atomically merges the code of the sound level into the shared memory: the maximum value is kept.
+ *
+ * @param shared Pointer to the code of the sound level in the shared memory.
+ * @param value The code of the sound level to merge.
+ * @return void
+ */
+static inline void merge_level_shared(unsigned short *shared, unsigned short value) {
+    unsigned short old = __atomic_load_n(shared, __ATOMIC_RELAXED);
+    while ((value > old) && 
+           !__atomic_compare_exchange_n(shared, &old, value, 1, __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+        // Failed exchange reloads the current value into old
+    }
+}
+
+/**
+ * @brief Retrieves the previous code of the sound level of the square or voxel, the same as get_audibility().
+ *
+ * @param shared Pointer to the code of the sound level in the shared memory.
+ * @param own Pointer to the code of the sound level in the private buffer, NULL if private buffers are not used.
+ * @return unsigned short the previous code of the sound level.
+ */
+static inline unsigned short get_level(unsigned short *shared, unsigned short *own) {
+    if (own == NULL) {
+        return *shared;
     }
+    unsigned short value = __atomic_load_n(shared, __ATOMIC_RELAXED);
+    return (*own > value ? *own : value);
+}
 
-    // Common building is audibility by default
-    if ((uib_src >= 0) && (uib_dst == uib_src)) {
-        return target;
+/**
+ * @brief Stores the code of the sound level into the private buffer (if used) or into the shared memory.
+ *
+ * @param shared Pointer to the code of the sound level in the shared memory.
+ * @param own Pointer to the code of the sound level in the private buffer, NULL if private buffers are not used.
+ * @param value The code of the sound level to store.
+ * @return void
+ */
+static inline void set_level(unsigned short *shared, unsigned short *own, unsigned short value) {
+    if (own == NULL) {
+        *shared = value;
+    } else {
+        *own = value;
     }
+}
 
-    // Find the maximum distance along the axes
-    double max_axis_distance = fmax(fmax(abs(dx), abs(dy)), abs(dz)); 
-    // Calculate step size on the longest axis to check audibility of voxels
-    double step = size_step / max_axis_distance; 
+/**
+ * @brief Packet of segments from the same source voxel with fixed steps traversal, 
+ * which are walked together by SIMD instructions (one lane for each segment).
+ * Segments are collected while the results of other checks are found and walked, when the packet is full.
+ */
+#define PACKET_SIZE 8 // Count of segments in the packet
+typedef struct {
+    unsigned int count; // Count of collected segments
+    double dx[PACKET_SIZE], dy[PACKET_SIZE], dz[PACKET_SIZE]; // Distances between source and destination voxels along the axes
+    long long uib_dst[PACKET_SIZE]; // Unique identificators of the destination buildings
+    signed char *shared[PACKET_SIZE]; // Pointers to the audibility values in the shared memory
+    signed char *own[PACKET_SIZE]; // Pointers to the audibility values in the private buffers (NULL if they are not used)
+    signed char target[PACKET_SIZE]; // Codes of audibility, if the segment is clear
+    signed char prev[PACKET_SIZE]; // Previous audibility values
+} ray_packet;
 
-    // Analyze segment between source and destination voxels
-    // We move in small steps along the segment and check for extraneous buildings or the earth's surface.
-    double t = 0.0;
-    while (t <= 1.0) {
+static unsigned char packet_support = 0; // The best SIMD instructions of the CPU: 0 - none, 1 - AVX2, 2 - AVX-512
 
-        // Calculate coordinates of the Intermediate voxel (x, y, z) on the segment
-        signed long x = round(x_src + t * dx);
-        signed long y = round(y_src + t * dy);
-        signed long z = round(z_src + t * dz);
-        signed long uib = uibs[x * bounds_y + y];
-        
-        // if intermediate voxel does not belong to source or destination buildings
-        if ((uib >= 0) && (uib != uib_src) && (uib != uib_dst)) {
-            // If there is an extraneous building on the intermediate voxel, check if the intermediate voxel is higher than the building
-            if (z < (get_first_building_voxel(x, y, uib, bounds_y, ground, building_size, buildings, building_ground_mode) + buildings[uib * building_size] )) {
-                // If previous audibility was better, return it
-                return (audibility_prev > 0 ? audibility_prev : -1);
-            }
+#if defined(__x86_64__) && defined(__GNUC__)
+#include <immintrin.h>
+
+/**
+ * @brief Finds the best SIMD instructions of the CPU for packets of segments, once at loading of the library.
+ */
+__attribute__((constructor)) static void detect_packet_support(void) {
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx2")) {
+        packet_support = 2;
+    } else if (__builtin_cpu_supports("avx2")) {
+        packet_support = 1;
+    }
+}
+
+/**
+ * @brief Rounds half away from zero like round() of the C library (SIMD rounding is half to even).
+ */
+__attribute__((target("avx2"), optimize("fp-contract=off"))) static inline __m256d round_avx2(__m256d v) {
+    __m256d sign = _mm256_and_pd(v, _mm256_set1_pd(-0.0));
+    __m256d a = _mm256_andnot_pd(_mm256_set1_pd(-0.0), v);
+    __m256d whole = _mm256_round_pd(a, _MM_FROUND_TO_ZERO | _MM_FROUND_NO_EXC);
+    __m256d up = _mm256_and_pd(_mm256_cmp_pd(_mm256_sub_pd(a, whole), _mm256_set1_pd(0.5), _CMP_GE_OQ), _mm256_set1_pd(1.0));
+    return _mm256_or_pd(_mm256_add_pd(whole, up), sign);
+}
+
+/**
+ * @brief Walks 4 segments of the packet from the lane first together with AVX2 instructions.
+ * Steps, coordinates and obstacles are the same as in is_segment_clear() with fixed steps.
+ * Obstacles heights are taken from the level 0 of the pyramid, buildings are gathered only for the cells
+ * lower than obstacles heights. Unused lanes must repeat the used ones.
+ *
+ * @return unsigned int bit mask of lanes with clear segments.
+ */
+__attribute__((target("avx2"), optimize("fp-contract=off"))) static unsigned int walk_packet_avx2(ray_packet *packet, unsigned int first,
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    unsigned int bounds_y, signed long *uibs, height_pyramid *pyramid, double size_step) {
+
+    unsigned int lanes = (packet->count - first >= 4 ? 0xF : (1u << (packet->count - first)) - 1);
+    __m256d dx = _mm256_loadu_pd(&packet->dx[first]);
+    __m256d dy = _mm256_loadu_pd(&packet->dy[first]);
+    __m256d dz = _mm256_loadu_pd(&packet->dz[first]);
+    __m256i uib_dst = _mm256_loadu_si256((__m256i *)&packet->uib_dst[first]);
+    __m256d abs_mask = _mm256_set1_pd(-0.0);
+    __m256d max_axis_distance = _mm256_max_pd(_mm256_max_pd(_mm256_andnot_pd(abs_mask, dx), 
+        _mm256_andnot_pd(abs_mask, dy)), _mm256_andnot_pd(abs_mask, dz));
+    __m256d step = _mm256_div_pd(_mm256_set1_pd(size_step), max_axis_distance);
+    __m256d xs = _mm256_set1_pd(x_src), ys = _mm256_set1_pd(y_src), zs = _mm256_set1_pd(z_src);
+    __m256d one = _mm256_set1_pd(1.0);
+    __m128i by = _mm_set1_epi32(bounds_y);
+    __m256i src = _mm256_set1_epi64x(uib_src);
+    __m256i zero = _mm256_setzero_si256();
+    __m256d t = _mm256_setzero_pd();
+    unsigned int active = lanes;
+    while (1) {
+        unsigned int live = active & _mm256_movemask_pd(_mm256_cmp_pd(t, one, _CMP_LE_OQ));
+        if (live == 0) {
+            break;
         }
 
-        // If there is no building there, check if the intermediate voxel is higher than the earth's surface
-        if (uib < 0) {
-            if (z < ( ground[x * bounds_y + y] -1 )) { // -1 for smoothing out the steps of the earth's surface
-                // If previous audibility was better, return it
-                return (audibility_prev > 0 ? audibility_prev : -1);
-            }
+        // Coordinates of the intermediate voxels. Finished lanes stay on the destination voxel inside the world
+        __m256d tt = _mm256_min_pd(t, one);
+        __m256d x = round_avx2(_mm256_add_pd(xs, _mm256_mul_pd(tt, dx)));
+        __m256d y = round_avx2(_mm256_add_pd(ys, _mm256_mul_pd(tt, dy)));
+        __m256d z = round_avx2(_mm256_add_pd(zs, _mm256_mul_pd(tt, dz)));
+        __m128i xi = _mm256_cvtpd_epi32(x);
+        __m128i yi = _mm256_cvtpd_epi32(y);
+        __m128i cells = _mm_add_epi32(_mm_mullo_epi32(xi, by), yi);
+
+        // Gather obstacles heights of the cells and buildings of the cells lower than obstacles
+        __m128i height = _mm_i32gather_epi32((const int *)pyramid->heights, cells, 2);
+        height = _mm_srai_epi32(_mm_slli_epi32(height, 16), 16);
+        __m128i lower = _mm_cmplt_epi32(_mm256_cvtpd_epi32(z), height);
+        unsigned int below = _mm_movemask_ps(_mm_castsi128_ps(lower));
+        if ((live & below) == 0) {
+            t = _mm256_add_pd(t, step);
+            continue;
+        }
+        __m256i uib = _mm256_mask_i32gather_epi64(src, (const long long *)uibs, cells, _mm256_cvtepi32_epi64(lower), 8);
+        unsigned int street = _mm256_movemask_pd(_mm256_castsi256_pd(_mm256_cmpgt_epi64(zero, uib)));
+        unsigned int own = _mm256_movemask_pd(_mm256_castsi256_pd(_mm256_or_si256(
+            _mm256_cmpeq_epi64(uib, src), _mm256_cmpeq_epi64(uib, uib_dst))));
+        active &= ~(live & below & (street | ~own));
+        t = _mm256_add_pd(t, step);
+    }
+    return active;
+}
+
+/**
+ * @brief Rounds half away from zero like round() of the C library.
+ */
+__attribute__((target("avx512f,avx2"), optimize("fp-contract=off"))) static inline __m512d round_avx512(__m512d v) {
+    __m512d a = _mm512_abs_pd(v);
+    __m512d whole = _mm512_roundscale_pd(a, _MM_FROUND_TO_ZERO | _MM_FROUND_NO_EXC);
+    whole = _mm512_mask_add_pd(whole, _mm512_cmp_pd_mask(_mm512_sub_pd(a, whole), _mm512_set1_pd(0.5), _CMP_GE_OQ),
+        whole, _mm512_set1_pd(1.0));
+    return _mm512_mask_sub_pd(whole, _mm512_cmp_pd_mask(v, _mm512_setzero_pd(), _CMP_LT_OQ), _mm512_setzero_pd(), whole);
+}
+
+/**
+ * @brief Walks all 8 segments of the packet together with AVX-512 instructions, the same as walk_packet_avx2().
+ *
+ * @return unsigned int bit mask of lanes with clear segments.
+ */
+__attribute__((target("avx512f,avx2"), optimize("fp-contract=off"))) static unsigned int walk_packet_avx512(ray_packet *packet,
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    unsigned int bounds_y, signed long *uibs, height_pyramid *pyramid, double size_step) {
+
+    __mmask8 lanes = (packet->count >= 8 ? 0xFF : (1u << packet->count) - 1);
+    __m512d dx = _mm512_loadu_pd(packet->dx);
+    __m512d dy = _mm512_loadu_pd(packet->dy);
+    __m512d dz = _mm512_loadu_pd(packet->dz);
+    __m512i uib_dst = _mm512_loadu_si512(packet->uib_dst);
+    __m512d max_axis_distance = _mm512_max_pd(_mm512_max_pd(_mm512_abs_pd(dx), _mm512_abs_pd(dy)), _mm512_abs_pd(dz));
+    __m512d step = _mm512_div_pd(_mm512_set1_pd(size_step), max_axis_distance);
+    __m512d xs = _mm512_set1_pd(x_src), ys = _mm512_set1_pd(y_src), zs = _mm512_set1_pd(z_src);
+    __m512d one = _mm512_set1_pd(1.0);
+    __m256i by = _mm256_set1_epi32(bounds_y);
+    __m512i src = _mm512_set1_epi64(uib_src);
+    __m512d t = _mm512_setzero_pd();
+    __mmask8 active = lanes;
+    while (1) {
+        __mmask8 live = active & _mm512_cmp_pd_mask(t, one, _CMP_LE_OQ);
+        if (live == 0) {
+            break;
         }
 
-        t += step; // Go to the next step on the segment
+        // Coordinates of the intermediate voxels. Finished and unused lanes stay inside the world
+        __m512d tt = _mm512_min_pd(t, one);
+        __m512d x = round_avx512(_mm512_add_pd(xs, _mm512_mul_pd(tt, dx)));
+        __m512d y = round_avx512(_mm512_add_pd(ys, _mm512_mul_pd(tt, dy)));
+        __m512d z = round_avx512(_mm512_add_pd(zs, _mm512_mul_pd(tt, dz)));
+        __m256i xi = _mm512_cvtpd_epi32(x);
+        __m256i yi = _mm512_cvtpd_epi32(y);
+        __m256i cells = _mm256_add_epi32(_mm256_mullo_epi32(xi, by), yi);
+
+        // Gather obstacles heights of the cells and buildings of the cells lower than obstacles
+        __m256i height = _mm256_i32gather_epi32((const int *)pyramid->heights, cells, 2);
+        height = _mm256_srai_epi32(_mm256_slli_epi32(height, 16), 16);
+        __mmask8 below = _mm256_movemask_ps(_mm256_castsi256_ps(_mm256_cmpgt_epi32(height, _mm512_cvtpd_epi32(z))));
+        if ((live & below) == 0) {
+            t = _mm512_add_pd(t, step);
+            continue;
+        }
+        __m512i uib = _mm512_mask_i32gather_epi64(src, below, cells, (const long long *)uibs, 8);
+        __mmask8 street = _mm512_cmplt_epi64_mask(uib, _mm512_setzero_si512());
+        __mmask8 own = _mm512_cmpeq_epi64_mask(uib, src) | _mm512_cmpeq_epi64_mask(uib, uib_dst);
+        active &= ~(live & below & (street | ~own));
+        t = _mm512_add_pd(t, step);
     }
+    return active;
+}
+#endif
 
-    // If no obstacles were found, the destination voxel is audible
-    return target;
+/**
+ * @brief Retrieves the best SIMD instructions of the CPU for packets of segments.
+ *
+ * @return unsigned char 0 - packets are not supported, 1 - AVX2, 2 - AVX-512.
+ */
+unsigned char get_packet_support(void) {
+    return packet_support;
+}
+
+/**
+ * @brief Walks all segments of the packet, stores their audibility values and clears the packet.
+ *
+ * @param packet Pointer to the packet of segments.
+ * @param packet_mode SIMD instructions to use: 1 - AVX2, 2 - AVX-512.
+ * @param x_src The x-coordinate of the source voxel.
+ * @param y_src The y-coordinate of the source voxel.
+ * @param z_src The z-coordinate of the source voxel.
+ * @param uib_src The unique identificator of the source building (if exists).
+ * @param bounds_y The y-dimension size of the world.
+ * @param uibs Pointer to the signed long array of building identificators.
+ * @param pyramid Pointer to the obstacles heights pyramid: its level 0 gives obstacles heights of cells.
+ * @param size_step The step size for checking audibility of voxels.
+ * @param count_audibility Pointer to the counter of audible squares or voxels.
+ * @return void
+ */
+static void flush_packet(ray_packet *packet, unsigned char packet_mode,
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    unsigned int bounds_y, signed long *uibs, height_pyramid *pyramid, double size_step,
+    unsigned long long *count_audibility) {
+
+    if (packet->count == 0) {
+        return;
+    }
+    unsigned int clear = 0;
+#if defined(__x86_64__) && defined(__GNUC__)
+    // Unused lanes repeat the first segment
+    for (unsigned int lane = packet->count; lane < PACKET_SIZE; lane++) {
+        packet->dx[lane] = packet->dx[0];
+        packet->dy[lane] = packet->dy[0];
+        packet->dz[lane] = packet->dz[0];
+        packet->uib_dst[lane] = packet->uib_dst[0];
+    }
+    if (packet_mode == 2) {
+        clear = walk_packet_avx512(packet, x_src, y_src, z_src, uib_src, bounds_y, uibs, pyramid, size_step);
+    } else {
+        for (unsigned int first = 0; first < packet->count; first += 4) {
+            clear |= walk_packet_avx2(packet, first, x_src, y_src, z_src, uib_src, 
+                bounds_y, uibs, pyramid, size_step) << first;
+        }
+    }
+#endif
+    for (unsigned int lane = 0; lane < packet->count; lane++) {
+        signed char flag = packet->target[lane];
+        if (!((clear >> lane) & 1)) {
+            flag = (packet->prev[lane] > 0 ? packet->prev[lane] : -1);
+        }
+        set_audibility(packet->shared[lane], packet->own[lane], flag);
+        (*count_audibility) += (flag > 0 ? 1 : 0);
+    }
+    packet->count = 0;
+}
+
+/**
+ * @brief Adds the segment to the packet and walks the packet, when it is full.
+ * Parameters are the same as flush_packet() and the destination voxel of the segment.
+ *
+ * @return void
+ */
+static inline void add_to_packet(ray_packet *packet, unsigned char packet_mode,
+    signed long x_dst, signed long y_dst, signed long z_dst, signed long uib_dst,
+    signed long x_src, signed long y_src, signed long z_src, signed long uib_src,
+    signed char *shared, signed char *own, signed char target, signed char prev,
+    unsigned int bounds_y, signed long *uibs, height_pyramid *pyramid, double size_step,
+    unsigned long long *count_audibility) {
+
+    unsigned int lane = packet->count;
+    packet->dx[lane] = x_dst - x_src;
+    packet->dy[lane] = y_dst - y_src;
+    packet->dz[lane] = z_dst - z_src;
+    packet->uib_dst[lane] = uib_dst;
+    packet->shared[lane] = shared;
+    packet->own[lane] = own;
+    packet->target[lane] = target;
+    packet->prev[lane] = prev;
+    packet->count++;
+    if (packet->count == PACKET_SIZE) {
+        flush_packet(packet, packet_mode, x_src, y_src, z_src, uib_src, bounds_y, uibs, pyramid, size_step, count_audibility);
+    }
+}
+
+/**
+ * @brief Enumerates cells of the part of the zone of possible audibility of the megaphone from spans of rows of cells. 
+ * Cells are enumerated in the order of spans and only cells marked in the mask are counted.
+ *
+ * @param zones Pointer to the array of spans of rows of cells of zones: x, first y and count of cells of each span.
+ * @param count_spans The count of spans of the zone of the megaphone.
+ * @param index The index of the first value of spans of the zone of the megaphone.
+ * @param mask Pointer to the 2D-array of flags of cells to check for each world's cell (NULL if all cells are checked).
+ * @param bounds_y The y-dimension size of the world.
+ * @param first The number of the first cell of the zone to enumerate.
+ * @param count The count of cells of the zone to enumerate.
+ * @param cells Pointer to the array for linear indexes (x * bounds_y + y) of enumerated cells.
+ * @return signed long the count of enumerated cells.
+ */
+static signed long enumerate_zone(signed long *zones, signed long count_spans, signed long index, unsigned char *mask,
+    unsigned int bounds_y, signed long first, signed long count, unsigned long *cells) {
+    signed long skipped = 0;
+    signed long enumerated = 0;
+    for (signed long s = 0; (s < count_spans) && (enumerated < count); s++) {
+        signed long *span = &zones[index + s * SIZE_SPAN];
+        unsigned long cell = (unsigned long)span[0] * bounds_y + span[1];
+        for (signed long k = 0; (k < span[2]) && (enumerated < count); k++, cell++) {
+            if ((mask != NULL) && (mask[cell] == 0)) {
+                continue;
+            }
+            if (skipped < first) {
+                skipped++;
+                continue;
+            }
+            cells[enumerated++] = cell;
+        }
+    }
+    return enumerated;
 }
 
 /**
  * @brief Calculates the audibility of surface squares and building voxels for a specific megaphone 
  * (for all their cells). It iterates through the cells associated with the megaphone and 
- * checks the audibility of each cell of buffer zones: first - internal buffer zones of the buildings, 
- * next - external buffer zones at the streets. The function updates the audibility status 
+ * checks the audibility of each cell of the given part of buffer zones: first - internal buffer zones 
+ * of the buildings, next - external buffer zones at the streets. The function updates the audibility status 
  * of each cell and voxel based on the presence of buildings and the ground level 
- * between megaphone and destination cell.
+ * between megaphone and destination cell. Cells of the part of buffer zones are enumerated from spans of rows of cells,
+ * so only spans of zones are stored in the shared memory.
  *
  * Parameters:
  * @param uim The index of the megaphone being processed.
  * Pointers on shared memory arrays and its sizes:
- * @param cells_size The size of each cell at arrays in shared memory.
+ * @param cells_size The size of each cell at arrays of megaphones cells in shared memory.
  * @param cells Pointer to the array of cells of a megaphone coordinates.
  * @param cells_count Pointer to the array of megaphones cells counts.
  * @param cells_index Pointer to the array of megaphones cells indexes.
- * @param buffers_int Pointer to the array of cells coordinates of internal (in the buildings) buffers for each megaphone.
- * @param buffers_int_count Pointer to the array of count of cells of internal buffers for each megaphone.
- * @param buffers_int_index Pointer to the array of index of the first cell of internal buffers for each megaphone.
- * @param buffers_ext Pointer to the array of cells coordinates of external (at the streets) buffers for each megaphone.
- * @param buffers_ext_count Pointer to the array of count of cells of external buffers for each megaphone.
- * @param buffers_ext_index Pointer to the array of index of the first cell of external buffers for each megaphone.
+ * @param zones_int Pointer to the array of spans of rows of cells (x, first y, count of cells) of internal (in the buildings) buffers for each megaphone.
+ * @param zones_int_count Pointer to the array of count of spans of internal buffers for each megaphone.
+ * @param zones_int_index Pointer to the array of index of the first value of spans of internal buffers for each megaphone.
+ * @param mask_int Pointer to the 2D-array of flags of checked cells of internal buffers for each world's cell (NULL if all cells are checked).
+ * @param zones_ext Pointer to the array of spans of rows of cells (x, first y, count of cells) of external (at the streets) buffers for each megaphone.
+ * @param zones_ext_count Pointer to the array of count of spans of external buffers for each megaphone.
+ * @param zones_ext_index Pointer to the array of index of the first value of spans of external buffers for each megaphone.
+ * @param mask_ext Pointer to the 2D-array of flags of checked cells of external buffers for each world's cell (NULL if all cells are checked).
+ * Part of the megaphone's buffers to calculate (large megaphones are divided into several tasks):
+ * @param buffer_int_first The number of the first checked cell of the internal buffer of the megaphone to check.
+ * @param buffer_int_count The count of cells of the internal buffer of the megaphone to check.
+ * @param buffer_ext_first The number of the first checked cell of the external buffer of the megaphone to check.
+ * @param buffer_ext_count The count of cells of the external buffer of the megaphone to check.
  * @param bounds_x The x-dimension size of the world.
  * @param bounds_y The y-dimension size of the world.
- * @param bounds_z The z-dimension size of the world.
  * @param ground Pointer to the 2D-array of integer first voxels vertical coordinates on the ground level for each world's cell.
+ * @param heights Pointer to the linear array of the obstacles heights pyramid (NULL if it is not used).
  * @param audibility_2d Pointer to the 2D-array of audibility status on the surface for each world's cell.
  * @param uibs Pointer to the 2D-array of building identifiers (if their exists) for each world's cell.
  * @param voxel_index Pointer to the array of voxel indexes if audibility_voxels array for each world's cell.
@@ -184,8 +1558,41 @@ signed char check_audibility(signed long x_dst, signed long y_dst, signed long z
  * @param height_standalone_megaphone The height of the standalone megaphone.
  * @param building_ground_mode Mode to determine the ground point of buildings.
  * @param size_step The step size for checking audibility of voxels.
+ * @param traversal_mode Mode to walk along the segments: 0 - fixed steps, 1 - exact traversal of crossed cells.
+ * @param squares_mode Mode to calculate audibility of the earth's surface squares:
+ *       0 - trace separate segment to each square
+ *       1 - find visibility of all squares around the megaphone cell in one radial sweep
+ * @param voxels_mode Mode to calculate audibility of the buildings voxels:
+ *       0 - trace separate segment to each floor
+ *       1 - find the lowest visible floor of the whole building column in one walk
+ * @param merge_mode Mode to store results into the shared memory:
+ *       0 - read and write shared memory at each check
+ *       1 - accumulate results in private buffers and merge them into the shared memory at the end of the task
+ * @param packet_mode SIMD instructions to walk packets of segments with fixed steps (used with the obstacles heights pyramid):
+ *       0 - walk each segment separately, 1 - AVX2, 2 - AVX-512 (or the best instructions of the CPU, if they are not supported)
  * @param flag_calculate_audibility Flag to calculate audibility (1) or use only distance without any checking (0).
- * @param possible_distance_int The distance of possible audibility in the buildings.
+ * @param possible_distance_int The distance of possible audibility in the buildings, horizontal voxel's edges.
+ * @param possible_distance_ext The distance of possible audibility on the streets, horizontal voxel's edges.
+ * @param scale_z The ratio of the vertical (one floor) and the horizontal voxel's edges: differences of z-coordinates 
+ *        are multiplied by it to get distances. Segments are walked in voxel's coordinates, their obstacles do not depend on it.
+ * Directional megaphone (one or several horn loudspeakers on the same source position):
+ * @param count_horns The count of horns of the megaphone.
+ * @param horns_azimuth Pointer to the array of azimuths of the axes of the beams, degrees clockwise from the north.
+ * @param horns_width Pointer to the array of widths of the beams, degrees: 0 or 360 for the omnidirectional horn.
+ * @param horns_rear Pointer to the array of sound declines outside the beams, dBA (negative values).
+ * Continuous field of sound levels (used instead of audibility codes if levels_2d and levels_voxels are not NULL):
+ * @param levels_2d Pointer to the 2D-array of codes of the maximum sound levels on the surface for each world's cell.
+ * @param levels_voxels Pointer to the linear serial array of codes of the maximum sound levels of voxels.
+ * @param level_megaphone The sound power of the megaphone, dBA.
+ * @param size_voxel The horizontal voxel's edge size, meters.
+ * Isolated task (used to store results of each megaphone separately):
+ * @param task_2d Pointer to the buffer for results of the task for each square of the external buffer 
+ *        (signed char audibility codes or unsigned short codes of the sound levels), NULL if the task is not isolated.
+ * @param task_voxels Pointer to the buffer for results of the task for each floor of living buildings of the internal buffer.
+ *        The isolated task uses these buffers as private buffers and never reads or writes the shared memory of results.
+ * Instrumented mode:
+ * @param stats_megaphones Pointer to the array of statistics of each megaphone in shared memory, NULL if they are not collected:
+ *        get_audibility_stats_size() unsigned long long values for each megaphone. Counters of the task are added to them at its end.
  * Returned result values:
  * @param count_checked_squares Pointer to the counter of checked squares.
  * @param count_audibility_squares Pointer to the counter of audible squares (based on the checking results).
@@ -196,17 +1603,117 @@ signed char check_audibility(signed long x_dst, signed long y_dst, signed long z
  */
 void calculate_audibility_of_megaphone(unsigned long uim, unsigned short cells_size, 
     signed long *cells, signed long *cells_count, signed long *cells_index,
-    signed long *buffers_int, signed long *buffers_int_count, signed long *buffers_int_index,
-    signed long *buffers_ext, signed long *buffers_ext_count, signed long *buffers_ext_index,
-    unsigned int bounds_x, unsigned int bounds_y, unsigned int bounds_z, signed short *ground,
-    signed char *audibility_2d, signed long *uibs, unsigned long *voxel_index, 
+    signed long *zones_int, signed long *zones_int_count, signed long *zones_int_index, unsigned char *mask_int,
+    signed long *zones_ext, signed long *zones_ext_count, signed long *zones_ext_index, unsigned char *mask_ext,
+    signed long buffer_int_first, signed long buffer_int_count, 
+    signed long buffer_ext_first, signed long buffer_ext_count,
+    unsigned int bounds_x, unsigned int bounds_y, signed short *ground,
+    signed short *heights, signed char *audibility_2d, signed long *uibs, unsigned long *voxel_index, 
     signed char *audibility_voxels, unsigned int building_size, unsigned short *buildings, 
     unsigned long long *made_checks, signed int height_standalone_megaphone,
-    unsigned char building_ground_mode, float size_step,
-    unsigned char flag_calculate_audibility, float possible_distance_int,
+    unsigned char building_ground_mode, float size_step, unsigned char traversal_mode,
+    unsigned char squares_mode, unsigned char voxels_mode, unsigned char merge_mode, unsigned char packet_mode,
+    unsigned char flag_calculate_audibility, float possible_distance_int, float possible_distance_ext,
+    float scale_z, unsigned int count_horns, float *horns_azimuth, float *horns_width, float *horns_rear,
+    unsigned short *levels_2d, unsigned short *levels_voxels, float level_megaphone, float size_voxel,
+    void *task_2d, void *task_voxels, unsigned long long *stats_megaphones,
     unsigned long long *count_checked_squares, unsigned long long *count_audibility_squares,
     unsigned long long *count_checked_voxels, unsigned long long *count_audibility_voxels) {
+
+    // Enumerate cells of the part of buffer zones of the task
+    unsigned long *buffers_int = malloc((buffer_int_count + 1) * sizeof(unsigned long));
+    unsigned long *buffers_ext = malloc((buffer_ext_count + 1) * sizeof(unsigned long));
+    if ((buffers_int == NULL) || (buffers_ext == NULL)) {
+        free(buffers_int);
+        free(buffers_ext);
+        return;
+    }
+    buffer_int_count = enumerate_zone(zones_int, zones_int_count[uim], zones_int_index[uim], mask_int, bounds_y,
+        buffer_int_first, buffer_int_count, buffers_int);
+    buffer_ext_count = enumerate_zone(zones_ext, zones_ext_count[uim], zones_ext_index[uim], mask_ext, bounds_y,
+        buffer_ext_first, buffer_ext_count, buffers_ext);
+
+    // Megaphone is directional, if beams of all its horns are narrower than the full circle
+    unsigned char directional = (count_horns > 0);
+    for (unsigned int h = 0; h < count_horns; h++) {
+        if ((horns_width[h] <= 0) || (horns_width[h] >= 360)) {
+            directional = 0;
+        }
+    }
+
+    // Start counters of the instrumented mode
+    audibility_stats counters = {0};
+    audibility_stats *stats = NULL;
+    struct timespec time_start;
+    if (stats_megaphones != NULL) {
+        stats = &counters;
+        clock_gettime(CLOCK_MONOTONIC, &time_start);
+    }
     
+    // Prepare the obstacles heights pyramid to skip cells lower than the segment and empty blocks with exact traversal
+    height_pyramid pyramid;
+    height_pyramid *pyramid_ptr = NULL;
+    if (heights != NULL) {
+        init_height_pyramid(&pyramid, heights, bounds_x, bounds_y);
+        pyramid_ptr = &pyramid;
+    }
+
+    // Walk segments with fixed steps in packets by SIMD instructions: only for audibility codes without statistics.
+    // Gathers use 32-bit indexes of cells
+    unsigned char packets = (packet_mode < packet_support ? packet_mode : packet_support);
+    if ((traversal_mode != 0) || (heights == NULL) || (stats != NULL) || (levels_voxels != NULL) ||
+        ((unsigned long)bounds_x * bounds_y >= 0x7FFFFFFF)) {
+        packets = 0;
+    }
+    ray_packet packet_squares = {0};
+    ray_packet packet_voxels = {0};
+
+    // Allocate private buffers: one value for each square of the external buffer 
+    // and one value for each floor of living buildings of the internal buffer
+    signed char *private_2d = NULL;
+    signed char *private_voxels = NULL;
+    unsigned short *private_levels_2d = NULL;
+    unsigned short *private_levels_voxels = NULL;
+    unsigned char isolated = (task_2d != NULL) && (task_voxels != NULL);
+    if (isolated) {
+        if (levels_voxels != NULL) {
+            private_levels_2d = task_2d;
+            private_levels_voxels = task_voxels;
+        } else {
+            private_2d = task_2d;
+            private_voxels = task_voxels;
+        }
+    } else if (merge_mode == 1) {
+        unsigned long size_voxels = 0;
+        signed long idx_buffer_int = 0;
+        for (signed long j = 0; j < buffer_int_count; j++) {
+            signed long uib_test = uibs[buffers_int[idx_buffer_int]];
+            if ((uib_test >= 0) && (buildings[uib_test * building_size + 2] > 0)) {
+                size_voxels += buildings[uib_test * building_size];
+            }
+            idx_buffer_int++;
+        }
+        if (levels_voxels != NULL) {
+            private_levels_2d = calloc(buffer_ext_count + 1, sizeof(unsigned short));
+            private_levels_voxels = calloc(size_voxels + 1, sizeof(unsigned short));
+        } else {
+            private_2d = calloc(buffer_ext_count + 1, sizeof(signed char));
+            private_voxels = calloc(size_voxels + 1, sizeof(signed char));
+        }
+        if (((private_2d == NULL) || (private_voxels == NULL)) && 
+            ((private_levels_2d == NULL) || (private_levels_voxels == NULL))) {
+            // Not enough memory: work directly with the shared memory
+            free(private_2d);
+            free(private_voxels);
+            free(private_levels_2d);
+            free(private_levels_voxels);
+            private_2d = NULL;
+            private_voxels = NULL;
+            private_levels_2d = NULL;
+            private_levels_voxels = NULL;
+        }
+    }
+
     // Loop through megaphones cells
     signed long idx_cell = cells_index[uim];
     for (signed long i = 0; i < cells_count[uim]; i++) {
@@ -228,17 +1735,27 @@ void calculate_audibility_of_megaphone(unsigned long uim, unsigned short cells_s
         }
 
         // Loop through internal and external buffers
-        signed long idx_buffer_int = buffers_int_index[uim];
-        for (signed long  j = 0; j < buffers_int_count[uim]; j++) {
+        signed long idx_buffer_int = 0;
+        unsigned long idx_private_voxels = 0;
+        for (signed long  j = 0; j < buffer_int_count; j++) {
 
             // Coordinates of test cell
-            signed long  x_buffer = buffers_int[idx_buffer_int];
-            signed long  y_buffer = buffers_int[idx_buffer_int + 1];
+            signed long  x_buffer = buffers_int[idx_buffer_int] / bounds_y;
+            signed long  y_buffer = buffers_int[idx_buffer_int] % bounds_y;
 
             // UIB building on test cell (if exists)
             signed long  uib_test = uibs[x_buffer * bounds_y + y_buffer];
             signed long  z_start = ground[x_buffer * bounds_y + y_buffer];
 
+            // Restrict the test cell to the beams and the rear lobes of the directional megaphone
+            double distance_int = possible_distance_int;
+            double level_source = level_megaphone;
+            unsigned char reachable = 1;
+            if (directional) {
+                reachable = apply_beam(x_buffer - x_cell, y_buffer - y_cell, count_horns, horns_azimuth,
+                    horns_width, horns_rear, possible_distance_ext, &distance_int, &level_source);
+            }
+
             // There is any building on tested square
             if (uib_test >= 0) {
 
@@ -250,56 +1767,304 @@ void calculate_audibility_of_megaphone(unsigned long uim, unsigned short cells_s
                     z_start = get_first_building_voxel(x_buffer, y_buffer, uib_test, bounds_y, ground, 
                         building_size, buildings, building_ground_mode);
                     unsigned short floors = buildings[uib_test * building_size];
+                    signed char *audibility_column = &audibility_voxels[voxel_index[x_buffer * bounds_y + y_buffer]];
+                    signed char *private_column = NULL;
+                    if (private_voxels != NULL) {
+                        private_column = &private_voxels[idx_private_voxels];
+                        if (isolated) {
+                            audibility_column = private_column; // Never read results of other tasks
+                        }
+                    }
+                    unsigned short *levels_column = NULL;
+                    unsigned short *private_levels_column = NULL;
+                    if (levels_voxels != NULL) {
+                        levels_column = &levels_voxels[voxel_index[x_buffer * bounds_y + y_buffer]];
+                        if (private_levels_voxels != NULL) {
+                            private_levels_column = &private_levels_voxels[idx_private_voxels];
+                            if (isolated) {
+                                levels_column = private_levels_column; // Never read results of other tasks
+                            }
+                        }
+                    }
+                    idx_private_voxels += floors;
+                    if (!reachable) {
+                        floors = 0; // The building is out of reach of the directional megaphone
+                    }
+
+                    // Find the lowest visible floor in one walk for all floors, which results depend on the traversal
+                    signed long floor_visible = floors;
+                    if ((voxels_mode == 1) && (flag_calculate_audibility > 0) && 
+                        ((uib_megaphone < 0) || (uib_test != uib_megaphone))) {
+                        signed long floor_first = -1, floor_last = -1;
+                        for (signed long floor = 0; floor < floors; floor++) {
+                            double dx = x_buffer - x_cell;
+                            double dy = y_buffer - y_cell;
+                            double dz = (z_start + floor - z_cell) * scale_z;
+                            double distance = sqrt(dx * dx + dy * dy + dz * dz);
+                            unsigned char needed;
+                            if (levels_column != NULL) {
+                                unsigned short level_prev = get_level(&levels_column[floor], 
+                                    (private_levels_column != NULL ? &private_levels_column[floor] : NULL));
+                                needed = (level_prev < get_sound_level(distance, level_source, size_voxel));
+                            } else {
+                                signed char prev = get_audibility(&audibility_column[floor], 
+                                    (private_column != NULL ? &private_column[floor] : NULL));
+                                needed = (prev <= 1) && !((distance > distance_int) && (prev > 0)) && (distance > 0);
+                            }
+                            if (needed) {
+                                if (floor_first < 0) {
+                                    floor_first = floor;
+                                }
+                                floor_last = floor;
+                            }
+                        }
+                        if (floor_first >= 0) {
+                            floor_visible = find_first_visible_floor(x_buffer, y_buffer, z_start, 
+                                floor_first, floor_last, uib_test, x_cell, y_cell, z_cell, uib_megaphone,
+                                bounds_y, ground, uibs, building_size, buildings, building_ground_mode, 
+                                size_step, traversal_mode, pyramid_ptr, stats);
+                        }
+                    }
 
                     // Loop through floors of the building
                     for (unsigned short floor = 0; floor < floors; floor++) {
 
                         // Check audibility of each voxel of the building
                         (*count_checked_voxels)++;
-                        signed char flag = audibility_voxels[voxel_index[x_buffer * bounds_y + y_buffer] + floor];
-                        flag = check_audibility(x_buffer, y_buffer, z_start + floor, uib_test, 
-                            x_cell, y_cell, z_cell, uib_megaphone,
-                            bounds_y, ground, uibs, 
-                            building_size, buildings, 
-                            building_ground_mode, size_step, 
-                            flag_calculate_audibility, possible_distance_int, flag);
-                        audibility_voxels[voxel_index[x_buffer * bounds_y + y_buffer] + floor] = flag;
+                        signed char known = -1;
+                        if (voxels_mode == 1) {
+                            known = (floor >= floor_visible ? 1 : 0);
+                        }
+
+                        // Find the maximum sound level instead of audibility code
+                        if (levels_column != NULL) {
+                            unsigned short *own_level = (private_levels_column != NULL ? &private_levels_column[floor] : NULL);
+                            unsigned short level = get_level(&levels_column[floor], own_level);
+                            level = check_sound_level(x_buffer, y_buffer, z_start + floor, uib_test, 
+                                x_cell, y_cell, z_cell, uib_megaphone,
+                                bounds_y, ground, uibs, building_size, buildings, 
+                                building_ground_mode, size_step, traversal_mode, pyramid_ptr, 
+                                flag_calculate_audibility, level_source, size_voxel, scale_z, known, level, stats);
+                            set_level(&levels_column[floor], own_level, level);
+                            (*count_audibility_voxels) += (level > 1 ? 1 : 0);
+                            continue;
+                        }
+
+                        signed char *own = (private_column != NULL ? &private_column[floor] : NULL);
+                        signed char flag = get_audibility(&audibility_column[floor], own);
+                        if (packets > 0) {
+                            // The segment is walked later in the packet, if its traversal is needed
+                            unsigned char target = 1;
+                            signed char result = check_audibility_without_traversal(x_buffer, y_buffer, z_start + floor, uib_test,
+                                x_cell, y_cell, z_cell, uib_megaphone, flag_calculate_audibility, distance_int, scale_z, known, flag, &target, stats);
+                            if (result == 0) {
+                                add_to_packet(&packet_voxels, packets, x_buffer, y_buffer, z_start + floor, uib_test,
+                                    x_cell, y_cell, z_cell, uib_megaphone, &audibility_column[floor], own, target, flag,
+                                    bounds_y, uibs, pyramid_ptr, size_step, count_audibility_voxels);
+                                continue;
+                            }
+                            flag = result;
+                        } else {
+                            flag = check_audibility(x_buffer, y_buffer, z_start + floor, uib_test, 
+                                x_cell, y_cell, z_cell, uib_megaphone,
+                                bounds_y, ground, uibs, 
+                                building_size, buildings, 
+                                building_ground_mode, size_step, traversal_mode,
+                                pyramid_ptr, flag_calculate_audibility, distance_int, scale_z, known, flag, stats);
+                        }
+                        set_audibility(&audibility_column[floor], own, flag);
                         (*count_audibility_voxels) += (flag>0 ? 1 : 0);
                     }
                 }
             }
-            idx_buffer_int += cells_size; // Go to next test cell from internal buffer
+            idx_buffer_int++; // Go to next test cell from internal buffer
+        }
+        flush_packet(&packet_voxels, packets, x_cell, y_cell, z_cell, uib_megaphone, 
+            bounds_y, uibs, pyramid_ptr, size_step, count_audibility_voxels);
+
+        // Find visibility of all squares of buffer zone on the streets in one sweep
+        signed char *visible = NULL;
+        signed long radius = 0;
+        if ((squares_mode == 1) && (flag_calculate_audibility > 0)) {
+            signed long idx_buffer_ext = 0;
+            for (signed long j = 0; j < buffer_ext_count; j++) {
+                signed long distance_x = labs((signed long)(buffers_ext[idx_buffer_ext] / bounds_y) - x_cell);
+                signed long distance_y = labs((signed long)(buffers_ext[idx_buffer_ext] % bounds_y) - y_cell);
+                if (distance_x > radius) {
+                    radius = distance_x;
+                }
+                if (distance_y > radius) {
+                    radius = distance_y;
+                }
+                idx_buffer_ext++;
+            }
+            float *offsets = NULL;
+            if (radius > 0) {
+                visible = calloc((2 * radius + 1) * (2 * radius + 1), sizeof(signed char));
+                offsets = malloc((2 * radius + 1) * (2 * radius + 1) * sizeof(float));
+            }
+            if ((visible != NULL) && (offsets != NULL)) {
+                sweep_visibility(x_cell, y_cell, z_cell, uib_megaphone, radius, visible, offsets,
+                    bounds_x, bounds_y, ground, uibs, building_size, buildings, building_ground_mode);
+            } else {
+                free(visible);
+                visible = NULL;
+            }
+            free(offsets);
         }
 
         // Loop through buffer zone on the streets
-        signed long idx_buffer_ext = buffers_ext_index[uim];
-        for (signed long j = 0; j < buffers_ext_count[uim]; j++) {
+        signed long idx_buffer_ext = 0;
+        for (signed long j = 0; j < buffer_ext_count; j++) {
             
             // Coordinates of test cell
-            signed long x_buffer = buffers_ext[idx_buffer_ext];
-            signed long y_buffer = buffers_ext[idx_buffer_ext + 1];
+            signed long x_buffer = buffers_ext[idx_buffer_ext] / bounds_y;
+            signed long y_buffer = buffers_ext[idx_buffer_ext] % bounds_y;
 
             // UIB building on test cell (if exists)
             signed long uib_test = uibs[x_buffer * bounds_y + y_buffer];
             signed long z_start = ground[x_buffer * bounds_y + y_buffer];
 
+            // Restrict the test cell to the beams and the rear lobes of the directional megaphone
+            double distance_int = possible_distance_int;
+            double level_source = level_megaphone;
+            unsigned char reachable = 1;
+            if (directional) {
+                reachable = apply_beam(x_buffer - x_cell, y_buffer - y_cell, count_horns, horns_azimuth,
+                    horns_width, horns_rear, possible_distance_ext, &distance_int, &level_source);
+            }
+            if (!reachable) {
+                idx_buffer_ext++; // Go to next test cell from external buffer
+                continue;
+            }
+
+            // Use visibility of the sweep (only for squares without buildings)
+            signed char known = -1;
+            if ((visible != NULL) && (uib_test < 0)) {
+                signed char v = visible[(x_buffer - x_cell + radius) * (2 * radius + 1) + (y_buffer - y_cell + radius)];
+                if (v != 0) {
+                    known = (v > 0 ? 1 : 0);
+                }
+            }
+
             // Check ground square audibility
             (*count_checked_squares)++;
-            signed char flag = audibility_2d[x_buffer * bounds_y + y_buffer];
-            flag = check_audibility(x_buffer, y_buffer, z_start, uib_test, 
-                x_cell, y_cell, z_cell, uib_megaphone,
-                bounds_y, ground, uibs, 
-                building_size, buildings, 
-                building_ground_mode, size_step, 
-                flag_calculate_audibility, possible_distance_int, flag);
-            audibility_2d[x_buffer * bounds_y + y_buffer] = flag;
+
+            // Find the maximum sound level instead of audibility code
+            if (levels_2d != NULL) {
+                unsigned short *own_level = (private_levels_2d != NULL ? &private_levels_2d[j] : NULL);
+                unsigned short *shared_level = (isolated ? own_level : &levels_2d[x_buffer * bounds_y + y_buffer]);
+                unsigned short level = get_level(shared_level, own_level);
+                level = check_sound_level(x_buffer, y_buffer, z_start, uib_test, 
+                    x_cell, y_cell, z_cell, uib_megaphone,
+                    bounds_y, ground, uibs, building_size, buildings, 
+                    building_ground_mode, size_step, traversal_mode, pyramid_ptr, 
+                    flag_calculate_audibility, level_source, size_voxel, scale_z, known, level, stats);
+                set_level(shared_level, own_level, level);
+                (*count_audibility_squares) += (level > 1 ? 1 : 0);
+                idx_buffer_ext++; // Go to next test cell from external buffer
+                continue;
+            }
+
+            signed char *own = (private_2d != NULL ? &private_2d[j] : NULL);
+            signed char *shared = (isolated ? own : &audibility_2d[x_buffer * bounds_y + y_buffer]);
+            signed char flag = get_audibility(shared, own);
+            if (packets > 0) {
+                // The segment is walked later in the packet, if its traversal is needed
+                unsigned char target = 1;
+                signed char result = check_audibility_without_traversal(x_buffer, y_buffer, z_start, uib_test,
+                    x_cell, y_cell, z_cell, uib_megaphone, flag_calculate_audibility, distance_int, scale_z, known, flag, &target, stats);
+                if (result == 0) {
+                    add_to_packet(&packet_squares, packets, x_buffer, y_buffer, z_start, uib_test,
+                        x_cell, y_cell, z_cell, uib_megaphone, shared, own, target, flag,
+                        bounds_y, uibs, pyramid_ptr, size_step, count_audibility_squares);
+                    idx_buffer_ext++; // Go to next test cell from external buffer
+                    continue;
+                }
+                flag = result;
+            } else {
+                flag = check_audibility(x_buffer, y_buffer, z_start, uib_test, 
+                    x_cell, y_cell, z_cell, uib_megaphone,
+                    bounds_y, ground, uibs, 
+                    building_size, buildings, 
+                    building_ground_mode, size_step, traversal_mode,
+                    pyramid_ptr, flag_calculate_audibility, distance_int, scale_z, known, flag, stats);
+            }
+            set_audibility(shared, own, flag);
             (*count_audibility_squares) += (flag>0 ? 1 : 0);
 
-            idx_buffer_ext += cells_size; // Go to next test cell from external buffer
+            idx_buffer_ext++; // Go to next test cell from external buffer
         }
+        flush_packet(&packet_squares, packets, x_cell, y_cell, z_cell, uib_megaphone, 
+            bounds_y, uibs, pyramid_ptr, size_step, count_audibility_squares);
+        free(visible);
 
         idx_cell += cells_size; // Go to next megaphone cell
-        made_checks[uim] += buffers_int_count[uim] + buffers_ext_count[uim]; // update statistics in shared memory
+        // Update statistics in shared memory: several parts of the megaphone can be calculated at the same time
+        __atomic_fetch_add(&made_checks[uim], buffer_int_count + buffer_ext_count, __ATOMIC_RELAXED);
+    }
+
+    // Merge private buffers into the shared memory
+    if (!isolated && (((private_2d != NULL) && (private_voxels != NULL)) || 
+        ((private_levels_2d != NULL) && (private_levels_voxels != NULL)))) {
+        signed long idx_buffer_int = 0;
+        unsigned long idx_private_voxels = 0;
+        for (signed long j = 0; j < buffer_int_count; j++) {
+            signed long x_buffer = buffers_int[idx_buffer_int] / bounds_y;
+            signed long y_buffer = buffers_int[idx_buffer_int] % bounds_y;
+            signed long uib_test = uibs[x_buffer * bounds_y + y_buffer];
+            if ((uib_test >= 0) && (buildings[uib_test * building_size + 2] > 0)) {
+                unsigned short floors = buildings[uib_test * building_size];
+                unsigned long idx_voxel = voxel_index[x_buffer * bounds_y + y_buffer];
+                for (unsigned short floor = 0; floor < floors; floor++) {
+                    if (private_levels_voxels != NULL) {
+                        if (private_levels_voxels[idx_private_voxels + floor] != 0) {
+                            merge_level_shared(&levels_voxels[idx_voxel + floor], private_levels_voxels[idx_private_voxels + floor]);
+                        }
+                    } else if (private_voxels[idx_private_voxels + floor] != 0) {
+                        merge_audibility_shared(&audibility_voxels[idx_voxel + floor], private_voxels[idx_private_voxels + floor]);
+                    }
+                }
+                idx_private_voxels += floors;
+            }
+            idx_buffer_int++;
+        }
+        signed long idx_buffer_ext = 0;
+        for (signed long j = 0; j < buffer_ext_count; j++) {
+            signed long idx_square = buffers_ext[idx_buffer_ext];
+            if (private_levels_2d != NULL) {
+                if (private_levels_2d[j] != 0) {
+                    merge_level_shared(&levels_2d[idx_square], private_levels_2d[j]);
+                }
+            } else if (private_2d[j] != 0) {
+                merge_audibility_shared(&audibility_2d[idx_square], private_2d[j]);
+            }
+            idx_buffer_ext++;
+        }
+    }
+    if (!isolated) {
+        free(private_2d);
+        free(private_voxels);
+        free(private_levels_2d);
+        free(private_levels_voxels);
+    }
+    free(buffers_int);
+    free(buffers_ext);
+
+    // Add counters of the task to statistics of the megaphone: several parts of the megaphone can be calculated at the same time
+    if (stats != NULL) {
+        struct timespec time_finish;
+        clock_gettime(CLOCK_MONOTONIC, &time_finish);
+        unsigned long long *row = &stats_megaphones[uim * SIZE_STATS];
+        __atomic_fetch_add(&row[0], (time_finish.tv_sec - time_start.tv_sec) * 1000000000LL 
+            + (time_finish.tv_nsec - time_start.tv_nsec), __ATOMIC_RELAXED);
+        __atomic_fetch_add(&row[1], counters.steps, __ATOMIC_RELAXED);
+        for (unsigned int k = 0; k < COUNT_EXITS; k++) {
+            __atomic_fetch_add(&row[2 + k], counters.exits[k], __ATOMIC_RELAXED);
+        }
+        for (unsigned int k = 0; k < COUNT_STEPS_BINS; k++) {
+            __atomic_fetch_add(&row[2 + COUNT_EXITS + k], counters.histogram[k], __ATOMIC_RELAXED);
+        }
     }
 
 }
\ No newline at end of file
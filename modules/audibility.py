@@ -9,11 +9,27 @@
 import multiprocessing as mp # Use multiprocessing
 from multiprocessing.shared_memory import SharedMemory # Use shared memory
 import ctypes # Use primitive datatypes for multiprocessing data exchange
-import time # For updating multiprocessing progress bar
+import threading # Use multithreading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED # Pool of threads
+import numpy as np # Estimate cost of tasks
+import time # Interval between checkpoints
+from pathlib import Path # Crossplatform pathing
 
 # Own core modules
 import modules.settings as cfg # Settings defenition
 import modules.environment as env # Environment defenition
+import modules.vectorized # Vectorized audibility calculation with NumPy
+import modules.cache # Cache of audibility of each megaphone
+import modules.optimizer # Megaphone placement optimizer
+import modules.checkpoint # Checkpoint of audibility calculation
+import modules.profiling # Statistics of audibility calculation
+import modules.coverage # Coverage of squares and voxels by several megaphones
+import modules.coarse # Coarse-to-fine audibility calculation
+import modules.megaphones # Distances and zones of possible audibility of megaphones
+import modules.buildings # Facades of buildings
+
+# Names of SIMD instructions for packets of segments returned by the C library
+PacketInstructions = ('none, each segment is walked separately', 'AVX2', 'AVX-512')
 
 # ============================================
 # Initialize calculation audibility of squares and voxels by the specific megaphone
@@ -21,78 +37,153 @@ import modules.environment as env # Environment defenition
 # and store them in global variables of this module of current proccess
 # ============================================
 def InitializeAudibilityOfMegaphone(pCellsSize, pCells, pCellsCount, pCellsIndex, 
-                                    pBuffersInt, pBuffersIntCount, pBuffersIntIndex,
-                                    pBuffersExt, pBuffersExtCount, pBuffersExtIndex,
-                                    pBoundsX, pBoundsY, pBoundsZ, pGround, pAudibility2D, pUIB, pVoxelIndex,
-                                    pAudibilityVoxels, pBuildingsSize, pBuildings, 
-                                    pMegaphonesCount, pChecksCount,
-                                    pMegaphonesLeft, pMadeChecks):
+                                    pZonesInt, pZonesIntCount, pZonesIntIndex, pMaskInt,
+                                    pZonesExt, pZonesExtCount, pZonesExtIndex, pMaskExt,
+                                    pBoundsX, pBoundsY, pGround, pHeights, pAudibility2D, pUIB, pVoxelIndex,
+                                    pAudibilityVoxels, pBuildingsSize, pBuildings, pLevels2D, pLevelsVoxels,
+                                    pMegaphonesPower, pMegaphonesHeight, pMegaphonesAzimuth, pMegaphonesBeamWidth, pMegaphonesRear,
+                                    pMegaphonesHorns, pMegaphonesHornsCount, pMegaphonesHornsIndex, pMegaphonesCount, pChecksCount,
+                                    pMegaphonesLeft, pMadeChecks, pAudibilityStats, pMergeLock):
     global lib
     global cellsSize, cells, cells_count, cells_index, \
-           buffersInt, buffersInt_count, buffersInt_index, \
-           buffersExt, buffersExt_count, buffersExt_index, \
-           boundsX, boundsY, boundsZ, ground, audibility2D, uibs, VoxelIndex, \
-           audibilityVoxels, buildingsSize, buildings, \
-           megaphonesCount, checksCount, \
-           megaphonesLeft, madeChecks
+           zonesInt, zonesInt_count, zonesInt_index, maskInt, \
+           zonesExt, zonesExt_count, zonesExt_index, maskExt, \
+           boundsX, boundsY, ground, heights, audibility2D, uibs, VoxelIndex, \
+           audibilityVoxels, buildingsSize, buildings, levels2D, levelsVoxels, \
+           megaphonesPower, megaphonesHeight, megaphonesAzimuth, megaphonesBeamWidth, megaphonesRear, \
+           megaphonesHorns, megaphonesHorns_count, megaphonesHorns_index, megaphonesCount, checksCount, \
+           megaphonesLeft, madeChecks, audibilityStats
 
     # Store parameters in global variables
     cellsSize = pCellsSize # integer
     cells = (ctypes.c_long * len(pCells)).from_buffer(pCells)
     cells_count = (ctypes.c_long * len(pCellsCount)).from_buffer(pCellsCount)
     cells_index = (ctypes.c_long * len(pCellsIndex)).from_buffer(pCellsIndex)
-    buffersInt = (ctypes.c_long * len(pBuffersInt)).from_buffer(pBuffersInt)
-    buffersInt_count = (ctypes.c_long * len(pBuffersIntCount)).from_buffer(pBuffersIntCount)
-    buffersInt_index = (ctypes.c_long * len(pBuffersIntIndex)).from_buffer(pBuffersIntIndex)
-    buffersExt = (ctypes.c_long * len(pBuffersExt)).from_buffer(pBuffersExt)
-    buffersExt_count = (ctypes.c_long * len(pBuffersExtCount)).from_buffer(pBuffersExtCount)
-    buffersExt_index = (ctypes.c_long * len(pBuffersExtIndex)).from_buffer(pBuffersExtIndex)
+    zonesInt = (ctypes.c_long * len(pZonesInt)).from_buffer(pZonesInt)
+    zonesInt_count = (ctypes.c_long * len(pZonesIntCount)).from_buffer(pZonesIntCount)
+    zonesInt_index = (ctypes.c_long * len(pZonesIntIndex)).from_buffer(pZonesIntIndex)
+    maskInt = (ctypes.c_ubyte * len(pMaskInt)).from_buffer(pMaskInt) if pMaskInt is not None else None
+    zonesExt = (ctypes.c_long * len(pZonesExt)).from_buffer(pZonesExt)
+    zonesExt_count = (ctypes.c_long * len(pZonesExtCount)).from_buffer(pZonesExtCount)
+    zonesExt_index = (ctypes.c_long * len(pZonesExtIndex)).from_buffer(pZonesExtIndex)
+    maskExt = (ctypes.c_ubyte * len(pMaskExt)).from_buffer(pMaskExt) if pMaskExt is not None else None
     boundsX = pBoundsX # integer
     boundsY = pBoundsY # integer
-    boundsZ = pBoundsZ # integer
     ground = (ctypes.c_short * len(pGround)).from_buffer(pGround)
+    heights = (ctypes.c_short * len(pHeights)).from_buffer(pHeights) if pHeights is not None else None
     audibility2D = (ctypes.c_byte * len(pAudibility2D)).from_buffer(pAudibility2D)
     uibs = (ctypes.c_long * len(pUIB)).from_buffer(pUIB)
     VoxelIndex = (ctypes.c_ulong * len(pVoxelIndex)).from_buffer(pVoxelIndex)
     audibilityVoxels = (ctypes.c_byte * len(pAudibilityVoxels)).from_buffer(pAudibilityVoxels)
     buildingsSize = pBuildingsSize # integer
     buildings = (ctypes.c_ushort * len(pBuildings)).from_buffer(pBuildings)
+    levels2D = (ctypes.c_ushort * len(pLevels2D)).from_buffer(pLevels2D) if pLevels2D is not None else None
+    levelsVoxels = (ctypes.c_ushort * len(pLevelsVoxels)).from_buffer(pLevelsVoxels) if pLevelsVoxels is not None else None
+    megaphonesPower = (ctypes.c_float * len(pMegaphonesPower)).from_buffer(pMegaphonesPower)
+    megaphonesHeight = (ctypes.c_float * len(pMegaphonesHeight)).from_buffer(pMegaphonesHeight)
+    megaphonesAzimuth = (ctypes.c_float * len(pMegaphonesAzimuth)).from_buffer(pMegaphonesAzimuth)
+    megaphonesBeamWidth = (ctypes.c_float * len(pMegaphonesBeamWidth)).from_buffer(pMegaphonesBeamWidth)
+    megaphonesRear = (ctypes.c_float * len(pMegaphonesRear)).from_buffer(pMegaphonesRear)
+    megaphonesHorns = (ctypes.c_long * len(pMegaphonesHorns)).from_buffer(pMegaphonesHorns)
+    megaphonesHorns_count = (ctypes.c_long * len(pMegaphonesHornsCount)).from_buffer(pMegaphonesHornsCount)
+    megaphonesHorns_index = (ctypes.c_long * len(pMegaphonesHornsIndex)).from_buffer(pMegaphonesHornsIndex)
     megaphonesCount = pMegaphonesCount # integer
     checksCount = (ctypes.c_ulonglong * len(pChecksCount)).from_buffer(pChecksCount)
     megaphonesLeft = (ctypes.c_ubyte * len(pMegaphonesLeft)).from_buffer(pMegaphonesLeft)
     madeChecks = (ctypes.c_ulonglong * len(pMadeChecks)).from_buffer(pMadeChecks)
+    audibilityStats = (ctypes.c_ulonglong * len(pAudibilityStats)).from_buffer(pAudibilityStats) if pAudibilityStats is not None else None
+
+    # Import functions from C shared library or prepare vectorized engine
+    if cfg.AudibilityEngine == 'numpy':
+        lib = None
+        modules.vectorized.InitializeEngine(boundsY, ground, audibility2D, uibs, VoxelIndex,
+                                            audibilityVoxels, buildingsSize, buildings, madeChecks, pMergeLock)
+    else:
+        lib = LoadLibrary()
 
-    # Import functions from C shared library
+# ============================================
+# Load C shared library and declare types of its functions
+# ============================================
+def LoadLibrary():
     lib = ctypes.CDLL('./audibility.so')
 
+    # get_height_pyramid_size function
+    lib.get_height_pyramid_size.argtypes = (ctypes.c_uint, ctypes.c_uint)
+    lib.get_height_pyramid_size.restype = ctypes.c_ulong
+
+    # build_height_pyramid function
+    lib.build_height_pyramid.argtypes = (ctypes.POINTER(ctypes.c_short), ctypes.c_uint, ctypes.c_uint,
+        ctypes.POINTER(ctypes.c_short), ctypes.POINTER(ctypes.c_long), ctypes.c_uint, ctypes.POINTER(ctypes.c_ushort),
+        ctypes.c_ubyte)
+    lib.build_height_pyramid.restype = None
+
+    # get_packet_support function
+    lib.get_packet_support.argtypes = ()
+    lib.get_packet_support.restype = ctypes.c_ubyte
+
+    # get_audibility_stats_size function
+    lib.get_audibility_stats_size.argtypes = ()
+    lib.get_audibility_stats_size.restype = ctypes.c_uint
+
     # calculate_audibility_of_megaphone function
     lib.calculate_audibility_of_megaphone.argtypes = (ctypes.c_ulong, ctypes.c_ushort,
         ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long),
-        ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long),
-        ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long),
-        ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_short), 
-        ctypes.POINTER(ctypes.c_byte), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.c_long, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+        ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_short), 
+        ctypes.POINTER(ctypes.c_short), ctypes.POINTER(ctypes.c_byte), ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_ulong),
         ctypes.POINTER(ctypes.c_byte), ctypes.c_uint, ctypes.POINTER(ctypes.c_ushort),
         ctypes.POINTER(ctypes.c_ulonglong), ctypes.c_int,
-        ctypes.c_ubyte, ctypes.c_float,
-        ctypes.c_ubyte, ctypes.c_float,
+        ctypes.c_ubyte, ctypes.c_float, ctypes.c_ubyte,
+        ctypes.c_ubyte, ctypes.c_ubyte, ctypes.c_ubyte, ctypes.c_ubyte, ctypes.c_ubyte, ctypes.c_float, ctypes.c_float,
+        ctypes.c_float, ctypes.c_uint, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float),
+        ctypes.POINTER(ctypes.c_ushort), ctypes.POINTER(ctypes.c_ushort), ctypes.c_float, ctypes.c_float,
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulonglong),
         ctypes.POINTER(ctypes.c_ulonglong), ctypes.POINTER(ctypes.c_ulonglong),
         ctypes.POINTER(ctypes.c_ulonglong), ctypes.POINTER(ctypes.c_ulonglong))
     lib.calculate_audibility_of_megaphone.restype = None
 
+    return lib
+
+# ============================================
+# Find linear indexes of cells of the part of buffer zones of the task in the same order as C shared library enumerates them
+# Returns tuple: cells of the internal buffer and cells of the external buffer
+# ============================================
+def GetTaskCells(uim, intFirst, intCount, extFirst, extCount):
+    cellsInt = modules.megaphones.GetZoneCells(zonesInt, zonesInt_count, zonesInt_index, maskInt, boundsY, uim)
+    cellsExt = modules.megaphones.GetZoneCells(zonesExt, zonesExt_count, zonesExt_index, maskExt, boundsY, uim)
+    return cellsInt[intFirst:intFirst+intCount], cellsExt[extFirst:extFirst+extCount]
+
+# ============================================
+# Find indexes of squares and voxels checked by the task in the same order as private buffers of C shared library:
+# one square for each cell of the external buffer and one voxel for each floor of living buildings of the internal buffer
+# ============================================
+def GetTaskIndexes(uim, intFirst, intCount, extFirst, extCount):
+    index, squares = GetTaskCells(uim, intFirst, intCount, extFirst, extCount)
+    uibsInt = np.frombuffer(uibs, dtype=ctypes.c_long)[index]
+    buildingsInt = np.frombuffer(buildings, dtype=ctypes.c_ushort).reshape(-1, buildingsSize)[np.maximum(uibsInt, 0)]
+    floors = np.where((uibsInt >= 0) & (buildingsInt[:,2] > 0), buildingsInt[:,0], 0).astype(np.int64)
+    first = np.frombuffer(VoxelIndex, dtype=ctypes.c_ulong)[index].astype(np.int64)
+    voxels = np.repeat(first, floors) + np.arange(floors.sum()) - np.repeat(np.cumsum(floors) - floors, floors)
+    return squares, voxels
+
 # ============================================
 # Calculate audibility of squares and voxels by the specific megaphone
+# for the part of its internal and external buffers
+# Returns UIM and results of the isolated task (or None if the task is not isolated)
 # ============================================
-def CalculateAudibilityOfMegaphone(num,uim):
+def CalculateAudibilityOfMegaphone(task):
     # Global variables
     global cellsSize, cells, cells_count, cells_index, \
-           buffersInt, buffersInt_count, buffersInt_index, \
-           buffersExt, buffersExt_count, buffersExt_index, \
-           boundsX, boundsY, boundsZ, ground, \
+           zonesInt, zonesInt_count, zonesInt_index, maskInt, \
+           zonesExt, zonesExt_count, zonesExt_index, maskExt, \
+           boundsX, boundsY, ground, heights, \
            audibility2D, uibs, VoxelIndex, \
-           audibilityVoxels, buildingsSize, buildings, \
-           megaphonesCount, checksCount, \
-           megaphonesLeft, madeChecks
+           audibilityVoxels, buildingsSize, buildings, levels2D, levelsVoxels, \
+           megaphonesPower, megaphonesHeight, megaphonesAzimuth, megaphonesBeamWidth, megaphonesRear, \
+           megaphonesHorns, megaphonesHorns_count, megaphonesHorns_index, megaphonesCount, checksCount, \
+           megaphonesLeft, madeChecks, audibilityStats
     
     # Global counters
     countCheckedSquares = ctypes.c_ulonglong(0)
@@ -101,32 +192,211 @@ def CalculateAudibilityOfMegaphone(num,uim):
     countAudibilityVoxels = ctypes.c_ulonglong(0)
 
     # Prepare calculation
-    env.logger.debug('Start {} (megaphone #{}) of {}: {} checks have been started', 
-                     num+1, uim, megaphonesCount, env.printLong(checksCount[uim]))
+    num, uim, intFirst, intCount, extFirst, extCount, isolated = task
+    env.logger.debug('Start task {} (megaphone #{} of {}): {} internal and {} external cells from {} checks', 
+                     num+1, uim, megaphonesCount, env.printLong(intCount), env.printLong(extCount), 
+                     env.printLong(checksCount[uim]))
+
+    # Sound power, height of standalone megaphone (floors) and max distances of possible audibility (horizontal voxels)
+    power = megaphonesPower[uim]
+    heightStandalone = round(megaphonesHeight[uim] / cfg.sizeFloor)
+    possibleDistanceInt, possibleDistanceExt = modules.megaphones.GetDistancesPossibleAudibility(power)
+    possibleDistanceInt = possibleDistanceInt / cfg.sizeVoxel
+    possibleDistanceExt = possibleDistanceExt / cfg.sizeVoxel
 
-    # Call C shared library function to calculate audibility 
-    # of all cells of this megaphone and its buffer zones
+    # Beams of all horns of the source: azimuth, width and sound decline behind the beam
+    first = megaphonesHorns_index[uim]
+    horns = [(megaphonesAzimuth[horn], megaphonesBeamWidth[horn], megaphonesRear[horn])
+             for horn in megaphonesHorns[first:first+megaphonesHorns_count[uim]]]
+
+    # Prepare buffers for results of the isolated task to store them in the cache or to use them in the optimizer
+    task2D = None
+    taskVoxels = None
+    if isolated and (lib is not None):
+        squares, voxels = GetTaskIndexes(uim, intFirst, intCount, extFirst, extCount)
+        taskType = ctypes.c_ushort if levels2D is not None else ctypes.c_byte
+        task2D = (taskType * (len(squares)+1))()
+        taskVoxels = (taskType * (len(voxels)+1))()
+
+    # Calculate audibility of all cells of this megaphone and the part of its buffer zones
     try:
-        lib.calculate_audibility_of_megaphone(uim, cellsSize,
-            cells, cells_count, cells_index,
-            buffersInt, buffersInt_count, buffersInt_index,
-            buffersExt, buffersExt_count, buffersExt_index,
-            boundsX, boundsY, boundsZ, ground, audibility2D, uibs, VoxelIndex,
-            audibilityVoxels, buildingsSize, buildings, 
-            madeChecks, round(cfg.heightStansaloneMegaphone / cfg.sizeVoxel),
-            0 if cfg.BuildingGroundMode == 'levels' else 1, cfg.sizeStep,            
-            1 if cfg.flagCalculateAudibility else 0, cfg.distancePossibleAudibilityInt/cfg.sizeVoxel,
-            ctypes.byref(countCheckedSquares), ctypes.byref(countAudibilitySquares), 
-            ctypes.byref(countCheckedVoxels), ctypes.byref(countAudibilityVoxels))
+        if lib is None:
+            # Use vectorized engine
+            counters = modules.vectorized.CalculateAudibilityOfTask(uim, cellsSize, cells, cells_count, cells_index,
+                *GetTaskCells(uim, intFirst, intCount, extFirst, extCount),
+                possibleDistanceInt, possibleDistanceExt, horns, heightStandalone)
+            countCheckedSquares.value, countAudibilitySquares.value, \
+                countCheckedVoxels.value, countAudibilityVoxels.value = counters
+        else:
+            # Call C shared library function
+            lib.calculate_audibility_of_megaphone(uim, cellsSize,
+                cells, cells_count, cells_index,
+                zonesInt, zonesInt_count, zonesInt_index, maskInt,
+                zonesExt, zonesExt_count, zonesExt_index, maskExt,
+                intFirst, intCount, extFirst, extCount,
+                boundsX, boundsY, ground, heights, audibility2D, uibs, VoxelIndex,
+                audibilityVoxels, buildingsSize, buildings, 
+                madeChecks, heightStandalone,
+                0 if cfg.BuildingGroundMode == 'levels' else 1, cfg.sizeStep,
+                0 if cfg.TraversalMode == 'step' else 1,
+                0 if cfg.SquaresMode == 'rays' else 1,
+                0 if cfg.VoxelsMode == 'rays' else 1,
+                0 if cfg.AudibilityMergeMode == 'shared' else 1,
+                {'none': 0, 'avx2': 1}.get(cfg.PacketMode, 2),
+                1 if cfg.flagCalculateAudibility else 0, possibleDistanceInt, possibleDistanceExt,
+                cfg.sizeFloor / cfg.sizeVoxel, len(horns), *[(ctypes.c_float * len(horns))(*[horn[k] for horn in horns]) for k in range(3)],
+                levels2D, levelsVoxels, power, cfg.sizeVoxel,
+                task2D, taskVoxels, audibilityStats,
+                ctypes.byref(countCheckedSquares), ctypes.byref(countAudibilitySquares), 
+                ctypes.byref(countCheckedVoxels), ctypes.byref(countAudibilityVoxels))
     except Exception as e:
         env.logger.error(e)
 
     # Finish calculation
-    megaphonesLeft[uim] = 0
-    env.logger.debug("Finish #{}. {} combinations checked. {} ({}) audibility squares, {} ({}) audibility voxels found",
-                       uim+1, env.printLong(madeChecks[uim]),
-                       env.printLong(countAudibilitySquares.value), f'{countAudibilitySquares.value/countCheckedSquares.value:.0%}', 
-                       env.printLong(countAudibilityVoxels.value), f'{countAudibilityVoxels.value/countCheckedVoxels.value:.0%}' )
+    env.logger.debug("Finish task {} (megaphone #{}). {} combinations checked. {} ({}) audibility squares, {} ({}) audibility voxels found",
+                       num+1, uim, env.printLong(madeChecks[uim]),
+                       env.printLong(countAudibilitySquares.value), f'{countAudibilitySquares.value/max(countCheckedSquares.value,1):.0%}', 
+                       env.printLong(countAudibilityVoxels.value), f'{countAudibilityVoxels.value/max(countCheckedVoxels.value,1):.0%}' )
+
+    # Keep only checked squares and voxels
+    contribution = None
+    if task2D is not None:
+        values2D = np.ctypeslib.as_array(task2D)[:len(squares)]
+        valuesVoxels = np.ctypeslib.as_array(taskVoxels)[:len(voxels)]
+        contribution = (squares[values2D != 0], values2D[values2D != 0], 
+                        voxels[valuesVoxels != 0], valuesVoxels[valuesVoxels != 0])
+    return uim, contribution
+
+# ============================================
+# Build hierarchical pyramid of obstacles heights to skip cells and empty blocks of cells lower than segments.
+# Ground levels of all cells must be found before
+# ============================================
+def PrepareHeightPyramid():
+    env.logger.info("Build pyramid of obstacles heights...")
+    lib = LoadLibrary()
+    size = lib.get_height_pyramid_size(env.bounds[0], env.bounds[1])
+    env.heights = mp.RawArray(ctypes.c_short, size)
+    lib.build_height_pyramid(env.heights, env.bounds[0], env.bounds[1], env.ground, env.uib,
+                             env.sizeBuilding, env.buildings, 0 if cfg.BuildingGroundMode == 'levels' else 1)
+    env.logger.success("Pyramid of obstacles heights built: {} elements", env.printLong(size))
+
+# ============================================
+# Classify the continuous field of sound levels into audibility codes by the noise levels of the profile.
+# Returns two NumPy-arrays of codes: for squares and for voxels
+# ============================================
+def ClassifySoundLevels(dBAStreet, dBAHome):
+
+    # Nested function to classify array of levels. Unchecked places keep their previous codes
+    def Classify(levels, codes):
+        result = np.where(levels >= (dBAStreet+cfg.dBALevel)*100, 1, -1).astype(np.int8)
+        result[levels >= (dBAHome+cfg.dBALevel-cfg.dBAWindow)*100] = 2
+        return np.where(levels == 0, codes, result)
+
+    levels2D = np.frombuffer(env.levels2D, dtype=ctypes.c_ushort)
+    levelsVoxels = np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort)
+    return (Classify(levels2D, np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)),
+            Classify(levelsVoxels, np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)))
+
+# ============================================
+# Find audibility codes of squares and voxels for all profiles of noise levels 
+# from the continuous field of sound levels and save it
+# ============================================
+def ApplySoundLevels():
+    env.logger.info("Classify sound levels...")
+    for name, (dBAStreet, dBAHome) in cfg.SoundLevelProfiles.items():
+        codes2D, codesVoxels = ClassifySoundLevels(dBAStreet, dBAHome)
+        env.logger.success("Profile '{}' ({} dBA on the streets, {} dBA in the buildings): {} audibility squares, {} audibility voxels",
+                           name, dBAStreet, dBAHome, 
+                           env.printLong(np.count_nonzero(codes2D > 0)), env.printLong(np.count_nonzero(codesVoxels > 0)))
+    codes2D, codesVoxels = ClassifySoundLevels(cfg.dBAStreet, cfg.dBAHome)
+    np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)[:] = codes2D
+    np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)[:] = codesVoxels
+    np.savez_compressed(Path('.', cfg.folderOUTPUT, 'levels.npz'), 
+                        levels2D=np.frombuffer(env.levels2D, dtype=ctypes.c_ushort), 
+                        levelsVoxels=np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort),
+                        VoxelIndex=np.frombuffer(env.VoxelIndex, dtype=ctypes.c_ulong), bounds=np.array(env.bounds))
+    env.logger.success("Sound levels saved")
+
+# ============================================
+# Get count of CPU cores to calculate audibility
+# ============================================
+def GetCoresCount():
+    return cfg.AudibilityCores if cfg.AudibilityCores > 0 else mp.cpu_count()
+
+# ============================================
+# Estimate cost of audibility calculation for each cell of the megaphone's buffer:
+# sum of lengths of segments (in voxels) from all cells of the megaphone 
+# to this cell, multiplied by the count of segments in this cell
+# ============================================
+def EstimateBufferCosts(uim, name, flagInt):
+    buffer = modules.megaphones.GetBufferCells(name, uim)
+    count = len(buffer)
+    if count == 0:
+        return np.zeros(0)
+    x, y = np.divmod(buffer, env.bounds[1])
+    cells = np.frombuffer(env.MegaphonesCells, dtype=ctypes.c_long, count=env.MegaphonesCells_count[uim]*env.sizeCell,
+                          offset=env.MegaphonesCells_index[uim]*ctypes.sizeof(ctypes.c_long))
+    cells = cells.reshape(-1, env.sizeCell)
+
+    # Sum of lengths of segments from all megaphone cells
+    lengths = np.zeros(count)
+    for cell in cells:
+        lengths = lengths + np.hypot(x-cell[0], y-cell[1]) + 1
+
+    # Count of segments: floors of living buildings in the buildings, one square at the streets
+    if flagInt:
+        uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)[buffer]
+        buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+        floors = np.where(uibs >= 0, buildings[uibs,0], 0)
+        flats = np.where(uibs >= 0, buildings[uibs,2], 0)
+        rays = np.where(flats > 0, floors if cfg.VoxelsMode == 'rays' else np.minimum(floors, 1), 0)
+        return lengths * rays + 1
+    return lengths
+
+# ============================================
+# Divide megaphones (list of UIMs) into tasks with nearly equal cost of calculation.
+# Large megaphones are divided into several tasks by ranges of cells of their buffers
+# Returns list of tasks: (UIM, first internal cell, internal cells count, first external cell, external cells count)
+# ordered by descending cost
+# ============================================
+def PrepareTasks(megaphones):
+    costsInt = {}
+    costsExt = {}
+    for uim in megaphones:
+        costsInt[uim] = EstimateBufferCosts(uim, 'Int', True)
+        costsExt[uim] = EstimateBufferCosts(uim, 'Ext', False)
+    totalCost = sum(c.sum() for c in costsInt.values()) + sum(c.sum() for c in costsExt.values())
+    maxCost = max(totalCost / (GetCoresCount() * cfg.AudibilityTasksPerCore), 1)
+
+    # Nested function to divide buffer into ranges of cells with cost not greater than maxCost
+    def SplitBuffer(costs):
+        if len(costs) == 0:
+            return []
+        parts = np.floor(np.cumsum(costs) / maxCost).astype(np.int64)
+        bounds = np.flatnonzero(np.diff(parts)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(costs)]))
+        return [(int(first), int(last-first), costs[first:last].sum()) for first, last in zip(starts, ends)]
+
+    tasks = []
+    for uim in megaphones:
+        costInt = costsInt[uim].sum()
+        costExt = costsExt[uim].sum()
+        if costInt + costExt <= maxCost:
+            tasks.append((uim, 0, len(costsInt[uim]), 0, len(costsExt[uim]), costInt + costExt))
+            continue
+        for first, count, cost in SplitBuffer(costsInt[uim]):
+            tasks.append((uim, first, count, 0, 0, cost))
+        if cfg.SquaresMode == 'sweep':
+            # One sweep for all squares of the megaphone
+            tasks.append((uim, 0, 0, 0, len(costsExt[uim]), costExt))
+        else:
+            for first, count, cost in SplitBuffer(costsExt[uim]):
+                tasks.append((uim, 0, 0, first, count, cost))
+
+    # Order by descending cost
+    tasks.sort(key=lambda x: x[5], reverse=True)
+    return [task[:5] for task in tasks]
 
 # ============================================
 # Calculate audibility of all squares and voxels
@@ -144,34 +414,212 @@ def CalculateAudibility():
             leftMegaphones = leftMegaphones + left
         pbar.set_description(str(leftMegaphones)+" processes left")
 
-    env.logger.info("Switching to multiprocessing mode...")
-    env.logger.info("Please note that due the CPU cores, the actual time may be x2 long as expected at first...")
+        # Save checkpoint periodically
+        nonlocal timeCheckpoint
+        if (cfg.intervalCheckpoint > 0) and (time.time() - timeCheckpoint > cfg.intervalCheckpoint):
+            modules.checkpoint.SaveCheckpoint(fingerprint)
+            timeCheckpoint = time.time()
+
+    # Nested function to mark the megaphone as finished, when all of its tasks are finished.
+    # Results of all tasks of the isolated megaphone are stored in the cache, 
+    # kept for the optimizer (for candidate sites) or merged into the shared memory
+    def FinishTask(result):
+        uim, contribution = result
+        if contribution is not None:
+            contributions[uim].append(contribution)
+        tasksLeft[uim] = tasksLeft[uim] - 1
+        if tasksLeft[uim] == 0:
+            env.leftMegaphones[uim] = 0
+            if uim in contributions:
+                contribution = modules.cache.JoinContributions(contributions.pop(uim))
+                if flagCache:
+                    modules.cache.SaveContribution(keys[uim], contribution)
+                FinishContribution(uim, contribution)
+
+    # Nested function to use results of the isolated megaphone
+    def FinishContribution(uim, contribution):
+        if uim in env.sitesCandidates:
+            candidates[uim] = contribution
+        else:
+            MergeContribution(uim, contribution)
+
+    # Nested function to merge results of the isolated megaphone into the shared memory and count its coverage
+    def MergeContribution(uim, contribution):
+        if flagCoverage:
+            modules.coverage.AddContribution(uim, contribution, flagSoundLevels)
+        modules.cache.MergeContribution(contribution, flagSoundLevels)
+
+    # Check modes supported by vectorized engine
+    if cfg.AudibilityEngine == 'numpy':
+        env.logger.info("Vectorized NumPy engine is used to calculate audibility")
+        if cfg.SquaresMode != 'rays':
+            env.logger.warning("SquaresMode = '{}' is not supported by vectorized engine, 'rays' is used", cfg.SquaresMode)
+        if (cfg.VoxelsMode != 'rays') and (cfg.TraversalMode == 'step'):
+            env.logger.warning("VoxelsMode = '{}' is not supported by vectorized engine, 'rays' is used", cfg.VoxelsMode)
+        if cfg.flagSoundLevels:
+            env.logger.warning("flagSoundLevels = True is not supported by vectorized engine, audibility codes are used")
+        if cfg.flagAudibilityCache:
+            env.logger.warning("flagAudibilityCache = True is not supported by vectorized engine, cache is not used")
+        if len(env.sitesCandidates) > 0:
+            env.logger.warning("Optimizer is not supported by vectorized engine, candidate sites are not used")
+        if cfg.flagAudibilityStats:
+            env.logger.warning("flagAudibilityStats = True is not supported by vectorized engine, statistics are not collected")
+        if cfg.flagCoverage:
+            env.logger.warning("flagCoverage = True is not supported by vectorized engine, coverage is not counted")
+
+    # Allocate memory for the continuous field of sound levels
+    flagSoundLevels = cfg.flagSoundLevels and (cfg.AudibilityEngine != 'numpy')
+    if flagSoundLevels:
+        env.levels2D = mp.RawArray(ctypes.c_ushort, env.bounds[0]*env.bounds[1])
+        env.levelsVoxels = mp.RawArray(ctypes.c_ushort, env.countVoxels)
+
+    # Allocate memory for statistics of the C library
+    flagAudibilityStats = cfg.flagAudibilityStats and (cfg.AudibilityEngine != 'numpy')
+    if flagAudibilityStats:
+        env.audibilityStats = mp.RawArray(ctypes.c_ulonglong, env.countMegaphones*LoadLibrary().get_audibility_stats_size())
+
+    # Allocate memory for coverage of squares and voxels by several megaphones
+    flagCoverage = cfg.flagCoverage and (cfg.AudibilityEngine != 'numpy')
+    if flagCoverage:
+        modules.coverage.InitializeCoverage()
+
+    # Calculate the coarse grid of cells at first and use its certain audibility codes
+    if (cfg.sizeCoarseCell > cfg.sizeVoxel) and not env.flagCoarseGrid:
+        if flagSoundLevels or flagCoverage or (len(env.sitesCandidates) > 0):
+            env.logger.warning("sizeCoarseCell is not used with flagSoundLevels, flagCoverage and optimizer")
+        else:
+            modules.coarse.CalculateCoarseGrid(CalculateAudibility)
 
-    # Collect array of processes parameters
-    processes = []
-    for uim in range(env.countMegaphones):
-        processes.append((uim,env.countChecks[uim]))
-    # Order by descending number of checks
-    processes.sort(key=lambda x: x[1], reverse=True)
-    # Prepare parameters for multiprocessing
+    # Prepare pyramid of obstacles heights
+    if cfg.flagHeightPyramid and (cfg.AudibilityEngine != 'numpy'):
+        PrepareHeightPyramid()
+        if (cfg.TraversalMode == 'step') and (cfg.PacketMode != 'none'):
+            env.logger.info("SIMD instructions of the CPU for packets of segments: {}",
+                            PacketInstructions[LoadLibrary().get_packet_support()])
+
+    # Restore results of finished megaphones from the checkpoint
+    fingerprint = None
+    finished = set()
+    if (cfg.intervalCheckpoint > 0) or env.flagResume:
+        fingerprint = modules.checkpoint.GetFingerprint()
+    if env.flagResume:
+        env.logger.info("Resume calculation from the checkpoint...")
+        finished = set(modules.checkpoint.LoadCheckpoint(fingerprint))
+    timeCheckpoint = time.time()
+
+    # Megaphones merged into other sources are not calculated
+    merged = {uim for uim in range(env.countMegaphones) if env.MegaphonesHorns_count[uim] == 0}
+
+    # Find megaphones in the cache
+    flagCache = cfg.flagAudibilityCache and (cfg.AudibilityEngine != 'numpy')
+    keys = {}
+    cached = {}
+    if flagCache:
+        env.logger.info("Search megaphones in the cache...")
+        for uim in env.tqdm(range(env.countMegaphones)):
+            if (uim in finished) or (uim in merged):
+                continue
+            keys[uim] = modules.cache.GetMegaphoneKey(uim)
+            contribution = modules.cache.LoadContribution(keys[uim])
+            if contribution is not None:
+                cached[uim] = contribution
+        env.logger.success("{} from {} megaphones found in the cache", 
+                           env.printLong(len(cached)), env.printLong(env.countMegaphones - len(merged)))
+
+    # Candidate sites are not calculated by vectorized engine
+    skipped = set(cached) | finished | merged
+    if cfg.AudibilityEngine == 'numpy':
+        skipped.update(env.sitesCandidates)
+    for uim in skipped:
+        env.leftMegaphones[uim] = 0
+        env.madeChecks[uim] = env.countChecks[uim]
+
+    # Megaphones to calculate. Results of isolated megaphones are returned by tasks
+    megaphones = [uim for uim in range(env.countMegaphones) if uim not in skipped]
+    contributions = {uim: [] for uim in megaphones if flagCache or flagCoverage or (uim in env.sitesCandidates)}
+    candidates = {}
+
+    # Merge results of megaphones from the cache
+    if len(cached) > 0:
+        env.logger.info("Merge results of megaphones from the cache...")
+        for uim, contribution in env.tqdm(cached.items()):
+            FinishContribution(uim, contribution)
+        env.logger.success("Results of {} megaphones merged", env.printLong(len(cached)))
+
+    # Divide megaphones into tasks
+    env.logger.info("Estimate cost of calculation and divide megaphones into tasks...")
+    tasks = PrepareTasks(megaphones)
+    tasksLeft = [0] * env.countMegaphones
     params = []
-    for index, (uim, _) in enumerate(processes):
-        params.append((index,uim,))
-
-    # Schedule processes
-    with mp.Pool(processes=mp.cpu_count(), initializer=InitializeAudibilityOfMegaphone, 
-                 initargs=(env.sizeCell, env.MegaphonesCells, env.MegaphonesCells_count, env.MegaphonesCells_index,
-                           env.MegaphonesBuffersInt, env.MegaphonesBuffersInt_count, env.MegaphonesBuffersInt_index,
-                           env.MegaphonesBuffersExt, env.MegaphonesBuffersExt_count, env.MegaphonesBuffersExt_index,
-                           env.bounds[0], env.bounds[1], env.bounds[2], env.ground, env.audibility2D, env.uib, env.VoxelIndex,
-                           env.audibilityVoxels, env.sizeBuilding, env.buildings, 
-                           env.countMegaphones, env.countChecks,
-                           env.leftMegaphones, env.madeChecks)) as pool:
-        result = pool.starmap_async(CalculateAudibilityOfMegaphone, params)
-
-        # Show progress bar
-        with env.tqdm(total=env.totalChecks) as pbar:
-            while not result.ready():
-                UpdateProgress()
-                time.sleep(0.1)
-            UpdateProgress()
\ No newline at end of file
+    for index, task in enumerate(tasks):
+        tasksLeft[task[0]] = tasksLeft[task[0]] + 1
+        params.append((index,) + task + (task[0] in contributions,))
+    env.logger.success("{} megaphones divided into {} tasks", env.printLong(len(megaphones)), env.printLong(len(params)))
+
+    # Parameters of calculation in shared memory
+    initArgs = (env.sizeCell, env.MegaphonesCells, env.MegaphonesCells_count, env.MegaphonesCells_index,
+                env.MegaphonesZonesInt, env.MegaphonesZonesInt_count, env.MegaphonesZonesInt_index, env.maskBuffersInt,
+                env.MegaphonesZonesExt, env.MegaphonesZonesExt_count, env.MegaphonesZonesExt_index, env.maskBuffersExt,
+                env.bounds[0], env.bounds[1], env.ground, env.heights, env.audibility2D, env.uib, env.VoxelIndex,
+                env.audibilityVoxels, env.sizeBuilding, env.buildings, env.levels2D, env.levelsVoxels,
+                env.MegaphonesPower, env.MegaphonesHeight, env.MegaphonesAzimuth, env.MegaphonesBeamWidth, env.MegaphonesRear,
+                env.MegaphonesHorns, env.MegaphonesHorns_count, env.MegaphonesHorns_index, env.countMegaphones, env.countChecks,
+                env.leftMegaphones, env.madeChecks, env.audibilityStats)
+
+    with env.tqdm(total=env.totalChecks) as pbar:
+        if cfg.AudibilityBackend == 'threads':
+
+            # Schedule threads: C library releases GIL, so all threads work with the same buffers of this process
+            env.logger.info("Switching to multithreading mode...")
+            InitializeAudibilityOfMegaphone(*initArgs, threading.Lock())
+            with ThreadPoolExecutor(max_workers=GetCoresCount()) as executor:
+                pending = {executor.submit(CalculateAudibilityOfMegaphone, task) for task in params}
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        FinishTask(future.result())
+                    UpdateProgress()
+
+        else:
+
+            # Schedule processes
+            env.logger.info("Switching to multiprocessing mode...")
+            env.logger.info("Please note that due the CPU cores, the actual time may be x2 long as expected at first...")
+            with mp.Pool(processes=GetCoresCount(), initializer=InitializeAudibilityOfMegaphone, 
+                         initargs=initArgs + (mp.Lock(),)) as pool:
+                result = pool.imap_unordered(CalculateAudibilityOfMegaphone, params)
+                tasksFinished = 0
+                while tasksFinished < len(params):
+                    try:
+                        taskResult = result.next(timeout=0.1)
+                    except mp.TimeoutError:
+                        UpdateProgress()
+                        continue
+                    tasksFinished = tasksFinished + 1
+                    FinishTask(taskResult)
+                    UpdateProgress()
+
+    # Select the best candidate sites and merge their results
+    if len(candidates) > 0:
+        for uim in modules.optimizer.OptimizeMegaphones(candidates, flagSoundLevels):
+            MergeContribution(uim, candidates[uim])
+
+    # Save coverage of squares and voxels
+    if flagCoverage:
+        modules.coverage.SaveCoverage()
+
+    # Save statistics of the C library
+    if flagAudibilityStats:
+        modules.profiling.SaveAudibilityStats()
+
+    # Interior cells of living buildings inherit results of facades
+    if (cfg.FacadeMode == 'inherit') and not env.flagCoarseGrid:
+        modules.buildings.InheritFacades(flagSoundLevels)
+
+    # Find audibility codes from the continuous field of sound levels
+    if flagSoundLevels:
+        ApplySoundLevels()
+
+    # Calculation is finished, checkpoint is not needed
+    if cfg.intervalCheckpoint > 0:
+        modules.checkpoint.DeleteCheckpoint()
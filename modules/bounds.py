@@ -115,9 +115,9 @@ def ReadWorldBounds():
     env.boundsMax[2] = env.boundsMax[2] + (float(env.maxFloors)*cfg.sizeFloor)
     env.logger.success("Bounds of our world:  {} - {}", env.boundsMin, env.boundsMax)
 
-    # Calculate bounds of voxel's world
+    # Calculate bounds of voxel's world: horizontal cells of sizeVoxel and vertical voxels of one floor
     for i in [0,1,2]:
-        env.bounds[i] = int(np.ceil((env.boundsMax[i]  - env.boundsMin[i]) / cfg.sizeVoxel).item())
+        env.bounds[i] = int(np.ceil((env.boundsMax[i]  - env.boundsMin[i]) / (cfg.sizeVoxel if i < 2 else cfg.sizeFloor)).item())
     
     env.logger.success("Bounds of voxel's world:  {}", env.bounds)
 
@@ -20,6 +20,7 @@ import gc # For garbage collectors
 import modules.settings as cfg # Settings defenition
 import modules.environment as env # Environment defenition
 import modules.earth # The earth's surface routines
+import modules.coarse # Voxels of living buildings
 
 
 # ============================================
@@ -110,6 +111,41 @@ def GenerateBuildings():
     env.logger.success("{} voxels of buildings allocated (including {} living voxels)",
                        env.printLong(env.countVoxels), env.printLong(env.countLivingVoxels) )
 
+# ============================================
+# Find facades of buildings: cells of the building, which touch a cell without buildings
+# (or the border of the world) by the side. Other cells of buildings are interior cells without windows
+# OUT:
+# NumPy 1D-array of bool for each cell of the world
+# ============================================
+def GetFacadeCells():
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long).reshape(env.bounds[0], env.bounds[1])
+    streets = np.pad(uibs < 0, 1, constant_values=True)
+    touch = streets[:-2,1:-1] | streets[2:,1:-1] | streets[1:-1,:-2] | streets[1:-1,2:]
+    return ((uibs >= 0) & touch).ravel()
+
+# ============================================
+# Interior cells of living buildings inherit results of facades: each floor of the interior column gets
+# the best audibility code (or sound level) of the same floor of facades of its building
+# IN:
+# flagSoundLevels - use the continuous field of sound levels instead of audibility codes
+# ============================================
+def InheritFacades(flagSoundLevels):
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    cells, floors, voxels = modules.coarse.GetLivingVoxels(np.flatnonzero(uibs >= 0))
+    floor = voxels - np.repeat(np.frombuffer(env.VoxelIndex, dtype=ctypes.c_ulong)[cells].astype(np.int64), floors)
+    facades = np.repeat(GetFacadeCells()[cells], floors)
+    keys = np.repeat(uibs[cells], floors) * (int(floors.max(initial=0)) + 1) + floor
+    if flagSoundLevels:
+        values = np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort)
+    else:
+        values = np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)
+    unique, keys = np.unique(keys, return_inverse=True)
+    best = np.full(len(unique), np.iinfo(values.dtype).min, dtype=values.dtype)
+    np.maximum.at(best, keys[facades], values[voxels[facades]])
+    interior = ~facades & (best[keys] != 0)
+    values[voxels[interior]] = best[keys[interior]]
+    env.logger.success("{} voxels of interior cells inherited results of facades", env.printLong(np.count_nonzero(interior)))
+
 # ============================================
 # Generate necessary voxel VTK objects from vtkPoints 
 # with the specified color and opacity to buildings vizualization
@@ -127,7 +163,7 @@ def VizualizePartOfVoxels(points, color, opacity):
     env.pldtVoxels.append(polyDataVoxels)
     cubeVoxel = vtk.vtkCubeSource()
     cubeVoxel.SetXLength(cfg.sizeVoxel-cfg.gapVoxel)
-    cubeVoxel.SetYLength(cfg.sizeVoxel-cfg.gapVoxel)
+    cubeVoxel.SetYLength(cfg.sizeFloor-cfg.gapVoxel)
     cubeVoxel.SetZLength(cfg.sizeVoxel-cfg.gapVoxel)
     env.cbVoxels.append(cubeVoxel)
     glyphVoxels = vtk.vtkGlyph3D()
@@ -176,18 +212,18 @@ def VizualizeAllVoxels():
                 for floor in range(floors):
                     audibility = env.audibilityVoxels[idxZ+floor]
                     if audibility>0:
-                        env.pntsVoxels_yes.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                        env.pntsVoxels_yes.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
                         totalFlats = totalFlats + flats/voxels
                         audibilityFlats = audibilityFlats + flats/voxels
                     elif audibility<0:
-                        env.pntsVoxels_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                        env.pntsVoxels_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
                         totalFlats = totalFlats + flats/voxels
                     else:
                         if flats>0:
-                            env.pntsVoxels_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel) # not env.pntsVoxels_living
+                            env.pntsVoxels_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel) # not env.pntsVoxels_living
                             totalFlats = totalFlats + flats/voxels
                         else:
-                            env.pntsVoxels_industrial.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                            env.pntsVoxels_industrial.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.5+floor)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
             idx2D = idx2D + 1
 
     VizualizePartOfVoxels(env.pntsVoxels_yes, env.Colors.GetColor3d("Green"), 1)
@@ -0,0 +1,115 @@
+# ============================================
+# Module: Cache of audibility of each megaphone
+# Results of each megaphone are stored separately, so only new or moved megaphones
+# are calculated again and results of others are merged from the cache
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import hashlib # Keys of megaphones in the cache
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Store and merge arrays of results
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.vectorized # Merge audibility values
+import modules.megaphones # Cells of zones of possible audibility of megaphones
+
+
+# ============================================
+# Get NumPy-array of linear indexes of cells of the megaphone from linear arrays of (x,y) cells
+# ============================================
+def GetCells(cells, cellsCount, cellsIndex, uim):
+    count = cellsCount[uim]
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    array = np.frombuffer(cells, dtype=ctypes.c_long, count=count*env.sizeCell,
+                          offset=cellsIndex[uim]*ctypes.sizeof(ctypes.c_long)).reshape(count, env.sizeCell)
+    return array[:,0].astype(np.int64)*env.bounds[1] + array[:,1]
+
+# ============================================
+# Get settings, which change results of audibility calculation: 
+# thresholds of sound levels change distances of possible audibility of each megaphone
+# ============================================
+def GetSettings():
+    return (cfg.sizeVoxel, cfg.sizeFloor, cfg.heightStansaloneMegaphone, cfg.BuildingGroundMode, cfg.sizeStep,
+            cfg.TraversalMode, cfg.SquaresMode, cfg.VoxelsMode, cfg.flagCalculateAudibility,
+            cfg.distancePossibleAudibilityInt, cfg.distancePossibleAudibilityExt, 
+            cfg.dBAStreet, cfg.dBAStreetMin, cfg.dBAHome, cfg.dBAHomeMin, cfg.dBAWindow, cfg.dBALevel,
+            cfg.flagSoundLevels, cfg.dBAMegaphone, env.bounds[1])
+
+# ============================================
+# Calculate key of the megaphone in the cache: hash of all input data of its calculation -
+# settings, sound power and height of the megaphone, beams of its horns, cells of the megaphone and its buffer zones, 
+# ground levels and buildings in these cells.
+# All segments of the megaphone lie in its zones of possible audibility, so other megaphones do not change the key
+# ============================================
+def GetMegaphoneKey(uim):
+    key = hashlib.sha1()
+    key.update(repr(GetSettings()).encode())
+    ground = np.frombuffer(env.ground, dtype=ctypes.c_short)
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    voxelIndex = np.frombuffer(env.VoxelIndex, dtype=ctypes.c_ulong)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    # Cells are hashed as couples (x,y) in any layout of arrays of cells
+    for index in (GetCells(env.MegaphonesCells, env.MegaphonesCells_count, env.MegaphonesCells_index, uim),
+            modules.megaphones.GetBufferCells('Int', uim), modules.megaphones.GetBufferCells('Ext', uim)):
+        key.update(np.column_stack(np.divmod(index, env.bounds[1])).astype(ctypes.c_long).tobytes())
+        key.update(ground[index].tobytes())
+        key.update(uibs[index].tobytes())
+        key.update(voxelIndex[index].tobytes())
+        key.update(buildings[uibs[index][uibs[index] >= 0], :3].tobytes())
+    values = [env.MegaphonesPower[uim], env.MegaphonesHeight[uim]]
+    first = env.MegaphonesHorns_index[uim]
+    for horn in env.MegaphonesHorns[first:first+env.MegaphonesHorns_count[uim]]:
+        values.extend((env.MegaphonesAzimuth[horn], env.MegaphonesBeamWidth[horn], env.MegaphonesRear[horn]))
+    key.update(repr(tuple(values)).encode())
+    return key.hexdigest()
+
+# ============================================
+# Load results of the megaphone from the cache
+# Returns tuple: indexes of squares, its values, indexes of voxels, its values.
+# Or None if the megaphone is not found in the cache
+# ============================================
+def LoadContribution(key):
+    fileC = Path('.', cfg.folderCACHE, key+'.npz')
+    if not fileC.exists():
+        return None
+    with np.load(fileC) as data:
+        return (data['squares'], data['values2D'], data['voxels'], data['valuesVoxels'])
+
+# ============================================
+# Join results of all tasks of the megaphone
+# ============================================
+def JoinContributions(contributions):
+    return tuple(np.concatenate(parts) for parts in zip(*contributions))
+
+# ============================================
+# Store results of the megaphone into the cache
+# ============================================
+def SaveContribution(key, contribution):
+    squares, values2D, voxels, valuesVoxels = contribution
+    Path('.', cfg.folderCACHE).mkdir(exist_ok=True)
+    np.savez_compressed(Path('.', cfg.folderCACHE, key+'.npz'),
+                        squares=squares, values2D=values2D, voxels=voxels, valuesVoxels=valuesVoxels)
+
+# ============================================
+# Merge results of the megaphone into the shared memory:
+# the maximum sound levels or the best audibility codes are kept
+# ============================================
+def MergeContribution(contribution, flagSoundLevels):
+    squares, values2D, voxels, valuesVoxels = contribution
+    if flagSoundLevels:
+        levels2D = np.frombuffer(env.levels2D, dtype=ctypes.c_ushort)
+        levelsVoxels = np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort)
+        levels2D[squares] = np.maximum(levels2D[squares], values2D)
+        levelsVoxels[voxels] = np.maximum(levelsVoxels[voxels], valuesVoxels)
+    else:
+        audibility2D = np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)
+        audibilityVoxels = np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)
+        audibility2D[squares] = modules.vectorized.MergeAudibility(audibility2D[squares], values2D)
+        audibilityVoxels[voxels] = modules.vectorized.MergeAudibility(audibilityVoxels[voxels], valuesVoxels)
@@ -0,0 +1,105 @@
+# ============================================
+# Module: Checkpoint of audibility calculation
+# Results of finished megaphones are saved periodically,
+# so the interrupted calculation continues only for unfinished megaphones
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import hashlib # Fingerprint of input data
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Store arrays of results
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.cache # Settings, which change results of audibility calculation
+
+
+# ============================================
+# Calculate fingerprint of input data of audibility calculation:
+# settings, voxel's world, megaphones and their zones
+# ============================================
+def GetFingerprint():
+    key = hashlib.sha1()
+    key.update(repr(modules.cache.GetSettings()).encode())
+    key.update(repr(sorted(env.sitesCandidates)).encode())
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    key.update(buildings[:,:3].tobytes())
+    for array in (env.ground, env.uib, env.VoxelIndex, env.MegaphonesPower, env.MegaphonesHeight,
+                  env.MegaphonesAzimuth, env.MegaphonesBeamWidth, env.MegaphonesRear,
+                  env.MegaphonesHorns, env.MegaphonesHorns_count, env.MegaphonesHorns_index,
+                  env.MegaphonesCells, env.MegaphonesCells_count, env.MegaphonesCells_index,
+                  env.MegaphonesZonesInt, env.MegaphonesZonesInt_count, env.MegaphonesZonesInt_index,
+                  env.MegaphonesBuffersInt_count, env.maskBuffersInt,
+                  env.MegaphonesZonesExt, env.MegaphonesZonesExt_count, env.MegaphonesZonesExt_index,
+                  env.MegaphonesBuffersExt_count, env.maskBuffersExt):
+        if array is not None:
+            key.update(memoryview(array))
+    return key.hexdigest()
+
+# ============================================
+# Get arrays of results in shared memory: name: array
+# ============================================
+def GetResults():
+    results = {'audibility2D': np.frombuffer(env.audibility2D, dtype=ctypes.c_byte),
+               'audibilityVoxels': np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)}
+    if env.levels2D is not None:
+        results['levels2D'] = np.frombuffer(env.levels2D, dtype=ctypes.c_ushort)
+        results['levelsVoxels'] = np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort)
+    if env.coverage is not None:
+        results['coverage'] = env.coverage
+    if env.strongestMegaphones is not None:
+        results['strongestMegaphones'] = env.strongestMegaphones
+    return results
+
+# ============================================
+# Save checkpoint: results of all megaphones and list of finished megaphones.
+# Results of candidate sites of the optimizer are not stored in shared memory, so they are never finished.
+# Results of finished megaphones are just merged into shared memory,
+# results of running tasks can be saved partially: they are calculated again after resume
+# ============================================
+def SaveCheckpoint(fingerprint):
+    finished = np.array([(env.leftMegaphones[uim] == 0) and (uim not in env.sitesCandidates)
+                         for uim in range(env.countMegaphones)], dtype=bool)
+    madeChecks = np.frombuffer(env.madeChecks, dtype=ctypes.c_ulonglong).copy()
+    Path('.', cfg.folderCHECKPOINT).mkdir(exist_ok=True)
+    fileT = Path('.', cfg.folderCHECKPOINT, 'checkpoint.tmp.npz')
+    np.savez_compressed(fileT, fingerprint=fingerprint, finished=finished, madeChecks=madeChecks, **GetResults())
+    fileT.replace(Path('.', cfg.folderCHECKPOINT, 'checkpoint.npz'))
+    env.logger.debug("Checkpoint saved: {} of {} megaphones finished",
+                     env.printLong(int(finished.sum())), env.printLong(env.countMegaphones))
+
+# ============================================
+# Load checkpoint with the same fingerprint and restore results in shared memory
+# Returns list of UIMs of finished megaphones
+# ============================================
+def LoadCheckpoint(fingerprint):
+    fileC = Path('.', cfg.folderCHECKPOINT, 'checkpoint.npz')
+    if not fileC.exists():
+        env.logger.warning("Checkpoint is not found. Calculate all megaphones")
+        return []
+    with np.load(fileC) as data:
+        if str(data['fingerprint']) != fingerprint:
+            env.logger.warning("Checkpoint was saved for other input files or settings. Calculate all megaphones")
+            return []
+        if any(name not in data for name in GetResults()):
+            env.logger.warning("Checkpoint was saved with other arrays of results. Calculate all megaphones")
+            return []
+        for name, array in GetResults().items():
+            array[:] = data[name]
+        finished = np.flatnonzero(data['finished']).tolist()
+        for uim in finished:
+            env.madeChecks[uim] = int(data['madeChecks'][uim])
+    env.logger.success("Checkpoint loaded: {} of {} megaphones finished",
+                       env.printLong(len(finished)), env.printLong(env.countMegaphones))
+    return finished
+
+# ============================================
+# Delete checkpoint after the calculation is finished
+# ============================================
+def DeleteCheckpoint():
+    Path('.', cfg.folderCHECKPOINT, 'checkpoint.npz').unlink(missing_ok=True)
@@ -0,0 +1,181 @@
+# ============================================
+# Module: Coarse-to-fine audibility calculation
+# At first audibility is calculated only for the coarse grid of cells: one cell in the center of each coarse cell.
+# Obstacles of the world are not coarsened, so codes of these cells are exact.
+# Coarse cells, where the cell and all its neighbours have the same audibility code far from tall buildings,
+# get this code at once. Only other areas (boundaries of audibility, tall obstacles) are calculated cell by cell
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import multiprocessing as mp # Use multiprocessing
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import numpy as np # Arrays of audibility codes
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.megaphones # Zones of possible audibility of megaphones
+
+
+# ============================================
+# Find voxels of living buildings on the cells (linear indexes of squares)
+# Returns tuple: cells with living buildings, count of their floors and indexes of their voxels
+# ============================================
+def GetLivingVoxels(cells):
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    cells = cells[uibs[cells] >= 0]
+    cells = cells[(buildings[uibs[cells],2] > 0) & (buildings[uibs[cells],0] > 0)]
+    floors = buildings[uibs[cells],0].astype(np.int64)
+    first = np.frombuffer(env.VoxelIndex, dtype=ctypes.c_ulong)[cells].astype(np.int64)
+    voxels = np.repeat(first, floors) + np.arange(floors.sum()) - np.repeat(np.cumsum(floors) - floors, floors)
+    return cells, floors, voxels
+
+# ============================================
+# Get audibility codes of cells: the code of the square on the streets,
+# the code of all voxels of the living building, if they have the same code, otherwise 0
+# Returns NumPy-array of codes of the cells
+# ============================================
+def GetCodes(cells):
+    codes = np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)[cells].copy()
+    living, floors, voxels = GetLivingVoxels(cells)
+    if len(living) > 0:
+        values = np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)[voxels]
+        starts = np.cumsum(floors) - floors
+        lowest = np.minimum.reduceat(values, starts)
+        highest = np.maximum.reduceat(values, starts)
+        codes[np.searchsorted(cells, living)] = np.where(lowest == highest, lowest, 0)
+    return codes
+
+# ============================================
+# Find coarse cells with certain audibility: the cell and all its 8 neighbours have the same code
+# and there are no tall buildings among them
+# Returns NumPy 2D-array of codes of certain coarse cells, 0 for other cells
+# ============================================
+def GetCertainCodes(codes, tall):
+    padded = np.pad(codes, 1)
+    paddedTall = np.pad(tall, 1)
+    certain = codes != 0
+    for dx in (0, 1, 2):
+        for dy in (0, 1, 2):
+            neighbours = (slice(dx, dx+codes.shape[0]), slice(dy, dy+codes.shape[1]))
+            certain = certain & (padded[neighbours] == codes) & ~paddedTall[neighbours]
+    return np.where(certain, codes, 0)
+
+# ============================================
+# Keep in buffers of all megaphones only cells, which are marked in the linear mask of the world's cells
+# (buffers at the streets use maskExt, if it is given), and count checks of audibility calculation again.
+# Spans of zones are not changed: only masks of checked cells and counts of checked cells are replaced
+# Returns tuple of previous buffers to restore them
+# ============================================
+def SelectBuffers(mask, maskExt=None):
+    previous = {}
+    for name in ('Int', 'Ext'):
+        for variable in ('maskBuffers'+name, 'MegaphonesBuffers'+name+'_count', 'countMegaphonesBuffers'+name):
+            previous[variable] = getattr(env, variable)
+        selection = mask if (name == 'Int') or (maskExt is None) else maskExt
+        if previous['maskBuffers'+name] is not None:
+            selection = selection & (np.frombuffer(previous['maskBuffers'+name], dtype=ctypes.c_ubyte) > 0)
+        buffersMask = mp.RawArray(ctypes.c_ubyte, len(selection))
+        np.frombuffer(buffersMask, dtype=ctypes.c_ubyte)[:] = selection
+        setattr(env, 'maskBuffers'+name, buffersMask)
+        count = mp.RawArray(ctypes.c_long, env.countMegaphones)
+        for uim in range(env.countMegaphones):
+            count[uim] = len(modules.megaphones.GetBufferCells(name, uim))
+        setattr(env, 'MegaphonesBuffers'+name+'_count', count)
+        setattr(env, 'countMegaphonesBuffers'+name, int(sum(count)))
+    previous['totalChecks'] = env.totalChecks
+    previous['countChecks'] = list(env.countChecks)
+    CountChecks()
+    return previous
+
+# ============================================
+# Restore buffers of all megaphones
+# ============================================
+def RestoreBuffers(previous):
+    for name, value in previous.items():
+        if name != 'countChecks':
+            setattr(env, name, value)
+    for uim in range(env.countMegaphones):
+        env.countChecks[uim] = previous['countChecks'][uim]
+
+# ============================================
+# Count checks of audibility calculation for current buffers of megaphones and prepare progress of calculation
+# ============================================
+def CountChecks():
+    env.totalChecks = 0
+    for uim in range(env.countMegaphones):
+        env.countChecks[uim] = env.MegaphonesCells_count[uim] * \
+                               (env.MegaphonesBuffersInt_count[uim] + env.MegaphonesBuffersExt_count[uim])
+        env.totalChecks = env.totalChecks + env.countChecks[uim]
+        env.leftMegaphones[uim] = 1
+        env.madeChecks[uim] = 0
+
+# ============================================
+# Calculate audibility of the coarse grid of cells and use its certain codes for squares and voxels of the world.
+# The function of audibility calculation is called again for cells of the coarse grid only.
+# Calculated cells and cells with certain codes are removed from buffers of megaphones,
+# so only uncertain areas are calculated after that
+# ============================================
+def CalculateCoarseGrid(CalculateAudibility):
+    step = max(int(round(cfg.sizeCoarseCell / cfg.sizeVoxel)), 2)
+    env.logger.info("Calculate audibility of the coarse grid with {} meters cells...", step*cfg.sizeVoxel)
+
+    # Cells of the coarse grid: centers of coarse cells
+    x, y = np.divmod(np.arange(env.bounds[0]*env.bounds[1]), env.bounds[1])
+    grid = (x % step == step//2) & (y % step == step//2)
+    coarseX = x // step
+    coarseY = y // step
+    shape = ((env.bounds[0]+step-1) // step, (env.bounds[1]+step-1) // step)
+
+    # Calculate audibility of cells of the coarse grid without checkpoints, cache and statistics
+    previous = SelectBuffers(grid)
+    settings = (cfg.intervalCheckpoint, cfg.flagAudibilityCache, cfg.flagAudibilityStats, env.flagResume)
+    cfg.intervalCheckpoint, cfg.flagAudibilityCache, cfg.flagAudibilityStats, env.flagResume = 0, False, False, False
+    env.flagCoarseGrid = True
+    try:
+        CalculateAudibility()
+    finally:
+        cfg.intervalCheckpoint, cfg.flagAudibilityCache, cfg.flagAudibilityStats, env.flagResume = settings
+        env.flagCoarseGrid = False
+        RestoreBuffers(previous)
+    cells = np.flatnonzero(grid)
+    codes = np.zeros(shape, dtype=np.int8)
+    codes[coarseX[cells], coarseY[cells]] = GetCodes(cells)
+
+    # Coarse cells with tall buildings
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    cells = np.flatnonzero(uibs >= 0)
+    cells = cells[buildings[uibs[cells],0]*cfg.sizeFloor > cfg.heightObstacleCoarse]
+    tall = np.zeros(shape, dtype=bool)
+    tall[coarseX[cells], coarseY[cells]] = True
+
+    # Certain codes of cells in buffers of megaphones: squares on the streets and voxels of living buildings
+    certain = GetCertainCodes(codes, tall)[coarseX, coarseY]
+    certain[grid] = 0
+    buffered = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+    for name in ('Int', 'Ext'):
+        for uim in range(env.countMegaphones):
+            buffered[modules.megaphones.GetBufferCells(name, uim)] = True
+    certain[~buffered] = 0
+    cells, floors, voxels = GetLivingVoxels(np.flatnonzero(certain))
+    squares = np.flatnonzero(certain)
+    squares = squares[uibs[squares] < 0]
+    np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)[squares] = certain[squares]
+    np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)[voxels] = np.repeat(certain[cells], floors)
+
+    # Only uncertain cells are calculated cell by cell. Squares under living buildings are not certain:
+    # their cells are removed only from zones in the buildings
+    totalChecks = env.totalChecks
+    calculated = grid.copy()
+    calculated[squares] = True
+    calculatedInt = calculated.copy()
+    calculatedInt[cells] = True
+    SelectBuffers(~calculatedInt, ~calculated)
+    env.logger.success("{} squares and {} voxels got codes of the coarse grid. {} from {} checks left",
+                       env.printLong(len(squares)), env.printLong(len(voxels)),
+                       env.printLong(env.totalChecks), env.printLong(totalChecks))
@@ -0,0 +1,127 @@
+# ============================================
+# Module: Coverage of squares and voxels by several megaphones (k-coverage)
+# Results of each megaphone are calculated separately (as isolated tasks), so counts of covering megaphones
+# and the strongest megaphone of each place are found in the same run with audibility calculation.
+# Reports show places, which go silent if one megaphone fails, and redundancy of living buildings
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Arrays of counts
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.optimizer # Covered places and weights of squares and voxels
+import modules.coarse # Voxels of living buildings
+
+
+# ============================================
+# Allocate arrays of coverage: squares at first, voxels after them
+# ============================================
+def InitializeCoverage():
+    size = env.bounds[0]*env.bounds[1] + env.countVoxels
+    env.coverage = np.zeros(size, dtype=np.uint8)
+    if cfg.flagStrongestMegaphone:
+        env.strongestMegaphones = np.full(size, -1, dtype=np.int32)
+
+# ============================================
+# Add results of the megaphone: increase counts of covered places (up to 255) and find the strongest megaphone.
+# Must be called before results are merged into shared memory,
+# because shared memory keeps the best values of the previous megaphones
+# ============================================
+def AddContribution(uim, contribution, flagSoundLevels):
+    covered = modules.optimizer.GetCoverage(contribution, flagSoundLevels)
+    env.coverage[covered] = np.minimum(env.coverage[covered], 254) + 1
+    if env.strongestMegaphones is None:
+        return
+
+    # The strongest megaphone has the maximum sound level or the best audibility code
+    squares, values2D, voxels, valuesVoxels = contribution
+    if flagSoundLevels:
+        best2D = np.frombuffer(env.levels2D, dtype=ctypes.c_ushort)
+        bestVoxels = np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort)
+        minimum = 2 # 1 - there are obstacles
+    else:
+        best2D = np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)
+        bestVoxels = np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)
+        minimum = 1
+    for indexes, values, best, offset in ((squares, values2D, best2D, 0),
+                                          (voxels, valuesVoxels, bestVoxels, env.bounds[0]*env.bounds[1])):
+        strongest = env.strongestMegaphones[offset+indexes]
+        stronger = (values >= minimum) & ((strongest < 0) | (values > best[indexes]) |
+                                          ((values == best[indexes]) & (uim < strongest)))
+        env.strongestMegaphones[offset+indexes[stronger]] = uim
+
+# ============================================
+# Find living building of each voxel
+# Returns NumPy-arrays: indexes of voxels of living buildings and their UIBs
+# ============================================
+def GetVoxelsBuildings():
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    cells, floors, voxels = modules.coarse.GetLivingVoxels(np.flatnonzero(uibs >= 0))
+    return voxels, np.repeat(uibs[cells], floors)
+
+# ============================================
+# Save coverage of squares and voxels to coverage.npz and reports of coverage in folderOUTPUT:
+# places covered by the only megaphone for each megaphone and redundancy of each living building
+# ============================================
+def SaveCoverage():
+    countSquares = env.bounds[0]*env.bounds[1]
+    arrays = {'coverage2D': env.coverage[:countSquares], 'coverageVoxels': env.coverage[countSquares:]}
+    if env.strongestMegaphones is not None:
+        arrays['strongest2D'] = env.strongestMegaphones[:countSquares]
+        arrays['strongestVoxels'] = env.strongestMegaphones[countSquares:]
+    np.savez_compressed(Path('.', cfg.folderOUTPUT, 'coverage.npz'), **arrays,
+                        VoxelIndex=np.frombuffer(env.VoxelIndex, dtype=ctypes.c_ulong), bounds=np.array(env.bounds))
+
+    # Summary: squares on the streets and flats covered by none, one and several megaphones
+    voxels, uibs = GetVoxelsBuildings()
+    flats = modules.optimizer.GetWeights()[countSquares:]
+    streets = np.flatnonzero(np.frombuffer(env.uib, dtype=ctypes.c_long) < 0)
+    for name, counts, weights in (('squares on the streets', env.coverage[streets], np.ones(len(streets))),
+                                  ('flats', env.coverage[countSquares+voxels], flats[voxels])):
+        total = max(weights.sum(), 1)
+        env.logger.success("Coverage of {}: {} not covered, {} covered by one megaphone, {} covered by several megaphones", name,
+                           f'{weights[counts == 0].sum()/total:.1%}', f'{weights[counts == 1].sum()/total:.1%}',
+                           f'{weights[counts > 1].sum()/total:.1%}')
+
+    # Places, which go silent if one megaphone fails: they are covered only by this megaphone
+    if env.strongestMegaphones is not None:
+        single = env.coverage == 1
+        strongest = np.where(single, env.strongestMegaphones, -1)
+        single = strongest[streets]
+        squaresSingle = np.bincount(single[single >= 0], minlength=env.countMegaphones)
+        single = strongest[countSquares+voxels]
+        voxelsSingle = np.bincount(single[single >= 0], minlength=env.countMegaphones)
+        flatsSingle = np.bincount(single[single >= 0], weights=flats[voxels][single >= 0], minlength=env.countMegaphones)
+        with open(Path('.', cfg.folderOUTPUT, 'coverage_megaphones.csv'), 'w') as file:
+            file.write("uim,squares,voxels,flats\n")
+            for uim in range(env.countMegaphones):
+                file.write(f'{uim},{squaresSingle[uim]},{voxelsSingle[uim]},{flatsSingle[uim]:.1f}\n')
+        if env.countMegaphones > 0:
+            uim = int(np.argmax(flatsSingle))
+            env.logger.success("Failure of megaphone #{} leaves the most places without sound: {} squares on the streets and {} flats",
+                               uim, env.printLong(squaresSingle[uim]), f'{flatsSingle[uim]:.0f}')
+
+    # Redundancy of living buildings: the minimum and the mean count of megaphones covering their voxels
+    counts = env.coverage[countSquares+voxels]
+    countBuildings = len(env.buildings) // env.sizeBuilding
+    minimum = np.full(countBuildings, 255, dtype=np.uint8)
+    np.minimum.at(minimum, uibs, counts)
+    total = np.bincount(uibs, minlength=countBuildings)
+    mean = np.bincount(uibs, weights=counts, minlength=countBuildings) / np.maximum(total, 1)
+    uncovered = np.bincount(uibs, weights=(counts == 0), minlength=countBuildings)
+    single = np.bincount(uibs, weights=(counts == 1), minlength=countBuildings)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    with open(Path('.', cfg.folderOUTPUT, 'coverage_buildings.csv'), 'w') as file:
+        file.write("uib,flats,voxels,min,mean,not_covered,single\n")
+        for uib in np.flatnonzero(total > 0):
+            file.write(f'{uib},{buildings[uib,2]},{total[uib]},{minimum[uib]},{mean[uib]:.2f},'
+                       f'{uncovered[uib]:.0f},{single[uib]:.0f}\n')
+    env.logger.success("Coverage saved: {} living buildings, {} of them are covered by several megaphones",
+                       env.printLong(np.count_nonzero(total > 0)), env.printLong(np.count_nonzero((total > 0) & (minimum > 1))))
@@ -312,12 +312,12 @@ def getGroundHeight(x, y, locator):
         locators = env.lctrClipped # All surfaces
     # Loop through surfaces and search intersection on each
     for lctr in locators:
-        intersected = lctr.IntersectWithLine([x_center, (-1)*cfg.sizeVoxel, y_center], 
-                                        [x_center, (env.bounds[2]+1)*cfg.sizeVoxel, y_center], 
+        intersected = lctr.IntersectWithLine([x_center, (-1)*cfg.sizeFloor, y_center], 
+                                        [x_center, (env.bounds[2]+1)*cfg.sizeFloor, y_center], 
                                             0.01, t, pos, pcoords, subId)
         # if intersection found - use first one
         if intersected:
-            z = np.ceil(pos[1]/cfg.sizeVoxel)
+            z = np.ceil(pos[1]/cfg.sizeFloor)
             if z<0:
                 z = 0
             env.ground[x*env.bounds[1]+y] = int(z)
@@ -379,13 +379,13 @@ def VizualizeAllSquares():
                     z = min(z, env.buildings[uib*env.sizeBuilding+1]) # Use building's ground level
             # Create points for squares of the earth's surface
             if env.audibility2D[idx2D]>1:
-                env.pntsSquares_full.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                env.pntsSquares_full.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
             elif env.audibility2D[idx2D]>0:
-                env.pntsSquares_only.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                env.pntsSquares_only.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
             elif env.audibility2D[idx2D]<0:
-                env.pntsSquares_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+                env.pntsSquares_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel)
             elif (env.audibility2D[idx2D]==0) and (cfg.ShowSquares == 'full'):
-                env.pntsSquares_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel) # not env.pntsSquares_unassigned
+                env.pntsSquares_no.InsertNextPoint((x+0.5)*cfg.sizeVoxel, (z+0.1)*cfg.sizeFloor, (y+0.5)*cfg.sizeVoxel) # not env.pntsSquares_unassigned
             idx2D = idx2D + 1
 
     VizualizePartOfSquares(env.pntsSquares_full, env.Colors.GetColor3d("Green"), 0.5)
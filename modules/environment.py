@@ -9,7 +9,7 @@
 # Standart modules
 from loguru import logger # Write log
 from tqdm import tqdm # Write log
-from vtkmodules.vtkCommonCore import vtkPoints # Use points clouds in 3D-world
+from vtkmodules.vtkCommonCore import vtkPoints, vtkFloatArray # Use points clouds in 3D-world and their attributes
 from vtkmodules.vtkIOImage import vtkImageReader2Factory # Read raster images from files
 from vtkmodules.vtkRenderingCore import ( vtkRenderer, vtkRenderWindow, vtkRenderWindowInteractor ) # All for render 3D-models
 from vtkmodules.vtkCommonColor import vtkNamedColors # Use colors
@@ -25,6 +25,9 @@ import modules.settings as cfg # Settings defenition
 # Global variables defenition
 # ============================================
 
+# Continue audibility calculation from the checkpoint: urbanmegaphone.py --resume
+flagResume = False
+
 # World dimensions (float, meters, Web-Mercator ESPG:3857)
 boundsMin = [None, None, None] #lon, lat, height
 boundsMax = [None, None, None] #lon, lat, height
@@ -40,6 +43,13 @@ bounds = [None, None, None] #x_lon, y_lat, z_height
 # At first initialized by -1 values
 ground = None
 
+# Linear array: 1D-array of signed short integer values [−32 767, +32 767]:
+# hierarchical pyramid of obstacles heights. First level - squares matrix of integer vertical z-coordinates 
+# of the first voxel over the building or over the earth's surface -1 in current point.
+# Each next level - maximum values of 2x2 blocks of previous level. 
+# Used to skip cells and empty blocks of cells lower than the segment with flagHeightPyramid = True
+heights = None
+
 # Squares matrix: 2D-array of signed byte integer values [−127, +127]:
 # integer value of audibility on the earth's surface in this place: 
 # -1 (no), 0 (unknown), 1(only on the streets here), 2(on the streets and in the buildings)
@@ -66,6 +76,14 @@ countVoxels = None # Total count of buildings voxels
 countLivingVoxels = None # Count of living-buildings voxels
 audibilityVoxels = None # Just array
 
+# Squares matrix and linear array of voxels: 2D-array and 1D-array of unsigned short integer values [0, 65535]:
+# maximum sound level in this place with flagSoundLevels = True: 
+# 0 (unknown), 1 (no line of sight), 2 and more - sound level in hundredths of dBA
+# use VoxelIndex matrix to find desired index of element in levelsVoxels array
+# At first initialized by 0 values
+levels2D = None
+levelsVoxels = None
+
 # Linear array: 1D-array of the fives values of unsigned short integer values [0, 65535]:
 # [UIB*5] value - count of floors
 # [UIB*5+1] value - integer vertical coordinate of voxel of the first floor (if BuildingGroundMode != 'levels')
@@ -80,23 +98,45 @@ buildings = None
 
 # Store coordinates of cells for megaphones and its buffer zones
 sizeCell = 2 # Each cell have two signed long integer values [−2 147 483 647, +2 147 483 647] for its (x,y) cells coordinates
+sizeSpan = 3 # Each span of a row of cells have three signed long integer values: x, first y and count of cells
 countMegaphones = None # Total count of megaphones
 leftMegaphones = None # Linear 1D-array [UIM] unsigned char with 1 if calculation process of current megaphone is still planed or running, and 0 if it is just finished
+MegaphonesPower = None # Linear 1D-array [UIM] float with sound power of each megaphone, dBA
+MegaphonesHeight = None # Linear 1D-array [UIM] float with height of each megaphone, if it is standalone, meters
+MegaphonesAzimuth = None # Linear 1D-array [UIM] float with azimuth of the beam of each megaphone, degrees clockwise from the north
+MegaphonesBeamWidth = None # Linear 1D-array [UIM] float with width of the beam of each megaphone, degrees (360 for omnidirectional megaphones)
+MegaphonesRear = None # Linear 1D-array [UIM] float with sound decline behind the beam of each megaphone, dBA
+MegaphonesHorns = None # Linear 1D-array with signed long integer UIMs of horns of all sources: megaphones with the same source position
+MegaphonesHorns_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesHorns_count[UIM] horns of the source in MegaphonesHorns array (0 - the megaphone is merged into other source)
+MegaphonesHorns_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesHorns_index[UIM] horn of the source in MegaphonesHorns array
 countMegaphonesCells = None # Count of cells under megaphones
 MegaphonesCells = None # Linear 1D-array with couples (x,y) signed long integer coordinates of cells under megaphones
 MegaphonesCells_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesCells_count[UIM] cells in MegaphonesCells array
 MegaphonesCells_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesCells_index[UIM] cell in MegaphonesCells array
-countMegaphonesBuffersInt = None # Count of cells in megaphones buffer zones in the buildings
-MegaphonesBuffersInt = None # Linear 1D-array with couples (x,y) signed long integer coordinates of cells under buffer zones in the buildings of megaphones
-MegaphonesBuffersInt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesBuffers_count[UIM] cells in MegaphonesBuffers array
-MegaphonesBuffersInt_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesBuffers_index[UIM] cell in MegaphonesBuffers array
-countMegaphonesBuffersExt = None # Count of cells in megaphones buffer zones on the streets
-MegaphonesBuffersExt = None # Linear 1D-array with couples (x,y) signed long integer coordinates of cells under buffer zones on the streets of megaphones
-MegaphonesBuffersExt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesBuffers_count[UIM] cells in MegaphonesBuffers array
-MegaphonesBuffersExt_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesBuffers_index[UIM] cell in MegaphonesBuffers array
+countMegaphonesBuffersInt = None # Count of checked cells in megaphones buffer zones in the buildings
+MegaphonesZonesInt = None # Linear 1D-array with triples (x, first y, count of cells) signed long integer spans of rows of cells under buffer zones in the buildings of megaphones
+MegaphonesZonesInt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesZonesInt_count[UIM] spans in MegaphonesZonesInt array
+MegaphonesZonesInt_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesZonesInt_index[UIM] span in MegaphonesZonesInt array
+MegaphonesBuffersInt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesBuffersInt_count[UIM] checked cells of spans in the buildings
+maskBuffersInt = None # Linear 1D-array [x*bounds[1]+y] unsigned char with 1 for cells checked in buffer zones in the buildings (None - all cells of spans are checked)
+countMegaphonesBuffersExt = None # Count of checked cells in megaphones buffer zones on the streets
+MegaphonesZonesExt = None # Linear 1D-array with triples (x, first y, count of cells) signed long integer spans of rows of cells under buffer zones on the streets of megaphones
+MegaphonesZonesExt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesZonesExt_count[UIM] spans in MegaphonesZonesExt array
+MegaphonesZonesExt_index = None # Linear 1D-array with signed long integer values indexes first of MegaphonesZonesExt_index[UIM] span in MegaphonesZonesExt array
+MegaphonesBuffersExt_count = None # Linear 1D-array with signed long integer values counts of each MegaphonesBuffersExt_count[UIM] checked cells of spans on the streets
+maskBuffersExt = None # Linear 1D-array [x*bounds[1]+y] unsigned char with 1 for cells checked in buffer zones on the streets (None - all cells of spans are checked)
 countChecks = None # Linear 1D-array [UIM] unsigned long long with count of total ckesks for audibility calculation (combination of megaphones cells and buffers cells)
 madeChecks = None # Linear 1D-array [UIM] unsigned long long with counters of calculated checks at current time
 totalChecks = None # integer count of total ckesks for audibility calculation (combination of megaphones cells and buffers cells)
+audibilityStats = None # Linear 1D-array [UIM*size+k] unsigned long long with statistics of calculation of each megaphone with flagAudibilityStats = True
+coverage = None # NumPy-array unsigned char with count of megaphones covering each square and voxel with flagCoverage = True: squares at first, voxels after them
+strongestMegaphones = None # NumPy-array signed int with UIM of the strongest megaphone of each square and voxel (-1 - none) in the same order as coverage
+flagCoarseGrid = False # True while audibility of the coarse grid of cells is calculated with sizeCoarseCell > sizeVoxel
+
+# Candidate sites of new megaphones for the optimizer (they are included in megaphones above)
+sitesCandidates = {} # Dict UIM: (x,y) coordinates of candidate site in the coordinate system of source vector files
+pointsCandidates = {} # Dict UIM: list of points of VTK objects for each cell of candidate megaphone
+selectedCandidates = [] # List of UIMs of candidate sites, selected by the optimizer
 
 # DatraFrame, GeoDataFrame tables, Shapely geometries
 # ============================================
@@ -195,6 +235,8 @@ actVoxels = [] # vtkActor
 # Arrays of VTK object: megaphones
 pntsMegaphones_buildings_cones = vtkPoints()
 pntsMegaphones_standalone_cones = vtkPoints()
+vecMegaphones_standalone_cones = vtkFloatArray() # Scales (1, height of the megaphone, 1) of cones of standalone megaphones
+vecMegaphones_standalone_cones.SetNumberOfComponents(3)
 pntsMegaphones_spheres = vtkPoints()
 pldtMegaphones = [] # vtkPolyData
 cnMegaphones = [] # vtkConeSource
@@ -0,0 +1,137 @@
+# ============================================
+# Module: Quick estimate of audibility by the random sample
+# Stratified random sample of cells of living buildings (all voxels of the cell) and squares is calculated
+# instead of the whole world. Shares of audible flats, voxels and squares are estimated with confidence intervals
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+from statistics import NormalDist # Quantiles of confidence intervals
+import numpy as np # Random sample and estimates
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.coarse # Select cells in buffers of megaphones
+import modules.megaphones # Cells of zones of possible audibility of megaphones
+import modules.audibility # Multiprocessing audibility calculation
+
+# Count of strata along each side of the world: the world is divided into StrataSide*StrataSide rectangles
+StrataSide = 8
+
+
+# ============================================
+# Get stratum of each cell (linear indexes of squares): rectangle of the world
+# ============================================
+def GetStrata(cells):
+    x, y = np.divmod(cells, env.bounds[1])
+    return (x*StrataSide // env.bounds[0]) * StrataSide + (y*StrataSide // env.bounds[1])
+
+# ============================================
+# Draw stratified random sample of cells with count of samples in each stratum
+# proportional to the sum of weights of its cells (at least 2 cells, if it is possible)
+# Returns NumPy-array of sampled cells
+# ============================================
+def DrawSample(rng, cells, weights, count):
+    strata = GetStrata(cells)
+    total = max(weights.sum(), 1e-9)
+    sample = []
+    for stratum in np.unique(strata):
+        inStratum = strata == stratum
+        size = int(round(count * weights[inStratum].sum() / total))
+        size = min(max(size, 2), np.count_nonzero(inStratum))
+        sample.append(rng.choice(cells[inStratum], size, replace=False))
+    return np.sort(np.concatenate(sample)) if len(sample) > 0 else np.zeros(0, dtype=np.int64)
+
+# ============================================
+# Combined ratio estimate of the stratified random sample: share = sum(values) / sum(weights) of all population
+# Returns tuple: estimated share, half-width of its confidence interval and estimated sum of weights of population
+# ============================================
+def EstimateShare(population, sample, values, weights):
+    strataPopulation = np.bincount(GetStrata(population), minlength=StrataSide*StrataSide)
+    strata = GetStrata(sample)
+    totalValues = 0
+    totalWeights = 0
+    for stratum in np.unique(strata):
+        inStratum = strata == stratum
+        totalValues = totalValues + strataPopulation[stratum] * values[inStratum].mean()
+        totalWeights = totalWeights + strataPopulation[stratum] * weights[inStratum].mean()
+    if totalWeights <= 0:
+        return 0.0, 0.0, 0.0
+    share = totalValues / totalWeights
+    variance = 0
+    for stratum in np.unique(strata):
+        inStratum = strata == stratum
+        size = np.count_nonzero(inStratum)
+        if size < 2:
+            continue
+        residuals = values[inStratum] - share*weights[inStratum]
+        variance = variance + strataPopulation[stratum]**2 * (1 - size/strataPopulation[stratum]) / size * residuals.var(ddof=1)
+    quantile = NormalDist().inv_cdf(0.5 + cfg.levelEstimateConfidence/2)
+    return share, quantile * np.sqrt(variance) / totalWeights, totalWeights
+
+# ============================================
+# Write the estimate to result.txt
+# ============================================
+def WriteEstimate(name, share, halfWidth, total, count):
+    env.writeStat("|| {} ({} ± {}) of {} {} are audibility, {} samples".format(
+                  env.printLong(round(share*total)), f'{share:.1%}', f'{halfWidth:.1%}', env.printLong(round(total)),
+                  name, env.printLong(count) ) )
+
+# ============================================
+# Estimate shares of audible flats, voxels and squares by the stratified random sample
+# instead of the full calculation of audibility
+# ============================================
+def EstimateAudibility():
+    env.logger.info("Draw stratified random sample of {} cells of living buildings and {} squares...",
+                    env.printLong(cfg.countEstimateSamples), env.printLong(cfg.countEstimateSamples))
+    rng = np.random.default_rng(cfg.seedEstimate)
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+
+    # Cells of living buildings: weight of each cell is count of its flats
+    living, floors, _ = modules.coarse.GetLivingVoxels(np.arange(env.bounds[0]*env.bounds[1]))
+    flats = floors * buildings[uibs[living],2] / np.maximum(buildings[uibs[living],3], 1)
+    sampleLiving = DrawSample(rng, living, flats, cfg.countEstimateSamples)
+
+    # Squares on the streets in zones of possible audibility of megaphones or all squares
+    if cfg.ShowSquares == 'full':
+        squares = np.arange(env.bounds[0]*env.bounds[1])
+    else:
+        squares = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+        for uim in range(env.countMegaphones):
+            squares[modules.megaphones.GetBufferCells('Ext', uim)] = True
+        squares = np.flatnonzero(squares)
+    sampleSquares = DrawSample(rng, squares, np.ones(len(squares)), cfg.countEstimateSamples)
+
+    # Calculate audibility only for sampled cells without checkpoints, cache, coverage and coarse grid
+    mask = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+    mask[sampleLiving] = True
+    mask[sampleSquares] = True
+    modules.coarse.SelectBuffers(mask)
+    cfg.intervalCheckpoint, cfg.flagAudibilityCache, cfg.flagCoverage, cfg.sizeCoarseCell = 0, False, False, 0
+    env.flagResume = False
+    modules.audibility.CalculateAudibility()
+
+    # Audible voxels and flats of sampled cells of living buildings
+    cells, floorsSample, voxels = modules.coarse.GetLivingVoxels(sampleLiving)
+    audible = np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte)[voxels] > 0
+    starts = np.cumsum(floorsSample) - floorsSample
+    audibleFloors = np.add.reduceat(audible, starts) if len(cells) > 0 else np.zeros(0)
+    flatsVoxel = buildings[uibs[cells],2] / np.maximum(buildings[uibs[cells],3], 1)
+
+    # Audible squares: squares without audibility codes are not analyzed, except ShowSquares = 'full'
+    codes = np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)[sampleSquares]
+    analyzed = np.ones(len(codes)) if cfg.ShowSquares == 'full' else (codes != 0).astype(np.float64)
+
+    env.writeStat("=========================================================================================================")
+    env.writeStat("|| ESTIMATE BY THE RANDOM SAMPLE, {} confidence intervals:".format(f'{cfg.levelEstimateConfidence:.0%}'))
+    share, halfWidth, _ = EstimateShare(living, cells, audibleFloors*flatsVoxel, floorsSample*flatsVoxel)
+    WriteEstimate('flats', share, halfWidth, flats.sum(), len(cells))
+    share, halfWidth, _ = EstimateShare(living, cells, audibleFloors, floorsSample)
+    WriteEstimate('living voxels', share, halfWidth, floors.sum(), len(cells))
+    WriteEstimate('squares', *EstimateShare(squares, sampleSquares, (codes > 0).astype(np.float64), analyzed), len(codes))
+    env.writeStat("=========================================================================================================")
@@ -16,12 +16,210 @@ from vtkmodules.vtkCommonDataModel import vtkPolyData # Use 3D-primitives
 from vtkmodules.vtkRenderingCore import (vtkActor, vtkPolyDataMapper) # Use VTK rendering
 import vtk # Use other 3D-visualization features
 from shapely.ops import unary_union # For combine vector objects 
+from shapely.geometry import MultiPoint # For sectors of directional megaphones
+from shapely import get_coordinates # For vertices of vector objects
+from shapely import prepare, contains_xy # For rasterization of zones of possible audibility
 import gc # For garbage collectors
 
 # Own core modules
 import modules.settings as cfg # Settings defenition
 import modules.environment as env # Environment defenition
 import modules.earth # The earth's surface routines
+import modules.buildings # Facades of buildings
+
+# ============================================
+# Insert points of one cell of the megaphone into VTK collections for further vizualization
+# IN: tuple (flag of standalone megaphone, point of cone, point of sphere, height of the megaphone in meters)
+# ============================================
+def InsertMegaphonePoints(points):
+    standalone, cone, sphere, height = points
+    if standalone:
+        env.pntsMegaphones_standalone_cones.InsertNextPoint(cone)
+        env.vecMegaphones_standalone_cones.InsertNextTuple3(1.0, height, 1.0)
+    else:
+        env.pntsMegaphones_buildings_cones.InsertNextPoint(cone)
+    env.pntsMegaphones_spheres.InsertNextPoint(sphere)
+
+# ============================================
+# Calculate max distances of possible audibility of the megaphone by its sound power, meters:
+# in the buildings and on the streets. The same formulas as distancePossibleAudibility in settings
+# ============================================
+def GetDistancesPossibleAudibility(power):
+    return (10**((power+cfg.dBAWindow-cfg.dBAHomeMin-cfg.dBALevel)/20), 
+            10**((power-cfg.dBAStreetMin-cfg.dBALevel)/20))
+
+# ============================================
+# Get zone of possible audibility around the megaphone geometry at the distance, meters.
+# The zone of directional megaphone is the sector of its beam (azimuth and width, degrees) 
+# and the circle of the rear lobe, where the distance is reduced by rear sound decline, dBA.
+# Geometry is already flipped to vtk's coordinates, so the north is directed against the y axis
+# ============================================
+def GetZoneOfPossibleAudibility(geometry, distance, azimuth, beamwidth, rear):
+    if not (0 < beamwidth < 360):
+        return geometry.buffer(distance)
+
+    # Split the sector into convex pieces not wider than 90 degrees. 
+    # The arc of each piece is circumscribed by segments not longer than 10 degrees
+    zones = [geometry.buffer(distance * 10**(rear/20))]
+    vertices = get_coordinates(geometry.convex_hull)
+    countPieces = int(np.ceil(beamwidth / 90))
+    for piece in range(countPieces):
+        start = azimuth - beamwidth/2 + piece*beamwidth/countPieces
+        countSegments = int(np.ceil(beamwidth / countPieces / 10))
+        angles = np.radians(start + np.arange(countSegments+1) * beamwidth/countPieces/countSegments)
+        radius = distance / np.cos(np.radians(beamwidth/countPieces/countSegments/2))
+        sector = np.vstack([[0.0, 0.0], np.column_stack([radius*np.sin(angles), -radius*np.cos(angles)])])
+        # Minkowski sum of the convex hull of the geometry and the convex piece of the sector
+        zones.append(MultiPoint((vertices[:,None,:] + sector[None,:,:]).reshape(-1, 2)).convex_hull)
+    return unary_union(zones)
+
+# ============================================
+# Get spans of rows of cells: (x, first y, count of cells) for each run of neighbouring cells of the same row
+# IN: cells - NumPy-array of unique linear indexes of cells in the row-major order
+# Returns NumPy 2D-array [span, sizeSpan] of spans
+# ============================================
+def GetSpans(cells):
+    if len(cells) == 0:
+        return np.zeros((0, env.sizeSpan), dtype=np.int64)
+    starts = np.flatnonzero((np.diff(cells, prepend=cells[0]-2) != 1) | (cells % env.bounds[1] == 0))
+    x, y = np.divmod(cells[starts], env.bounds[1])
+    return np.column_stack((x, y, np.diff(starts, append=len(cells)))).astype(np.int64)
+
+# ============================================
+# Get cells of spans of rows of cells
+# IN: spans - NumPy 2D-array [span, sizeSpan] of spans, sizeY - the y-dimension size of the world
+# Returns NumPy-array of linear indexes of cells in the row-major order
+# ============================================
+def GetSpansCells(spans, sizeY):
+    lengths = spans[:,2]
+    starts = spans[:,0]*sizeY + spans[:,1] - (np.cumsum(lengths) - lengths)
+    return np.repeat(starts, lengths) + np.arange(lengths.sum())
+
+# ============================================
+# Get cells of the zone of possible audibility of the megaphone from linear arrays of spans of zones 
+# in the same order as C shared library enumerates them: only cells marked in the mask of the world's cells
+# (all cells, if the mask is None). It is used by processes of calculation, so it uses only constants of environment
+# Returns NumPy-array of linear indexes of cells
+# ============================================
+def GetZoneCells(zones, zonesCount, zonesIndex, mask, sizeY, uim):
+    count = zonesCount[uim]
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    spans = np.frombuffer(zones, dtype=ctypes.c_long, count=count*env.sizeSpan,
+                          offset=zonesIndex[uim]*ctypes.sizeof(ctypes.c_long)).reshape(count, env.sizeSpan)
+    cells = GetSpansCells(spans.astype(np.int64), sizeY)
+    if mask is not None:
+        cells = cells[np.frombuffer(mask, dtype=ctypes.c_ubyte)[cells] > 0]
+    return cells
+
+# ============================================
+# Get cells of the zone of possible audibility of the megaphone, which are checked by audibility calculation
+# IN: name - 'Int' for the zone in the buildings or 'Ext' for the zone at the streets
+# Returns NumPy-array of linear indexes of cells
+# ============================================
+def GetBufferCells(name, uim):
+    return GetZoneCells(getattr(env, 'MegaphonesZones'+name), getattr(env, 'MegaphonesZones'+name+'_count'),
+                        getattr(env, 'MegaphonesZones'+name+'_index'), getattr(env, 'maskBuffers'+name), env.bounds[1], uim)
+
+# ============================================
+# Rasterize the zone of possible audibility: find cells of the world, which centers are within the zone.
+# These are the same cells as the spatial join of the zone and centers of voxel's squares, 
+# but only cells of the bounding box of the zone are tested (by strips of rows to save memory)
+# Returns NumPy 2D-array of spans of rows of cells in the row-major order
+# ============================================
+def RasterizeZone(zone):
+    xMin, yMin, xMax, yMax = zone.bounds
+    rows = np.arange(max(int(np.floor(xMin/cfg.sizeVoxel)), 0), min(int(np.ceil(xMax/cfg.sizeVoxel)), env.bounds[0]))
+    columns = np.arange(max(int(np.floor(yMin/cfg.sizeVoxel)), 0), min(int(np.ceil(yMax/cfg.sizeVoxel)), env.bounds[1]))
+    prepare(zone)
+    spans = [np.zeros((0, env.sizeSpan), dtype=np.int64)]
+    sizeStrip = max(2**22 // max(len(columns), 1), 1)
+    for first in range(0, len(rows), sizeStrip):
+        x, y = np.meshgrid(rows[first:first+sizeStrip], columns, indexing='ij')
+        inside = contains_xy(zone, (x+0.5)*cfg.sizeVoxel, (y+0.5)*cfg.sizeVoxel)
+        spans.append(GetSpans(x[inside].astype(np.int64)*env.bounds[1] + y[inside]))
+    return np.concatenate(spans)
+
+# ============================================
+# Rasterize zones of possible audibility of all megaphones without tables of cell-megaphone combinations
+# IN: distance - name of the column of gdfMegaphones with the distance of possible audibility
+# Returns tuple: dictionary {UIM: NumPy 2D-array of spans of rows of cells of its zone} 
+# and the linear mask of all cells in zones of possible audibility
+# ============================================
+def RasterizeZones(distance):
+    zones = {}
+    mask = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+    for megaphone in env.tqdm(env.gdfMegaphones.itertuples(), total=len(env.gdfMegaphones.index)):
+        spans = RasterizeZone(GetZoneOfPossibleAudibility(megaphone.geometry, getattr(megaphone, distance), 
+            megaphone.azimuthMegaphone, megaphone.beamMegaphone, megaphone.rearMegaphone))
+        if megaphone.UIM in zones: # The megaphone is near several buildings
+            spans = GetSpans(np.union1d(GetSpansCells(zones[megaphone.UIM], env.bounds[1]), GetSpansCells(spans, env.bounds[1])))
+        zones[megaphone.UIM] = spans
+        mask[GetSpansCells(spans, env.bounds[1])] = True
+    env.logger.success("{} from {} unique cells in zones of possible audibility", 
+                       env.printLong(np.count_nonzero(mask)), env.printLong(len(mask)))
+    env.logger.success("{} cell-megaphone combinations", env.printLong(sum(int(spans[:,2].sum()) for spans in zones.values())))
+    return zones, mask
+
+# ============================================
+# Get spans of rows of cells of zones of possible audibility of each megaphone 
+# from the spatial join of zones and centers of voxel's squares
+# Returns dictionary {UIM: NumPy 2D-array of spans of rows of cells of its zone}
+# ============================================
+def GetZonesSpans(gdfBuffers):
+    cells = gdfBuffers['x'].to_numpy().astype(np.int64)*env.bounds[1] + gdfBuffers['y'].to_numpy().astype(np.int64)
+    uims = gdfBuffers['UIM'].to_numpy()
+    order = np.argsort(uims, kind='stable')
+    unique, starts = np.unique(uims[order], return_index=True)
+    return {uim: GetSpans(np.unique(cells)) for uim, cells in zip(unique.tolist(), np.split(cells[order], starts[1:]))}
+
+# ============================================
+# Store spans of rows of cells of zones of possible audibility of all megaphones into the shared memory.
+# Cells of zones are not stored: C shared library enumerates them from spans and skips cells out of the mask
+# IN: zones - dictionary {UIM: NumPy 2D-array of spans of rows of cells of its zone},
+# mask - NumPy-array of the linear mask of the world's cells to check or None for all cells
+# Returns tuple: count of checked cells, linear array of spans, counts and indexes of the first values of spans of megaphones,
+# counts of checked cells of megaphones and the mask in the shared memory (or None)
+# ============================================
+def StoreZones(zones, mask):
+    counts = np.array([len(zones.get(uim, ())) for uim in range(env.countMegaphones)], dtype=np.int64)
+    spans = mp.RawArray(ctypes.c_long, int(counts.sum())*env.sizeSpan)
+    count = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    index = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    np.frombuffer(count, dtype=ctypes.c_long)[:] = counts
+    np.frombuffer(index, dtype=ctypes.c_long)[:] = (np.cumsum(counts) - counts)*env.sizeSpan
+    if counts.sum() > 0:
+        np.frombuffer(spans, dtype=ctypes.c_long)[:] = np.concatenate([zones[uim] for uim in range(env.countMegaphones) 
+                                                                       if counts[uim] > 0]).ravel()
+    sharedMask = None
+    if mask is not None:
+        sharedMask = mp.RawArray(ctypes.c_ubyte, len(mask))
+        np.frombuffer(sharedMask, dtype=ctypes.c_ubyte)[:] = mask
+    cellsCount = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    for uim in range(env.countMegaphones):
+        cellsCount[uim] = len(GetZoneCells(spans, count, index, sharedMask, env.bounds[1], uim))
+    return int(sum(cellsCount)), spans, count, index, cellsCount, sharedMask
+
+# ============================================
+# Find sources of megaphones: megaphones with the same cells, height and sound power (e.g. several horns 
+# on the same roof or mast) are calculated as one source. Candidate sites of the optimizer are never merged
+# IN: megaphones - DataFrame of megaphones with UIM index
+# Returns NumPy-array [UIM] with UIM of the source of each megaphone: the lowest UIM of its horns
+# ============================================
+def GetMegaphonesSources(megaphones):
+    sources = np.arange(env.countMegaphones)
+    if not cfg.flagMergeMegaphones:
+        return sources
+    cells = {}
+    for cell in env.gdfCellsMegaphones.itertuples():
+        cells.setdefault(cell.UIM, []).append((int(cell.x), int(cell.y)))
+    first = {}
+    for uim in range(env.countMegaphones):
+        if (uim not in megaphones.index) or megaphones['candidate'][uim]:
+            continue
+        key = (tuple(sorted(cells.get(uim, []))), megaphones['powerMegaphone'][uim], megaphones['heightMegaphone'][uim])
+        sources[uim] = first.setdefault(key, uim)
+    return sources
 
 # ============================================
 # Load vector points of megaphones
@@ -32,9 +230,45 @@ def LoadMegaphones():
     gdfPoints = []
     for file in Path('.',cfg.folderMEGAPHONES).glob("*.geojson", case_sensitive=False):
         env.logger.debug("Load points of megaphones: {file}", file=file)
-        gdfPoints.append(gpd.read_file(file))
+        gdfFile = gpd.read_file(file)
+        gdfFile['candidate'] = False
+        gdfPoints.append(gdfFile)
+
+    # Load candidate sites of new megaphones for the optimizer
+    if cfg.countOptimizeMegaphones > 0:
+        for file in Path('.',cfg.folderCANDIDATES).glob("*.geojson", case_sensitive=False):
+            env.logger.debug("Load candidate sites of megaphones: {file}", file=file)
+            gdfFile = gpd.read_file(file)
+            gdfFile['candidate'] = True
+            gdfPoints.append(gdfFile)
     env.gdfMegaphones = gpd.GeoDataFrame(pd.concat(gdfPoints, ignore_index=True, sort=False))
-    env.logger.success("{} megaphones loaded", len(env.gdfMegaphones.index))
+    env.gdfMegaphones['xSite'] = env.gdfMegaphones.geometry.x
+    env.gdfMegaphones['ySite'] = env.gdfMegaphones.geometry.y
+
+    # Sound power and height of each megaphone: optional attributes or default values
+    env.gdfMegaphones['powerMegaphone'] = float(cfg.dBAMegaphone)
+    if cfg.fieldMegaphonePower in env.gdfMegaphones.columns:
+        env.gdfMegaphones['powerMegaphone'] = env.gdfMegaphones[cfg.fieldMegaphonePower].astype(float).fillna(cfg.dBAMegaphone)
+    env.gdfMegaphones['heightMegaphone'] = float(cfg.heightStansaloneMegaphone)
+    if cfg.fieldMegaphoneHeight in env.gdfMegaphones.columns:
+        env.gdfMegaphones['heightMegaphone'] = env.gdfMegaphones[cfg.fieldMegaphoneHeight].astype(float).fillna(cfg.heightStansaloneMegaphone)
+    env.gdfMegaphones['distanceInt'], env.gdfMegaphones['distanceExt'] = GetDistancesPossibleAudibility(env.gdfMegaphones['powerMegaphone'])
+
+    # Beam of directional megaphones: optional attributes or default values. Megaphones without azimuth are omnidirectional
+    env.gdfMegaphones['azimuthMegaphone'] = 0.0
+    env.gdfMegaphones['beamMegaphone'] = 360.0
+    if cfg.fieldMegaphoneAzimuth in env.gdfMegaphones.columns:
+        azimuth = env.gdfMegaphones[cfg.fieldMegaphoneAzimuth].astype(float)
+        env.gdfMegaphones['azimuthMegaphone'] = azimuth.fillna(0.0) % 360
+        env.gdfMegaphones['beamMegaphone'] = float(cfg.BeamWidthMegaphone)
+        if cfg.fieldMegaphoneBeamWidth in env.gdfMegaphones.columns:
+            env.gdfMegaphones['beamMegaphone'] = env.gdfMegaphones[cfg.fieldMegaphoneBeamWidth].astype(float).fillna(cfg.BeamWidthMegaphone)
+        env.gdfMegaphones.loc[azimuth.isna(), 'beamMegaphone'] = 360.0
+    env.gdfMegaphones['rearMegaphone'] = float(cfg.dBAMegaphoneRear)
+    if cfg.fieldMegaphoneRear in env.gdfMegaphones.columns:
+        env.gdfMegaphones['rearMegaphone'] = env.gdfMegaphones[cfg.fieldMegaphoneRear].astype(float).fillna(cfg.dBAMegaphoneRear)
+    env.logger.success("{} megaphones loaded (including {} candidate sites)", 
+                       len(env.gdfMegaphones.index), int(env.gdfMegaphones['candidate'].sum()))
     env.logger.trace(env.gdfMegaphones)
 
     # Convert 2D-coordinates of megaphones GeoDataFrame from meters (Web-Mercator ESPG:3857) to vtk's float
@@ -50,6 +284,13 @@ def LoadMegaphones():
     env.logger.success("{} megaphones left after removing megaphones outside of current world area", len(env.gdfMegaphones.index))
     env.logger.trace(env.gdfMegaphones)
 
+    # Store candidate sites for the optimizer
+    env.sitesCandidates = {}
+    env.pointsCandidates = {}
+    for megaphone in env.gdfMegaphones.loc[env.gdfMegaphones['candidate']].itertuples():
+        env.sitesCandidates[megaphone.UIM] = (megaphone.xSite, megaphone.ySite)
+        env.pointsCandidates[megaphone.UIM] = []
+
     # Join megaphones and cells of buildings GeoDataFrames
     env.gdfCellsMegaphones = env.gdfMegaphones.sjoin_nearest(env.gdfCellsBuildings, how='left', max_distance=cfg.distanceMegaphoneAndBuilding)
     env.logger.success("{} from {} cells are under megaphones", 
@@ -61,13 +302,14 @@ def LoadMegaphones():
     env.gdfCellsMegaphones['y'] = env.gdfCellsMegaphones['y'].fillna(env.gdfCellsMegaphones['geometry'].apply(lambda g : int(round(g.y/cfg.sizeVoxel))))
     env.logger.trace(env.gdfCellsMegaphones)
 
-    # Generate VTK's objects for megaphones
+    # Generate VTK's objects for megaphones. Candidate sites are shown only if they are selected by the optimizer
     for cell in env.gdfCellsMegaphones.itertuples(): # (tqdm is not needed)
         if pd.isna(cell.floors):
             z = int(modules.earth.getGroundHeight( int(cell.x), int(cell.y), None ))
-            height = cfg.heightStansaloneMegaphone / cfg.sizeVoxel
-            env.pntsMegaphones_standalone_cones.InsertNextPoint((cell.x+0.5)*cfg.sizeVoxel, (z-0.5)*cfg.sizeVoxel+cfg.heightStansaloneMegaphone/2, (cell.y+0.5)*cfg.sizeVoxel)
-            env.pntsMegaphones_spheres.InsertNextPoint((cell.x+0.5)*cfg.sizeVoxel, (z-0.5)*cfg.sizeVoxel+cfg.heightStansaloneMegaphone, (cell.y+0.5)*cfg.sizeVoxel)
+            height = cell.heightMegaphone / cfg.sizeFloor
+            points = (True, ((cell.x+0.5)*cfg.sizeVoxel, (z-0.5)*cfg.sizeFloor+cell.heightMegaphone/2, (cell.y+0.5)*cfg.sizeVoxel),
+                      ((cell.x+0.5)*cfg.sizeVoxel, (z-0.5)*cfg.sizeFloor+cell.heightMegaphone, (cell.y+0.5)*cfg.sizeVoxel),
+                      cell.heightMegaphone)
             env.logger.warning("Megaphone too far from any building: {}. Use {} voxels ground and {} voxels height",
                                cell.geometry, z, f'{height:.1f}')
         else:
@@ -75,13 +317,25 @@ def LoadMegaphones():
                 z = cell.GP_agg
             else:
                 z = cell.GP
-            height = int(round( cell.floors * cfg.sizeFloor / cfg.sizeVoxel ))
-            env.pntsMegaphones_buildings_cones.InsertNextPoint((cell.x+0.5)*cfg.sizeVoxel, (z+0.5+height)*cfg.sizeVoxel, (cell.y+0.5)*cfg.sizeVoxel)
-            env.pntsMegaphones_spheres.InsertNextPoint((cell.x+0.5)*cfg.sizeVoxel, (z+0.5+height+0.5)*cfg.sizeVoxel, (cell.y+0.5)*cfg.sizeVoxel)
+            height = int(cell.floors) # One voxel for each floor
+            points = (False, ((cell.x+0.5)*cfg.sizeVoxel, (z+0.5+height)*cfg.sizeFloor, (cell.y+0.5)*cfg.sizeVoxel),
+                      ((cell.x+0.5)*cfg.sizeVoxel, (z+0.5+height+0.5)*cfg.sizeFloor, (cell.y+0.5)*cfg.sizeVoxel),
+                      cfg.sizeFloor)
+        if cell.candidate:
+            env.pointsCandidates[cell.UIM].append(points)
+        else:
+            InsertMegaphonePoints(points)
 
     # Echo distance of maxium possible audibility
     env.logger.success("Maximum distance of possible audibility is {} meter in the buildings and {} meter on the streets", 
-                       f'{cfg.distancePossibleAudibilityInt:.1f}', f'{cfg.distancePossibleAudibilityExt:.1f}' )
+                       f'{env.gdfMegaphones["distanceInt"].max():.1f}', f'{env.gdfMegaphones["distanceExt"].max():.1f}' )
+    if env.gdfMegaphones['powerMegaphone'].nunique() > 1:
+        env.logger.success("Sound power of megaphones is {} - {} dBA, the minimum distance of possible audibility is {} meter in the buildings and {} meter on the streets",
+                           f'{env.gdfMegaphones["powerMegaphone"].min():.1f}', f'{env.gdfMegaphones["powerMegaphone"].max():.1f}',
+                           f'{env.gdfMegaphones["distanceInt"].min():.1f}', f'{env.gdfMegaphones["distanceExt"].min():.1f}' )
+    countDirectional = int(((env.gdfMegaphones['beamMegaphone'] > 0) & (env.gdfMegaphones['beamMegaphone'] < 360)).sum())
+    if countDirectional > 0:
+        env.logger.success("{} directional megaphones: zones of possible audibility are restricted by sectors of their beams", countDirectional)
     if cfg.distancePossibleAudibilityInt > cfg.distancePossibleAudibilityExt:
         env.logger.error("Audibility on the streets is less than in the buildings. It's impossible")
 
@@ -97,70 +351,122 @@ def LoadMegaphones():
     env.gdfMegaphones = env.gdfMegaphones.set_geometry(col='geometry_buildings').drop(columns='geometry').rename_geometry('geometry')
     env.logger.trace(env.gdfMegaphones)
 
-    # Generate zones of possible audibility in the buildings
-    env.logger.info("Locate zones of possible audibility in the buildings...")
+    # Generate zones of possible audibility: cells of zones of each megaphone
+    if cfg.BuffersMode == 'raster':
+        env.logger.info("Rasterize zones of possible audibility in the buildings...")
+        zonesInt, _ = RasterizeZones('distanceInt')
+        env.logger.info("Rasterize zones of possible audibility at the streets...")
+        zonesExt, maskZonesExt = RasterizeZones('distanceExt')
+    else:
+        # Generate zones of possible audibility in the buildings
+        env.logger.info("Locate zones of possible audibility in the buildings...")
 
-    # Calculate buffer around all megaphones
-    env.gdfBuffersMegaphonesInt = env.gdfMegaphones.copy()
-    env.gdfBuffersMegaphonesInt = env.gdfBuffersMegaphonesInt.drop(labels='index_right', axis='columns')
-    env.gdfBuffersMegaphonesInt['geometry'] = env.gdfBuffersMegaphonesInt['geometry'].buffer(distance=cfg.distancePossibleAudibilityInt)
-    env.logger.trace(env.gdfBuffersMegaphonesInt)
+        # Calculate buffer around all megaphones
+        env.gdfBuffersMegaphonesInt = env.gdfMegaphones.copy()
+        env.gdfBuffersMegaphonesInt = env.gdfBuffersMegaphonesInt.drop(labels='index_right', axis='columns')
+        env.gdfBuffersMegaphonesInt['geometry'] = [GetZoneOfPossibleAudibility(*zone) for zone in zip(
+            env.gdfBuffersMegaphonesInt['geometry'], env.gdfBuffersMegaphonesInt['distanceInt'], env.gdfBuffersMegaphonesInt['azimuthMegaphone'],
+            env.gdfBuffersMegaphonesInt['beamMegaphone'], env.gdfBuffersMegaphonesInt['rearMegaphone'])]
+        env.logger.trace(env.gdfBuffersMegaphonesInt)
 
-    # Join buffer zones and centers of voxel's squares GeoDataFrames
-    env.gdfBuffersMegaphonesInt = env.gdfCells.sjoin(env.gdfBuffersMegaphonesInt, how='inner',predicate='within')
-    env.logger.trace(env.gdfBuffersMegaphonesInt)
-    env.logger.trace(env.gdfBuffersMegaphonesInt.dtypes)
+        # Join buffer zones and centers of voxel's squares GeoDataFrames
+        env.gdfBuffersMegaphonesInt = env.gdfCells.sjoin(env.gdfBuffersMegaphonesInt, how='inner',predicate='within')
+        env.logger.trace(env.gdfBuffersMegaphonesInt)
+        env.logger.trace(env.gdfBuffersMegaphonesInt.dtypes)
 
-    # Calculate count of unique cells
-    gdfBuffersMegaphonesInt = env.gdfBuffersMegaphonesInt.groupby(['x','y']).size().reset_index()
-    env.logger.success("{} from {} unique cells in zones of possible audibility", 
-                       env.printLong(len(gdfBuffersMegaphonesInt.index)), env.printLong(len(env.gdfCells.index)))
-    env.logger.success("{} cell-megaphone combinations", env.printLong(len(env.gdfBuffersMegaphonesInt.index)))
+        # Calculate count of unique cells
+        gdfBuffersMegaphonesInt = env.gdfBuffersMegaphonesInt.groupby(['x','y']).size().reset_index()
+        env.logger.success("{} from {} unique cells in zones of possible audibility", 
+                           env.printLong(len(gdfBuffersMegaphonesInt.index)), env.printLong(len(env.gdfCells.index)))
+        env.logger.success("{} cell-megaphone combinations", env.printLong(len(env.gdfBuffersMegaphonesInt.index)))
 
-    # Generate zones of possible audibility at the streets
-    env.logger.info("Locate zones of possible audibility at the streets...")
+        # Generate zones of possible audibility at the streets
+        env.logger.info("Locate zones of possible audibility at the streets...")
 
-    # Calculate buffer around all megaphones
-    env.gdfBuffersMegaphonesExt = env.gdfMegaphones.copy()
-    env.gdfBuffersMegaphonesExt = env.gdfBuffersMegaphonesExt.drop(labels='index_right', axis='columns')
-    env.gdfBuffersMegaphonesExt['geometry'] = env.gdfBuffersMegaphonesExt['geometry'].buffer(distance=cfg.distancePossibleAudibilityExt)
-    env.logger.trace(env.gdfBuffersMegaphonesExt)
+        # Calculate buffer around all megaphones
+        env.gdfBuffersMegaphonesExt = env.gdfMegaphones.copy()
+        env.gdfBuffersMegaphonesExt = env.gdfBuffersMegaphonesExt.drop(labels='index_right', axis='columns')
+        env.gdfBuffersMegaphonesExt['geometry'] = [GetZoneOfPossibleAudibility(*zone) for zone in zip(
+            env.gdfBuffersMegaphonesExt['geometry'], env.gdfBuffersMegaphonesExt['distanceExt'], env.gdfBuffersMegaphonesExt['azimuthMegaphone'],
+            env.gdfBuffersMegaphonesExt['beamMegaphone'], env.gdfBuffersMegaphonesExt['rearMegaphone'])]
+        env.logger.trace(env.gdfBuffersMegaphonesExt)
 
-    # Join buffer zones and centers of voxel's squares GeoDataFrames
-    env.gdfBuffersMegaphonesExt = env.gdfCells.sjoin(env.gdfBuffersMegaphonesExt, how='inner',predicate='within')
-    env.logger.trace(env.gdfBuffersMegaphonesExt)
-    env.logger.trace(env.gdfBuffersMegaphonesExt.dtypes)
+        # Join buffer zones and centers of voxel's squares GeoDataFrames
+        env.gdfBuffersMegaphonesExt = env.gdfCells.sjoin(env.gdfBuffersMegaphonesExt, how='inner',predicate='within')
+        env.logger.trace(env.gdfBuffersMegaphonesExt)
+        env.logger.trace(env.gdfBuffersMegaphonesExt.dtypes)
 
-    # Calculate count of unique cells
-    gdfBuffersMegaphonesExt = env.gdfBuffersMegaphonesExt.groupby(['x','y']).size().reset_index()
-    env.logger.success("{} from {} unique cells in zones of possible audibility", 
-                       env.printLong(len(gdfBuffersMegaphonesExt.index)), env.printLong(len(env.gdfCells.index)))
-    env.logger.success("{} cell-megaphone combinations", env.printLong(len(env.gdfBuffersMegaphonesExt.index)))
+        # Calculate count of unique cells
+        gdfBuffersMegaphonesExt = env.gdfBuffersMegaphonesExt.groupby(['x','y']).size().reset_index()
+        env.logger.success("{} from {} unique cells in zones of possible audibility", 
+                           env.printLong(len(gdfBuffersMegaphonesExt.index)), env.printLong(len(env.gdfCells.index)))
+        env.logger.success("{} cell-megaphone combinations", env.printLong(len(env.gdfBuffersMegaphonesExt.index)))
+        maskZonesExt = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+        maskZonesExt[gdfBuffersMegaphonesExt['x'].to_numpy()*env.bounds[1] + gdfBuffersMegaphonesExt['y'].to_numpy()] = True
+        zonesInt = GetZonesSpans(env.gdfBuffersMegaphonesInt)
+        zonesExt = GetZonesSpans(env.gdfBuffersMegaphonesExt)
+        del gdfBuffersMegaphonesInt
+        del gdfBuffersMegaphonesExt
+
+    # Remove interior cells of buildings and squares under buildings from zones of possible audibility:
+    # zones keep all their cells, the masks of the world's cells mark cells to check
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    maskInt = None
+    maskExt = None
+    if cfg.FacadeMode != 'all':
+        maskInt = modules.buildings.GetFacadeCells()
+        env.logger.success("{} cell-megaphone combinations on facades of buildings", 
+                           env.printLong(sum(np.count_nonzero(maskInt[GetSpansCells(spans, env.bounds[1])]) for spans in zonesInt.values())))
+    if not cfg.flagBuildingSquares:
+        maskExt = uibs < 0
+        env.logger.success("{} cell-megaphone combinations at the streets without buildings", 
+                           env.printLong(sum(np.count_nonzero(maskExt[GetSpansCells(spans, env.bounds[1])]) for spans in zonesExt.values())))
 
     # Allocate memory and store megaphones and their zones
     env.logger.info("Allocate memory and store megaphones and their zones...")
     env.countMegaphones = len(env.gdfMegaphones.index)
     env.leftMegaphones = mp.RawArray(ctypes.c_ubyte, env.countMegaphones)
+    env.MegaphonesPower = mp.RawArray(ctypes.c_float, env.countMegaphones)
+    env.MegaphonesHeight = mp.RawArray(ctypes.c_float, env.countMegaphones)
+    env.MegaphonesAzimuth = mp.RawArray(ctypes.c_float, env.countMegaphones)
+    env.MegaphonesBeamWidth = mp.RawArray(ctypes.c_float, env.countMegaphones)
+    env.MegaphonesRear = mp.RawArray(ctypes.c_float, env.countMegaphones)
+    megaphones = env.gdfMegaphones.drop_duplicates(subset='UIM').set_index('UIM')
+
+    # Megaphones with the same source position are calculated as one source: zones of its horns are united
+    sources = GetMegaphonesSources(megaphones)
+    env.MegaphonesHorns = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    env.MegaphonesHorns_count = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    env.MegaphonesHorns_index = mp.RawArray(ctypes.c_long, env.countMegaphones)
+    countHorns = np.bincount(sources, minlength=env.countMegaphones)
+    np.frombuffer(env.MegaphonesHorns, dtype=ctypes.c_long)[:] = np.argsort(sources, kind='stable')
+    np.frombuffer(env.MegaphonesHorns_count, dtype=ctypes.c_long)[:] = countHorns
+    np.frombuffer(env.MegaphonesHorns_index, dtype=ctypes.c_long)[:] = np.cumsum(countHorns) - countHorns
+    if np.count_nonzero(countHorns > 1) > 0:
+        for zones in (zonesInt, zonesExt):
+            for uim in np.flatnonzero(sources != np.arange(env.countMegaphones)):
+                if uim in zones:
+                    spans = zones.pop(uim)
+                    zones[sources[uim]] = GetSpans(np.union1d(GetSpansCells(zones.get(sources[uim], spans), env.bounds[1]), 
+                                                              GetSpansCells(spans, env.bounds[1])))
+        env.logger.success("{} megaphones merged into {} sources with several horns. {} and {} cell-source combinations left",
+                           env.printLong(int(countHorns[countHorns > 1].sum())), env.printLong(np.count_nonzero(countHorns > 1)),
+                           env.printLong(sum(int(spans[:,2].sum()) for spans in zonesInt.values())),
+                           env.printLong(sum(int(spans[:,2].sum()) for spans in zonesExt.values())))
+
+    # Megaphones and their cells
     env.countMegaphonesCells = len(env.gdfCellsMegaphones.index)
     env.MegaphonesCells = mp.RawArray(ctypes.c_long, env.countMegaphonesCells*env.sizeCell)
     env.MegaphonesCells_count = mp.RawArray(ctypes.c_long, env.countMegaphones)
     env.MegaphonesCells_index = mp.RawArray(ctypes.c_long, env.countMegaphones)
-    env.countMegaphonesBuffersInt = len(env.gdfBuffersMegaphonesInt.index)
-    env.MegaphonesBuffersInt = mp.RawArray(ctypes.c_long, env.countMegaphonesBuffersInt*env.sizeCell)
-    env.MegaphonesBuffersInt_count = mp.RawArray(ctypes.c_long, env.countMegaphones)
-    env.MegaphonesBuffersInt_index = mp.RawArray(ctypes.c_long, env.countMegaphones)
-    env.countMegaphonesBuffersExt = len(env.gdfBuffersMegaphonesExt.index)
-    env.MegaphonesBuffersExt = mp.RawArray(ctypes.c_long, env.countMegaphonesBuffersExt*env.sizeCell)
-    env.MegaphonesBuffersExt_count = mp.RawArray(ctypes.c_long, env.countMegaphones)
-    env.MegaphonesBuffersExt_index = mp.RawArray(ctypes.c_long, env.countMegaphones)
-    env.countChecks = mp.RawArray(ctypes.c_ulonglong, env.countMegaphones)
-    env.madeChecks = mp.RawArray(ctypes.c_ulonglong, env.countMegaphones)
-    env.totalChecks = 0
     indexCells = 0
-    indexBuffersInt = 0
-    indexBuffersExt = 0
     for uim in env.tqdm(range(env.countMegaphones)):
         env.leftMegaphones[uim] = 1
+        env.MegaphonesPower[uim] = megaphones['powerMegaphone'].get(uim, cfg.dBAMegaphone)
+        env.MegaphonesHeight[uim] = megaphones['heightMegaphone'].get(uim, cfg.heightStansaloneMegaphone)
+        env.MegaphonesAzimuth[uim] = megaphones['azimuthMegaphone'].get(uim, 0.0)
+        env.MegaphonesBeamWidth[uim] = megaphones['beamMegaphone'].get(uim, 360.0)
+        env.MegaphonesRear[uim] = megaphones['rearMegaphone'].get(uim, cfg.dBAMegaphoneRear)
         megaphoneCells = env.gdfCellsMegaphones.loc[env.gdfCellsMegaphones['UIM'] == uim]
         env.MegaphonesCells_count[uim] = len(megaphoneCells.index)
         env.MegaphonesCells_index[uim] = indexCells
@@ -169,28 +475,37 @@ def LoadMegaphones():
             env.MegaphonesCells[indexCells+1] = int(cell.y)
             indexCells = indexCells + env.sizeCell
             modules.earth.getGroundHeight(int(cell.x), int(cell.y), None)
-        megaphoneBuffersInt = env.gdfBuffersMegaphonesInt.loc[env.gdfBuffersMegaphonesInt['UIM'] == uim]
-        env.MegaphonesBuffersInt_count[uim] = len(megaphoneBuffersInt.index)
-        env.MegaphonesBuffersInt_index[uim] = indexBuffersInt
-        for cell in megaphoneBuffersInt.itertuples():
-            env.MegaphonesBuffersInt[indexBuffersInt] = int(cell.x)
-            env.MegaphonesBuffersInt[indexBuffersInt+1] = int(cell.y)
-            indexBuffersInt = indexBuffersInt + env.sizeCell
-            modules.earth.getGroundHeight(int(cell.x), int(cell.y), None)
-        megaphoneBuffersExt = env.gdfBuffersMegaphonesExt.loc[env.gdfBuffersMegaphonesExt['UIM'] == uim]
-        env.MegaphonesBuffersExt_count[uim] = len(megaphoneBuffersExt.index)
-        env.MegaphonesBuffersExt_index[uim] = indexBuffersExt
-        for cell in megaphoneBuffersExt.itertuples():
-            env.MegaphonesBuffersExt[indexBuffersExt] = int(cell.x)
-            env.MegaphonesBuffersExt[indexBuffersExt+1] = int(cell.y)
-            indexBuffersExt = indexBuffersExt + env.sizeCell
-            modules.earth.getGroundHeight(int(cell.x), int(cell.y), None)
+        del megaphoneCells
+
+    # Ground levels of all cells of zones of possible audibility
+    env.logger.info("Calculate ground levels of zones of possible audibility...")
+    cells = np.zeros(env.bounds[0]*env.bounds[1], dtype=bool)
+    for zones, mask in ((zonesInt, maskInt), (zonesExt, maskExt)):
+        for spans in zones.values():
+            zone = GetSpansCells(spans, env.bounds[1])
+            cells[zone if mask is None else zone[mask[zone]]] = True
+    cells = np.flatnonzero(cells & (np.frombuffer(env.ground, dtype=ctypes.c_short) < 0))
+    for cell in env.tqdm(cells):
+        modules.earth.getGroundHeight(int(cell // env.bounds[1]), int(cell % env.bounds[1]), None)
+
+    # Only cells of living buildings are checked in zones of possible audibility in the buildings
+    if cfg.BuffersMode == 'raster':
+        buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+        living = (uibs >= 0) & (buildings[np.maximum(uibs, 0),2] > 0)
+        maskInt = living if maskInt is None else maskInt & living
+
+    # Store zones of possible audibility and count checks
+    env.countMegaphonesBuffersInt, env.MegaphonesZonesInt, env.MegaphonesZonesInt_count, env.MegaphonesZonesInt_index, \
+        env.MegaphonesBuffersInt_count, env.maskBuffersInt = StoreZones(zonesInt, maskInt)
+    env.countMegaphonesBuffersExt, env.MegaphonesZonesExt, env.MegaphonesZonesExt_count, env.MegaphonesZonesExt_index, \
+        env.MegaphonesBuffersExt_count, env.maskBuffersExt = StoreZones(zonesExt, maskExt)
+    env.countChecks = mp.RawArray(ctypes.c_ulonglong, env.countMegaphones)
+    env.madeChecks = mp.RawArray(ctypes.c_ulonglong, env.countMegaphones)
+    env.totalChecks = 0
+    for uim in range(env.countMegaphones):
         env.countChecks[uim] = (env.MegaphonesCells_count[uim] * env.MegaphonesBuffersInt_count[uim]) + \
                                (env.MegaphonesCells_count[uim] * env.MegaphonesBuffersExt_count[uim])
         env.totalChecks = env.totalChecks + env.countChecks[uim]
-        del megaphoneCells
-        del megaphoneBuffersInt
-        del megaphoneBuffersExt
     env.logger.success('{} megaphones, {} cells under megaphones stored', 
                        env.printLong(env.countMegaphones), env.printLong(env.countMegaphonesCells) )
     env.logger.success('{} cells under buildings, {} cells at the streets in megaphones zones  of possible audibility stored',  
@@ -200,17 +515,16 @@ def LoadMegaphones():
     # Select livings buffer zone, excluded megaphones potential audibility zone
     if cfg.ShowSquares == 'buffer':
         env.logger.info("Exclude living zones without possible audibility...")
-        gdfLivingWithoutAudibility = env.gdfBuffersLiving.merge(gdfBuffersMegaphonesExt, how='left', on=['x','y'], indicator=True)
-        gdfLivingWithoutAudibility = gdfLivingWithoutAudibility.loc[gdfLivingWithoutAudibility['_merge'] == 'left_only']
-        for cell in env.tqdm(gdfLivingWithoutAudibility.itertuples(), total=len(gdfLivingWithoutAudibility.index)):
-            env.audibility2D[cell.x*env.bounds[1]+cell.y] = -1
+        cells = env.gdfBuffersLiving['x'].to_numpy()*env.bounds[1] + env.gdfBuffersLiving['y'].to_numpy()
+        cells = cells[~maskZonesExt[cells]]
+        np.frombuffer(env.audibility2D, dtype=ctypes.c_byte)[cells] = -1
         env.logger.success('{} from {} living cells excluded', 
-                           env.printLong(len(gdfLivingWithoutAudibility.index)), env.printLong(len(env.gdfBuffersLiving.index)) )
-        del gdfLivingWithoutAudibility
+                           env.printLong(len(cells)), env.printLong(len(env.gdfBuffersLiving.index)) )
 
     # Clear temporary variables
-    del gdfBuffersMegaphonesInt
-    del gdfBuffersMegaphonesExt
+    del megaphones
+    del zonesInt
+    del zonesExt
     gc.collect()
 
 # ============================================
@@ -221,10 +535,11 @@ def LoadMegaphones():
 # glyph - vtkObject object's glyph
 # color - tuple of three float number 0..1 for R,G,B values of color (0% .. 100%)
 # opacity - float number 0..1 for opacity value (0% .. 100%)
+# scales - vtkFloatArray of scales (x,y,z) of each glyph or None to keep the size of the glyph
 # OUT:
 # No return values. Modify variables of environment.py in which VTK objects for further vizualization
 # ============================================
-def VizualizePartOfMegaphones(points, glyph, color, opacity):
+def VizualizePartOfMegaphones(points, glyph, color, opacity, scales=None):
     # Put Voxels on intersection points
     polyDataMegaphones = vtkPolyData()
     polyDataMegaphones.SetPoints(points)
@@ -232,7 +547,13 @@ def VizualizePartOfMegaphones(points, glyph, color, opacity):
     glyphMegaphone = vtk.vtkGlyph3D()
     glyphMegaphone.SetInputData(polyDataMegaphones)
     glyphMegaphone.SetSourceConnection(glyph.GetOutputPort())
-    glyphMegaphone.ScalingOff()
+    if scales is None:
+        glyphMegaphone.ScalingOff()
+    else:
+        # Scale each glyph by components of its vector without rotation
+        polyDataMegaphones.GetPointData().SetVectors(scales)
+        glyphMegaphone.OrientOff()
+        glyphMegaphone.SetScaleModeToScaleByVectorComponents()
     glyphMegaphone.Update()
     env.glphMegaphones.append(glyphMegaphone)
     pointsMapperMegaphones = vtkPolyDataMapper()
@@ -255,7 +576,7 @@ def VizualizeAllMegaphones():
     # Build body of buildings megaphones
     coneMegaphone = vtk.vtkConeSource()
     coneMegaphone.SetDirection(0, 1, 0)
-    coneMegaphone.SetHeight(cfg.sizeVoxel)
+    coneMegaphone.SetHeight(cfg.sizeFloor)
     coneMegaphone.SetRadius(cfg.sizeVoxel/4)
     env.cnMegaphones.append(coneMegaphone)
     VizualizePartOfMegaphones(env.pntsMegaphones_buildings_cones, coneMegaphone, env.Colors.GetColor3d("GreenYellow"), 1.0)
@@ -263,10 +584,11 @@ def VizualizeAllMegaphones():
     # Build body of standalone megaphones
     coneMegaphone = vtk.vtkConeSource()
     coneMegaphone.SetDirection(0, 1, 0)
-    coneMegaphone.SetHeight(cfg.heightStansaloneMegaphone)
+    coneMegaphone.SetHeight(1.0) # Each cone is scaled by the height of its megaphone
     coneMegaphone.SetRadius(cfg.sizeVoxel)
     env.cnMegaphones.append(coneMegaphone)
-    VizualizePartOfMegaphones(env.pntsMegaphones_standalone_cones, coneMegaphone, env.Colors.GetColor3d("GreenYellow"), 1.0)
+    VizualizePartOfMegaphones(env.pntsMegaphones_standalone_cones, coneMegaphone, env.Colors.GetColor3d("GreenYellow"), 1.0,
+                              env.vecMegaphones_standalone_cones)
 
     # Build head of megaphones
     sphereMegaphone = vtk.vtkSphereSource()
@@ -282,5 +604,5 @@ def VizualizeAllMegaphones():
 
     env.writeStat("{} megaphones on {} buildings, {} standalone megaphones".format(
                   env.printLong(env.pntsMegaphones_buildings_cones.GetNumberOfPoints()),
-                  env.countMegaphones - env.pntsMegaphones_standalone_cones.GetNumberOfPoints(),
+                  env.countMegaphones - len(env.sitesCandidates) + len(env.selectedCandidates) - env.pntsMegaphones_standalone_cones.GetNumberOfPoints(),
                   env.printLong(env.pntsMegaphones_standalone_cones.GetNumberOfPoints())) )
\ No newline at end of file
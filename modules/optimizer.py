@@ -0,0 +1,116 @@
+# ============================================
+# Module: Megaphone placement optimizer
+# Coverage of each candidate site is calculated once as the sparse set of covered squares and voxels,
+# then the best sites are selected by unions of these sets without any new calculation of audibility
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import heapq # Priority queue of candidate sites
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Sets of covered squares and voxels
+import geopandas as gpd # For vector objects
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+import modules.megaphones # Show selected megaphones
+import modules.coarse # Voxels of living buildings
+
+
+# ============================================
+# Calculate weights of all squares and voxels in flats:
+# each voxel of the living building has flats/voxels part of flats of its building,
+# each square on the streets has weightOptimizeSquare flats.
+# Squares and voxels are placed in one array: squares at first, voxels after them
+# ============================================
+def GetWeights():
+    countSquares = env.bounds[0]*env.bounds[1]
+    weights = np.zeros(countSquares + env.countVoxels, dtype=np.float32)
+    uibs = np.frombuffer(env.uib, dtype=ctypes.c_long)
+    weights[:countSquares] = np.where(uibs < 0, cfg.weightOptimizeSquare, 0)
+    buildings = np.frombuffer(env.buildings, dtype=ctypes.c_ushort).reshape(-1, env.sizeBuilding)
+    cells, floors, voxels = modules.coarse.GetLivingVoxels(np.flatnonzero(uibs >= 0))
+    flats = buildings[uibs[cells],2] / np.maximum(buildings[uibs[cells],3], 1)
+    weights[countSquares + voxels] = np.repeat(flats, floors)
+    return weights
+
+# ============================================
+# Get sorted indexes of squares and voxels covered by the results of the megaphone:
+# audible squares and voxels or places with sound level over the noise level on the streets
+# ============================================
+def GetCoverage(contribution, flagSoundLevels):
+    squares, values2D, voxels, valuesVoxels = contribution
+    if flagSoundLevels:
+        threshold = (cfg.dBAStreet+cfg.dBALevel)*100
+    else:
+        threshold = 1
+    return np.unique(np.concatenate((squares[values2D >= threshold],
+                                     env.bounds[0]*env.bounds[1] + voxels[valuesVoxels >= threshold])))
+
+# ============================================
+# Select the best candidate sites one by one by the greatest weight of new covered squares and voxels.
+# Weight of new coverage can only decrease when other sites are selected,
+# so stale weights in the priority queue are upper bounds and only the top of the queue is recalculated (lazy greedy)
+# Returns list of tuples: UIM and weight of new coverage
+# ============================================
+def SelectCandidates(coverages, covered, weights, count):
+    queue = [(-weights[coverage].sum(), uim) for uim, coverage in coverages.items()]
+    heapq.heapify(queue)
+    selected = []
+    while (len(selected) < count) and (len(queue) > 0):
+        _, uim = heapq.heappop(queue)
+        coverage = coverages[uim]
+        gain = weights[coverage[~covered[coverage]]].sum()
+        if (len(queue) > 0) and (gain < -queue[0][0]):
+            heapq.heappush(queue, (-gain, uim))
+            continue
+        if gain <= 0:
+            break
+        covered[coverage] = True
+        selected.append((uim, gain))
+    return selected
+
+# ============================================
+# Select the best candidate sites of new megaphones by their results and coverage of other megaphones.
+# IN: dict UIM: results of the candidate site (indexes of squares, its values, indexes of voxels, its values)
+# OUT: list of UIMs of selected candidate sites
+# ============================================
+def OptimizeMegaphones(candidates, flagSoundLevels):
+    env.logger.info("Select {} from {} candidate sites of new megaphones...", cfg.countOptimizeMegaphones, len(candidates))
+    weights = GetWeights()
+
+    # Places just covered by other megaphones
+    if flagSoundLevels:
+        covered = np.concatenate((np.frombuffer(env.levels2D, dtype=ctypes.c_ushort),
+                                  np.frombuffer(env.levelsVoxels, dtype=ctypes.c_ushort))) >= (cfg.dBAStreet+cfg.dBALevel)*100
+    else:
+        covered = np.concatenate((np.frombuffer(env.audibility2D, dtype=ctypes.c_byte),
+                                  np.frombuffer(env.audibilityVoxels, dtype=ctypes.c_byte))) > 0
+    env.logger.success("{} flats are covered by other megaphones", f'{weights[covered].sum():.0f}')
+
+    # Select the best sites
+    coverages = {uim: GetCoverage(contribution, flagSoundLevels) for uim, contribution in candidates.items()}
+    selected = SelectCandidates(coverages, covered, weights, cfg.countOptimizeMegaphones)
+    total = 0
+    for order, (uim, gain) in enumerate(selected):
+        total = total + gain
+        env.logger.success("Site #{}: candidate {} at {} covers {} new flats, {} new flats in total", order+1, uim,
+                           env.sitesCandidates[uim], f'{gain:.0f}', f'{total:.0f}')
+        for points in env.pointsCandidates[uim]:
+            modules.megaphones.InsertMegaphonePoints(points)
+    if len(selected) < cfg.countOptimizeMegaphones:
+        env.logger.warning("Only {} sites cover new flats", len(selected))
+
+    # Save selected sites
+    if len(selected) > 0:
+        gdfSelected = gpd.GeoDataFrame({'order': np.arange(len(selected))+1,
+                                        'flats': [round(float(gain), 1) for uim, gain in selected]},
+                                       geometry=gpd.points_from_xy([env.sitesCandidates[uim][0] for uim, gain in selected],
+                                                                   [env.sitesCandidates[uim][1] for uim, gain in selected]))
+        gdfSelected.to_file(Path('.', cfg.folderOUTPUT, 'optimized.geojson'), driver='GeoJSON')
+    env.selectedCandidates = [uim for uim, gain in selected]
+    return env.selectedCandidates
@@ -0,0 +1,89 @@
+# ============================================
+# Module: Statistics of audibility calculation
+# Counters of the C library are collected for each megaphone in shared memory
+# and saved to tune sizeStep and distancePossibleAudibility by real data
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import json # Save summary of statistics
+from pathlib import Path # Crossplatform pathing
+import numpy as np # Sum statistics of megaphones
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+import modules.environment as env # Environment defenition
+
+# Reasons to finish the check of audibility in the same order as in the C library
+ExitReasons = ['audible', 'distance', 'same_building', 'terrain', 'building', 'clear', 'known']
+
+
+# ============================================
+# Get labels of bins of the histogram of steps: 0, 1, 2-3, 4-7, ..., the last bin has no upper limit
+# ============================================
+def GetBinsLabels(countBins):
+    labels = ['0']
+    for bin in range(1, countBins):
+        low = 2**(bin-1)
+        high = 2**bin - 1
+        if bin == countBins-1:
+            labels.append(f'{low}+')
+        elif low == high:
+            labels.append(f'{low}')
+        else:
+            labels.append(f'{low}-{high}')
+    return labels
+
+# ============================================
+# Save statistics of audibility calculation of each megaphone to CSV file
+# and summary of all megaphones to JSON file in folderOUTPUT
+# Each row of statistics: nanoseconds, total steps, counts of checks for each reason, histogram of steps of segments
+# ============================================
+def SaveAudibilityStats():
+    stats = np.frombuffer(env.audibilityStats, dtype=ctypes.c_ulonglong).reshape(env.countMegaphones, -1)
+    countExits = len(ExitReasons)
+    labels = GetBinsLabels(stats.shape[1] - 2 - countExits)
+    seconds = stats[:,0] / 1e9
+    checks = stats[:,2:2+countExits].sum(axis=1)
+    totals = stats.sum(axis=0)
+
+    # Statistics of each megaphone
+    with open(Path('.', cfg.folderOUTPUT, 'audibility_stats.csv'), 'w') as file:
+        file.write(','.join(['uim', 'seconds', 'checks', 'steps'] +
+                            [f'exit_{reason}' for reason in ExitReasons] +
+                            [f'steps_{label}' for label in labels]) + "\n")
+        for uim in range(env.countMegaphones):
+            file.write(','.join([str(uim), f'{seconds[uim]:.6f}', str(checks[uim])] +
+                                [str(value) for value in stats[uim,1:]]) + "\n")
+
+    # Summary of all megaphones
+    slowest = np.argsort(-seconds)[:10]
+    summary = {
+        'settings': {'TraversalMode': cfg.TraversalMode, 'sizeStep': cfg.sizeStep,
+                     'SquaresMode': cfg.SquaresMode, 'VoxelsMode': cfg.VoxelsMode,
+                     'distancePossibleAudibilityInt': cfg.distancePossibleAudibilityInt,
+                     'distancePossibleAudibilityExt': cfg.distancePossibleAudibilityExt},
+        'seconds': float(seconds.sum()),
+        'checks': int(checks.sum()),
+        'steps': int(totals[1]),
+        'segments': int(totals[2+countExits:].sum()),
+        'exits': {reason: int(totals[2+k]) for k, reason in enumerate(ExitReasons)},
+        'histogram': {label: int(totals[2+countExits+k]) for k, label in enumerate(labels)},
+        'slowest': [{'uim': int(uim), 'seconds': float(seconds[uim]), 'checks': int(checks[uim]),
+                     'steps': int(stats[uim,1])} for uim in slowest if seconds[uim] > 0]
+    }
+    with open(Path('.', cfg.folderOUTPUT, 'audibility_stats.json'), 'w') as file:
+        json.dump(summary, file, indent=4)
+
+    # Show summary
+    env.logger.success("Statistics of audibility calculation: {} checks, {} segments, {} steps, {} seconds of tasks",
+                       env.printLong(summary['checks']), env.printLong(summary['segments']),
+                       env.printLong(summary['steps']), f'{summary["seconds"]:.1f}')
+    env.logger.info("Reasons to finish checks: {}", ', '.join(f'{reason} {count/max(summary["checks"],1):.1%}'
+                                                         for reason, count in summary['exits'].items()))
+    if len(summary['slowest']) > 0:
+        env.logger.info("The slowest megaphone #{}: {} seconds", summary['slowest'][0]['uim'],
+                        f'{summary["slowest"][0]["seconds"]:.1f}')
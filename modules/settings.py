@@ -12,6 +12,9 @@ folderDEM = 'DEM' # Subfolder (in current folder) with DEM tiles (.tif)
 folderBUILDINGS = 'BUILDINGS' # Subfolder (in current folder) with vector buildings polygones (.geojson)
 folderMEGAPHONES = 'MEGAPHONES' # Subfolder (in current folder) with vector megaphones points (.geojson)
 folderOUTPUT = 'OUTPUT' # Subfolder (in current folder) with output files
+folderCANDIDATES = 'CANDIDATES' # Subfolder (in current folder) with vector candidate sites of new megaphones points (.geojson)
+folderCHECKPOINT = 'CHECKPOINT' # Subfolder (in current folder) with checkpoint of audibility calculation (.npz)
+folderCACHE = 'CACHE' # Subfolder (in current folder) with cached audibility of megaphones (.npz)
 
 # Debug log detail level, from verbose to terse:
 # "TRACE" or "DEBUG" or "INFO" or "SUCCESS" or "WARNING" or "ERROR" or "CRITICAL"
@@ -21,13 +24,15 @@ logLevel = "INFO"
 # Quality of world's detail
 # ============================================
 
-# Voxel's edge size, meter. Default value is 3 meter - approximately one floor
+# Horizontal voxel's edge size: the cell of the world's grid, meter. Default value is 3 meter - approximately one floor.
+# Large areas can be calculated with coarse cells (e.g. 6 meters - 4 times less cells), voxels still have one floor height
 sizeVoxel = 3
 
 # The gap between voxels, meter. Default value is 0.5 meter
 gapVoxel = 0.5
 
-# Floor size, meter.  Default value is 3 meter
+# Floor size: the vertical voxel's edge size, meter. Each floor of buildings is one voxel, 
+# heights of the ground and megaphones are rounded to floors. Default value is 3 meter
 sizeFloor = 3
 
 # How many pixeles get out of box border. Increase it to prevent blank lines on raster's or DEMs seams. Default value is 3 px
@@ -77,6 +82,37 @@ heightStansaloneMegaphone = 9
 # Recomended value: 120 dBA: the maximum sound level that does not harm a human
 dBAMegaphone = 120
 
+# Names of optional attributes of megaphones points in vector files of folderMEGAPHONES and folderCANDIDATES:
+# sound power of the megaphone, dBA, and height of the standalone megaphone, meters. 
+# Zones of possible audibility are calculated for each megaphone by its own sound power, 
+# megaphones without these attributes use dBAMegaphone and heightStansaloneMegaphone. 
+# Default values are 'power' and 'height'
+fieldMegaphonePower = 'power'
+fieldMegaphoneHeight = 'height'
+
+# Names of optional attributes of directional megaphones (horn loudspeakers) in the same vector files:
+# azimuth of the axis of the horn, degrees clockwise from the north, width of its beam, degrees, 
+# and sound decline behind the beam, dBA. Megaphones without azimuth are omnidirectional.
+# Zones of possible audibility of directional megaphones are sectors of the beam and short rear lobes around them.
+# Default values are 'azimuth', 'beamwidth' and 'rear'
+fieldMegaphoneAzimuth = 'azimuth'
+fieldMegaphoneBeamWidth = 'beamwidth'
+fieldMegaphoneRear = 'rear'
+
+# Default width of the beam of directional megaphone, degrees. Default value is 90 degrees
+BeamWidthMegaphone = 90
+
+# Default sound decline behind the beam of directional megaphone, dBA. Default value is -20 dBA.
+# Recomended values: -20 dBA for horn loudspeakers, -10 dBA for column loudspeakers
+dBAMegaphoneRear = -20
+
+# Calculate megaphones with the same source position (the same cells, height and sound power), e.g. 2-4 horns
+# on the same roof or mast, as one source: segments from the source are traced once and each square or voxel
+# gets the best of its horns. Original UIMs of merged megaphones are kept for reporting, coverage and statistics 
+# are counted for the source under the lowest UIM of its horns. Candidate sites of the optimizer are never merged.
+# Default value is False
+flagMergeMegaphones = False
+
 # Average sound decline, when passing through the standart window, dBA. 
 # Recomended values: -30 dBA for good windows, -25 dBA - windows of average quality
 dBAWindow = -25
@@ -93,16 +129,197 @@ dBAHome = 30
 # Recomended value: +15 dBA
 dBALevel = +15
 
+# Store the continuous field of maximum sound levels of squares and voxels instead of audibility codes only.
+# Audibility codes are found by fast classification of the stored levels after calculation, 
+# so several profiles of noise levels are checked by one calculation. Requires additional memory: 
+# 2 bytes per square and voxel. Levels are saved to levels.npz in folderOUTPUT. Default value is False
+flagSoundLevels = False
+
+# Profiles of noise levels to check with flagSoundLevels = True: name: (dBAStreet, dBAHome).
+# Zones of possible audibility are calculated for the most permissive profile.
+# Audibility codes of squares and voxels are shown for dBAStreet and dBAHome values above.
+# Default value is {'day': (55, 40), 'night': (45, 30)}
+SoundLevelProfiles = {'day': (55, 40), 'night': (45, 30)}
+
+# The lowest noise levels used to find zones of possible audibility, dBA
+dBAStreetMin = min([dBAStreet] + [street for street, home in SoundLevelProfiles.values()]) if flagSoundLevels else dBAStreet
+dBAHomeMin = min([dBAHome] + [home for street, home in SoundLevelProfiles.values()]) if flagSoundLevels else dBAHome
+
 # Max distance between megaphone and point, where theoretically is possible an audibility, meters. 
 # Used to speed up and facilitate calculations. Default value is 1000 meters.
-distancePossibleAudibilityInt = math.pow(10, (dBAMegaphone+dBAWindow-dBAHome-dBALevel)/20) # in the buildings
-distancePossibleAudibilityExt = math.pow(10, (dBAMegaphone-dBAStreet-dBALevel)/20) # on the streets
+# Values for megaphones with dBAMegaphone sound power, distances of other megaphones are found by their own sound power
+distancePossibleAudibilityInt = math.pow(10, (dBAMegaphone+dBAWindow-dBAHomeMin-dBALevel)/20) # in the buildings
+distancePossibleAudibilityExt = math.pow(10, (dBAMegaphone-dBAStreetMin-dBALevel)/20) # on the streets
 
 # Step size to check audibility of voxels, part of voxels count along the longest axis distance. 
 # Maximum value is 1.0. Smaller values lead to more accurate, but longer calculations. Default value is 1.0
+# Used with TraversalMode = 'step'
 sizeStep = 1.0
 
+# Select mode to walk along the segment between megaphone and checked voxel:
+# 'step' - fixed steps of sizeStep voxels along the longest axis. Cells can be visited several times or skipped.
+# 'grid' - exact traversal: each (x,y) cell crossed by the segment is checked exactly once 
+#          at the lowest point of the segment inside this cell. sizeStep is not used.
+# Default value is 'step'
+TraversalMode = 'step'
+
+# Use hierarchical pyramid of obstacles heights: cells lower than the segment are skipped without reading of buildings,
+# with TraversalMode = 'grid' whole blocks of such cells are skipped. It is also used by PacketMode.
+# Results are the same, but long segments over low-rise areas are checked faster.
+# Requires additional memory: 2 bytes per cell plus 1/3 for all levels. Default value is False
+flagHeightPyramid = False
+
+# Select SIMD instructions to walk segments with TraversalMode = 'step' in packets of 8 segments of the same megaphone cell:
+# 'auto' - the best instructions of the CPU (AVX-512 or AVX2), chosen at loading of the library
+# 'avx2' - AVX2 instructions, even if the CPU supports AVX-512
+# 'none' - walk each segment separately
+# Results are the same. Packets use the pyramid of obstacles heights (flagHeightPyramid = True) 
+# and are not used with flagSoundLevels and flagAudibilityStats. Default value is 'none'
+PacketMode = 'none'
+
+# Select mode to calculate audibility of the earth's surface squares on the streets:
+# 'rays' - trace a separate segment from each megaphone to each square of its zone of possible audibility
+# 'sweep' - find visibility of all squares around each megaphone in one radial sweep, 
+#           carrying the maximum elevation angle of the earth's surface and buildings from the megaphone outward.
+#           Much faster for large zones, but less accurate. Squares under buildings are still checked by 'rays'
+# Default value is 'rays'
+SquaresMode = 'rays'
+
+# Select mode to calculate audibility of the buildings voxels:
+# 'rays' - trace a separate segment from each megaphone to each floor of the building
+# 'column' - walk the (x, y) path to the building column only once and find the lowest floor with line of sight, 
+#            all higher floors are visible too. Results are the same with TraversalMode = 'grid', 
+#            with TraversalMode = 'step' the smallest step among all floors is used
+# Default value is 'rays'
+VoxelsMode = 'rays'
+
+# Select cells of living buildings to calculate audibility of their voxels:
+# 'all' - all cells of buildings
+# 'inherit' - only facades: cells, which touch a cell without buildings by the side. Each floor of interior cells 
+#             inherits the best result of the same floor of facades of its building
+# 'exclude' - only facades. Voxels of interior cells without windows are not calculated and are non-audibility
+# Large blocks and malls have much less checks with 'inherit' and 'exclude'. Default value is 'all'
+FacadeMode = 'all'
+
+# Calculate audibility of squares under buildings. With False they are removed from zones of possible audibility 
+# at the streets and are not shown. Default value is True
+flagBuildingSquares = True
+
+# Select mode to locate cells of zones of possible audibility of megaphones:
+# 'sjoin' - spatial join of centers of all cells of the world and polygons of zones. Tables of all cell-megaphone 
+#           combinations with attributes of megaphones and their buildings need tens of GB for hundreds of megaphones
+# 'raster' - rasterize the polygon of each zone in its bounding box straight into spans of rows of cells (the same cells).
+#            Only cells of living buildings are marked in zones in the buildings, other cells are never counted there.
+# Both modes store only spans of rows of cells (x, first y, count of cells) of zones in the shared memory, 
+# cells of zones are enumerated by the calculation itself
+# Default value is 'sjoin'
+BuffersMode = 'sjoin'
+
+# Select mode to store results of parallel processes into the shared memory:
+# 'shared' - each check reads and writes shared arrays directly. Concurrent writes of overlapping megaphones zones 
+#            can overwrite better results, so results can depend on timing
+# 'private' - each task accumulates results in its own buffers and merges them into shared arrays 
+#            at the end of the task with atomic operations. Results are the same for any count of CPU cores
+# Default value is 'shared'
+AudibilityMergeMode = 'shared'
+
+# Select engine to calculate audibility:
+# 'c' - compiled shared library audibility.so
+# 'numpy' - vectorized NumPy engine: all segments of the megaphone are processed as arrays in batches. 
+#           Results are the same, runs wherever NumPy runs. Supports only SquaresMode = 'rays', 
+#           VoxelsMode = 'column' is supported only with TraversalMode = 'grid'
+# Default value is 'c'
+AudibilityEngine = 'c'
+
+# Count of segments processed at once by vectorized engine. Larger values need more memory. Default value is 65536
+VectorizedBatchSize = 65536
+
+# Select backend to run audibility calculation in parallel:
+# 'processes' - pool of processes. Each process maps shared memory and loads the library on its own
+# 'threads' - pool of threads in the current process: no processes spawn, no mapping of shared memory and lower memory usage. 
+#             The C library releases GIL, so threads run in parallel. Vectorized engine runs in parallel only partially
+# Default value is 'processes'
+AudibilityBackend = 'processes'
+
+# Count of CPU cores (processes or threads) to calculate audibility. 0 - all CPU cores of the computer. Default value is 0
+AudibilityCores = 0
+
+# How many tasks for each CPU core the audibility calculation is divided into. 
+# Cost of each megaphone is estimated as sum of lengths of its segments. Large megaphones are divided into several tasks 
+# by ranges of cells of their buffers, so all CPU cores stay busy until the end. Default value is 4
+AudibilityTasksPerCore = 4
+
+# Store results of each megaphone in folderCACHE and use them at the next runs. Only new or moved megaphones 
+# (or megaphones with changed buildings and earth's surface in their zones) are calculated again, 
+# results of others are merged from the cache. Each megaphone is calculated without results of other megaphones,
+# so the first run is longer. Delete folderCACHE to clear the cache. Default value is False
+flagAudibilityCache = False
+
+# Interval between checkpoints of audibility calculation, seconds. 0 - checkpoints are not saved.
+# Checkpoint keeps results of finished megaphones in folderCHECKPOINT. Set it (e.g. 600 seconds) for long calculations:
+# if the calculation was interrupted, run urbanmegaphone.py --resume with the same input files and settings 
+# to calculate only unfinished megaphones. Checkpoint is deleted after the calculation is finished. Default value is 0
+intervalCheckpoint = 0
+
+# Collect statistics of the C library during audibility calculation: histogram of steps along segments, 
+# reasons to finish checks (already audible, distance, same building, terrain, building, clear segment, known visibility) 
+# and time of calculation of each megaphone. Statistics are saved to audibility_stats.json and audibility_stats.csv 
+# in folderOUTPUT and help to tune sizeStep and distancePossibleAudibility. Used with AudibilityEngine = 'c'. 
+# Calculation is a bit slower. Default value is False
+flagAudibilityStats = False
+
+# Count megaphones covering each square and voxel (k-coverage) in the same run with audibility calculation.
+# Places are covered as in the optimizer: audible squares and voxels or places with sound level over the noise level on the streets.
+# Each megaphone is calculated without results of other megaphones (as with flagAudibilityCache), so calculation is a bit longer.
+# Counts are saved to coverage.npz in folderOUTPUT with reports of places covered by the only megaphone 
+# (coverage_megaphones.csv) and redundancy of living buildings (coverage_buildings.csv). 
+# Used with AudibilityEngine = 'c'. 1 byte per square and voxel. Default value is False
+flagCoverage = False
+
+# Find the strongest megaphone of each square and voxel with flagCoverage = True: the megaphone with the maximum
+# sound level (flagSoundLevels = True) or the best audibility code, the lowest UIM of equal megaphones.
+# It is needed to find places, which go silent if one megaphone fails. 4 bytes per square and voxel. Default value is True
+flagStrongestMegaphone = True
+
+# Size of cells of the coarse grid for coarse-to-fine audibility calculation, meters. 0 - calculate all cells.
+# At first audibility is calculated only for one cell in the center of each coarse cell. Coarse cells, where
+# this cell and cells of all neighbours have the same audibility code of squares and voxels, get this code at once,
+# only other areas (boundaries of audibility and tall buildings) are calculated cell by cell.
+# Small shadows between cells of the coarse grid may be lost. Not used with flagSoundLevels, flagCoverage and optimizer.
+# Recomended value: 4*sizeVoxel for suburban and rural areas. Default value is 0
+sizeCoarseCell = 0
+
+# Buildings higher than this height are tall obstacles: areas around them are always calculated cell by cell, meters.
+# Default value is 12 meters
+heightObstacleCoarse = 12
+
+# Count of samples to estimate shares of audible flats, voxels and squares instead of the full calculation. 0 - estimate is off.
+# Stratified random sample of cells of living buildings (weighted by flats) and the same count of squares is calculated, 
+# shares are written to result.txt with confidence intervals. Squares and voxels are not shown.
+# 10000 samples give about ±1% at 95% confidence. Default value is 0
+countEstimateSamples = 0
+
+# Seed of the random generator of samples of the estimate: the same seed gives the same samples and estimates 
+# for the same world. None - new samples at each run. Default value is 0
+seedEstimate = 0
+
+# Confidence level of intervals of estimates. Default value is 0.95
+levelEstimateConfidence = 0.95
+
 # Real calculate audibility of voxels. Default value is True
 # For debug purposes you can set it to False,
 # then all voxels and squares in the distancePossibleAudibility will be marked as audible
-flagCalculateAudibility = True  
\ No newline at end of file
+flagCalculateAudibility = True
+
+
+# Megaphone placement optimizer
+# ============================================
+
+# Count of new megaphones to select from candidate sites of folderCANDIDATES. 0 - optimizer is off.
+# Coverage of each candidate site is calculated once, without results of other megaphones. 
+# Then the best sites are selected one by one by the greatest count of new covered flats (lazy greedy search). 
+# Selected sites are shown with megaphones and saved to optimized.geojson in folderOUTPUT. Default value is 0
+countOptimizeMegaphones = 0
+
+# Weight of each audible square on the streets in the optimizer, flats. Default value is 0: only flats are covered
+weightOptimizeSquare = 0
@@ -0,0 +1,313 @@
+# ============================================
+# Module: Vectorized audibility calculation with NumPy
+# The same algorithms as in audibility.c shared library, but all segments
+# from the megaphone cell to the destinations of the task are processed as arrays in batches
+# ============================================
+
+# Modules import
+# ============================================
+
+# Standart modules
+import ctypes # Use primitive datatypes for multiprocessing data exchange
+import numpy as np # Vectorized calculations
+
+# Own core modules
+import modules.settings as cfg # Settings defenition
+
+
+# ============================================
+# Initialize vectorized engine in the current process:
+# store NumPy views of shared memory arrays in global variables of this module
+# ============================================
+def InitializeEngine(pBoundsY, pGround, pAudibility2D, pUIB, pVoxelIndex,
+                     pAudibilityVoxels, pBuildingsSize, pBuildings, pMadeChecks, pMergeLock):
+    global boundsY, ground, audibility2D, uibs, VoxelIndex, \
+           audibilityVoxels, buildingsSize, buildings, madeChecks, mergeLock
+    boundsY = pBoundsY # integer
+    ground = np.frombuffer(pGround, dtype=ctypes.c_short)
+    audibility2D = np.frombuffer(pAudibility2D, dtype=ctypes.c_byte)
+    uibs = np.frombuffer(pUIB, dtype=ctypes.c_long)
+    VoxelIndex = np.frombuffer(pVoxelIndex, dtype=ctypes.c_ulong)
+    audibilityVoxels = np.frombuffer(pAudibilityVoxels, dtype=ctypes.c_byte)
+    buildingsSize = pBuildingsSize # integer
+    buildings = np.frombuffer(pBuildings, dtype=ctypes.c_ushort)
+    madeChecks = np.frombuffer(pMadeChecks, dtype=ctypes.c_ulonglong)
+    mergeLock = pMergeLock # multiprocessing lock for merging results into shared memory
+
+    # Height of obstacle in each cell: the first voxel over the building or the earth's surface -1
+    global obstacleTops
+    obstacleTops = ground.astype(np.int32) - 1 # -1 for smoothing out the steps of the earth's surface
+    building = np.flatnonzero(uibs >= 0)
+    uib = uibs[building]
+    if cfg.BuildingGroundMode == 'levels':
+        obstacleTops[building] = ground[building].astype(np.int32) + buildings[uib*buildingsSize]
+    else:
+        obstacleTops[building] = buildings[uib*buildingsSize+1].astype(np.int32) + buildings[uib*buildingsSize]
+
+# ============================================
+# Round half away from zero, as round() function of C language.
+# numpy.round() rounds half to even, so it can not be used
+# ============================================
+def RoundC(value):
+    absolute = np.abs(value)
+    rounded = np.floor(absolute)
+    rounded = rounded + ((absolute - rounded) >= 0.5)
+    return np.copysign(rounded, value).astype(np.int64)
+
+# ============================================
+# Retrieve vertical coordinates of the first voxels of buildings uib in (x, y) cells
+# ============================================
+def GetFirstBuildingVoxel(x, y, uib):
+    if cfg.BuildingGroundMode == 'levels':
+        return ground[x*boundsY+y].astype(np.int64)
+    return buildings[uib*buildingsSize+1].astype(np.int64)
+
+# ============================================
+# Check if the intermediate voxels (x, y, z) are obstacles for the sound:
+# they are inside extraneous buildings (not the source and not the destination one) or under the earth's surface
+# ============================================
+def IsObstacle(x, y, z, uibDst, uibSrc):
+    idx = x*boundsY+y
+    obstacle = z < obstacleTops[idx]
+    if np.any(obstacle):
+        # Source and destination buildings are not obstacles
+        uib = uibs[idx[obstacle]]
+        obstacle[obstacle] = (uib < 0) | ((uib != uibSrc) & (uib != uibDst[obstacle]))
+    return obstacle
+
+# ============================================
+# Walk along segments with fixed steps of sizeStep voxels along the longest axis.
+# Returns mask of segments without obstacles
+# ============================================
+def TraceSegmentsStep(xDst, yDst, zDst, uibDst, xSrc, ySrc, zSrc, uibSrc, sizeStep):
+    dx = (xDst - xSrc).astype(np.float64)
+    dy = (yDst - ySrc).astype(np.float64)
+    dz = (zDst - zSrc).astype(np.float64)
+    step = sizeStep / np.fmax(np.fmax(np.abs(dx), np.abs(dy)), np.abs(dz))
+    visible = np.ones(len(dx), dtype=bool)
+    active = np.arange(len(dx))
+    t = np.zeros(len(dx))
+    while len(active) > 0:
+        x = RoundC(xSrc + t * dx[active])
+        y = RoundC(ySrc + t * dy[active])
+        z = RoundC(zSrc + t * dz[active])
+        blocked = IsObstacle(x, y, z, uibDst[active], uibSrc)
+        visible[active[blocked]] = False
+        t = t + step[active]
+        left = (~blocked) & (t <= 1.0)
+        active = active[left]
+        t = t[left]
+    return visible
+
+# ============================================
+# Walk along segments through each (x, y) cell crossed by them exactly once,
+# checking the lowest point of the segment inside this cell.
+# Returns mask of segments without obstacles
+# ============================================
+def TraceSegmentsGrid(xDst, yDst, zDst, uibDst, xSrc, ySrc, zSrc, uibSrc):
+
+    # Nested function to calculate the parameter t of segments at the exit of the current cells
+    def GetExit(kx, ky, adx2, ady2):
+        tX = np.where(adx2 > 0, (2.0 * kx + 1.0) / np.maximum(adx2, 1.0), 1.0)
+        tY = np.where(ady2 > 0, (2.0 * ky + 1.0) / np.maximum(ady2, 1.0), 1.0)
+        return np.minimum(np.fmin(tX, tY), 1.0)
+
+    # Constant parameters of segments
+    ids = np.arange(len(xDst))
+    dz = (zDst - zSrc).astype(np.float64)
+    xEnd = xDst.astype(np.int64)
+    yEnd = yDst.astype(np.int64)
+    stepX = np.sign(xEnd - xSrc)
+    stepY = np.sign(yEnd - ySrc)
+    adx = np.abs(xEnd - xSrc)
+    ady = np.abs(yEnd - ySrc)
+    adx2 = 2.0 * adx
+    ady2 = 2.0 * ady
+
+    # Traversal state of segments
+    x = np.full(len(xDst), xSrc, dtype=np.int64)
+    y = np.full(len(xDst), ySrc, dtype=np.int64)
+    kx = np.zeros(len(xDst), dtype=np.int64)
+    ky = np.zeros(len(xDst), dtype=np.int64)
+    errX = ady.copy()
+    errY = adx.copy()
+    tIn = np.zeros(len(xDst))
+    tOut = GetExit(kx, ky, adx2, ady2)
+    alive = np.ones(len(xDst), dtype=bool)
+
+    visible = np.ones(len(xDst), dtype=bool)
+    while True:
+        z = RoundC(zSrc + np.where(dz > 0, tIn, tOut) * dz)
+        blocked = IsObstacle(x, y, z, uibDst, uibSrc) & alive
+        visible[ids[blocked]] = False
+
+        # Go to the next cell, if it is not the last one
+        alive = alive & ~blocked & ((x != xEnd) | (y != yEnd))
+        countAlive = np.count_nonzero(alive)
+        if countAlive == 0:
+            break
+        if countAlive < len(alive) // 2:
+            # Remove finished segments from arrays
+            ids, dz, xEnd, yEnd, stepX, stepY, adx, ady, adx2, ady2, uibDst = \
+                ids[alive], dz[alive], xEnd[alive], yEnd[alive], stepX[alive], stepY[alive], \
+                adx[alive], ady[alive], adx2[alive], ady2[alive], uibDst[alive]
+            x, y, kx, ky, errX, errY, tOut = \
+                x[alive], y[alive], kx[alive], ky[alive], errX[alive], errY[alive], tOut[alive]
+            alive = np.ones(countAlive, dtype=bool)
+        moveX = (errX <= errY) & alive
+        moveY = (errX >= errY) & alive
+        x = x + stepX * moveX
+        kx = kx + moveX
+        errX = errX + 2 * ady * moveX
+        y = y + stepY * moveY
+        ky = ky + moveY
+        errY = errY + 2 * adx * moveY
+        tIn = tOut
+        tOut = GetExit(kx, ky, adx2, ady2)
+    return visible
+
+# ============================================
+# Check audibility on destination voxels (xDst, yDst, zDst) with UIBs uibDst
+# from megaphone on source voxel (xSrc, ySrc, zSrc) with UIB uibSrc. Distances are in horizontal voxel's edges:
+# differences of z-coordinates (floors) are scaled by sizeFloor / sizeVoxel.
+# Returns new audibility values based on previous values prev
+# ============================================
+def CheckAudibility(xDst, yDst, zDst, uibDst, xSrc, ySrc, zSrc, uibSrc, prev, sizeStep, possibleDistanceInt):
+    dx = (xDst - xSrc).astype(np.float64)
+    dy = (yDst - ySrc).astype(np.float64)
+    dz = (zDst - zSrc).astype(np.float64) * float(np.float32(cfg.sizeFloor / cfg.sizeVoxel))
+    distance = np.sqrt(dx * dx + dy * dy + dz * dz)
+    target = np.where(distance <= possibleDistanceInt, 2, 1).astype(np.int8)
+
+    # Voxels, which can not be improved or do not need any checks
+    result = prev.copy()
+    keep = (prev > 1) | ((distance > possibleDistanceInt) & (prev > 0))
+    done = keep.copy()
+    result[~keep & (distance == 0)] = 2
+    done = done | (distance == 0)
+    if not cfg.flagCalculateAudibility:
+        result[~done] = target[~done]
+        return result
+    if uibSrc >= 0:
+        common = ~done & (uibDst == uibSrc)
+        result[common] = target[common]
+        done = done | common
+
+    # Walk along segments in batches
+    check = np.flatnonzero(~done)
+    for first in range(0, len(check), cfg.VectorizedBatchSize):
+        batch = check[first:first+cfg.VectorizedBatchSize]
+        if cfg.TraversalMode == 'step':
+            visible = TraceSegmentsStep(xDst[batch], yDst[batch], zDst[batch], uibDst[batch],
+                                        xSrc, ySrc, zSrc, uibSrc, sizeStep)
+        else:
+            visible = TraceSegmentsGrid(xDst[batch], yDst[batch], zDst[batch], uibDst[batch],
+                                        xSrc, ySrc, zSrc, uibSrc)
+        result[batch] = np.where(visible, target[batch], np.where(prev[batch] > 0, prev[batch], -1))
+    return result
+
+# ============================================
+# Restrict destination cells (xDst, yDst) to the beams of the horns of the directional megaphone on source cell (xSrc, ySrc)
+# and the short rear lobes behind them, as apply_beam() function of C shared library.
+# horns is list of tuples: azimuth of the beam, degrees clockwise from the north, width of the beam, degrees, 
+# and sound decline behind the beam, dBA. Each destination gets the best of horns.
+# Returns mask of reachable destinations and their max distances of possible audibility in the buildings
+# ============================================
+def ApplyBeam(xDst, yDst, xSrc, ySrc, possibleDistanceInt, possibleDistanceExt, horns):
+    if any(not (0 < beamwidth < 360) for _, beamwidth, _ in horns):
+        return np.ones(len(xDst), dtype=bool), np.full(len(xDst), possibleDistanceInt)
+    dx = (xDst - xSrc).astype(np.float64)
+    dy = (yDst - ySrc).astype(np.float64)
+    bearing = np.degrees(np.arctan2(dx, -dy)) # The north is directed against the y axis of the world
+    inBeam = (dx == 0) & (dy == 0)
+    for azimuth, beamwidth, _ in horns:
+        inBeam = inBeam | (np.abs(np.fmod(bearing - azimuth + 540.0, 360.0) - 180.0) <= beamwidth / 2.0)
+    rear = max(rear for _, _, rear in horns)
+    factor = np.where(inBeam, 1.0, 10.0**(rear / 20.0))
+    return np.hypot(dx, dy) <= possibleDistanceExt * factor, np.where(inBeam, possibleDistanceInt, possibleDistanceInt * factor)
+
+# ============================================
+# Merge audibility values: the result is the best of them.
+# Values are ordered as: 0 (unknown) < -1 (no) < 1 (only on the streets) < 2 (on the streets and in the buildings)
+# ============================================
+def MergeAudibility(a, b):
+    return np.where(a == 0, b, np.where(b == 0, a, np.maximum(a, b))).astype(np.int8)
+
+# ============================================
+# Calculate audibility of squares and voxels by the specific megaphone
+# for the part of its internal and external buffers (linear indexes of their cells). Max distances of possible audibility in the buildings
+# and on the streets and height of the standalone megaphone are given in voxels, horns are described in ApplyBeam().
+# Results are accumulated in private arrays and merged into shared memory at the end of the task
+# Returns counters: checked squares, audibility squares, checked voxels, audibility voxels
+# ============================================
+def CalculateAudibilityOfTask(uim, cellsSize, cells, cellsCount, cellsIndex,
+                              inside, extIdx, possibleDistanceInt, possibleDistanceExt,
+                              horns, heightStandalone):
+
+    # Constants passed to the C library as float values
+    sizeStep = float(np.float32(cfg.sizeStep))
+    possibleDistanceInt = float(np.float32(possibleDistanceInt))
+    possibleDistanceExt = float(np.float32(possibleDistanceExt))
+
+    # Destination squares at the streets
+    extX, extY = np.divmod(extIdx, boundsY)
+    extUIB = uibs[extIdx].astype(np.int64)
+    extZ = ground[extIdx].astype(np.int64)
+
+    # Destination voxels of living buildings: one item for each floor
+    intUIB = uibs[inside].astype(np.int64)
+    living = intUIB >= 0
+    living[living] = buildings[intUIB[living]*buildingsSize+2] > 0
+    inside = inside[living]
+    intUIB = intUIB[living]
+    floors = buildings[intUIB*buildingsSize].astype(np.int64)
+    voxelX, voxelY = np.divmod(np.repeat(inside, floors), boundsY)
+    voxelUIB = np.repeat(intUIB, floors)
+    voxelFloor = np.arange(floors.sum()) - np.repeat(np.cumsum(floors) - floors, floors)
+    voxelZ = GetFirstBuildingVoxel(voxelX, voxelY, voxelUIB) + voxelFloor
+    voxelIdx = VoxelIndex[voxelX*boundsY+voxelY].astype(np.int64) + voxelFloor
+
+    # Private results
+    private2D = np.zeros(len(extIdx), dtype=np.int8)
+    privateVoxels = np.zeros(len(voxelIdx), dtype=np.int8)
+    countCheckedSquares = 0
+    countAudibilitySquares = 0
+    countCheckedVoxels = 0
+    countAudibilityVoxels = 0
+
+    # Loop through megaphones cells
+    for i in range(cellsCount[uim]):
+        xCell = cells[cellsIndex[uim]+i*cellsSize]
+        yCell = cells[cellsIndex[uim]+i*cellsSize+1]
+        uibMegaphone = int(uibs[xCell*boundsY+yCell])
+        if uibMegaphone < 0:
+            zCell = int(ground[xCell*boundsY+yCell]) + heightStandalone
+        else:
+            zCell = int(GetFirstBuildingVoxel(np.array([xCell]), np.array([yCell]), np.array([uibMegaphone]))[0]) + \
+                    int(buildings[uibMegaphone*buildingsSize])
+
+        # Voxels of buildings
+        reach, distanceInt = ApplyBeam(voxelX, voxelY, xCell, yCell, possibleDistanceInt, possibleDistanceExt, horns)
+        prev = MergeAudibility(privateVoxels[reach], audibilityVoxels[voxelIdx[reach]])
+        privateVoxels[reach] = CheckAudibility(voxelX[reach], voxelY[reach], voxelZ[reach], voxelUIB[reach],
+                                               xCell, yCell, zCell, uibMegaphone, prev, sizeStep, distanceInt[reach])
+        countCheckedVoxels = countCheckedVoxels + int(np.count_nonzero(reach))
+        countAudibilityVoxels = countAudibilityVoxels + int(np.count_nonzero(privateVoxels[reach] > 0))
+
+        # Squares at the streets
+        reach, distanceInt = ApplyBeam(extX, extY, xCell, yCell, possibleDistanceInt, possibleDistanceExt, horns)
+        prev = MergeAudibility(private2D[reach], audibility2D[extIdx[reach]])
+        private2D[reach] = CheckAudibility(extX[reach], extY[reach], extZ[reach], extUIB[reach],
+                                           xCell, yCell, zCell, uibMegaphone, prev, sizeStep, distanceInt[reach])
+        countCheckedSquares = countCheckedSquares + int(np.count_nonzero(reach))
+        countAudibilitySquares = countAudibilitySquares + int(np.count_nonzero(private2D[reach] > 0))
+
+        with mergeLock:
+            madeChecks[uim] = madeChecks[uim] + len(living) + len(extIdx)
+
+    # Merge private results into shared memory
+    with mergeLock:
+        audibilityVoxels[voxelIdx] = MergeAudibility(audibilityVoxels[voxelIdx], privateVoxels)
+        audibility2D[extIdx] = MergeAudibility(audibility2D[extIdx], private2D)
+
+    return countCheckedSquares, countAudibilitySquares, countCheckedVoxels, countAudibilityVoxels
@@ -8,6 +8,7 @@
 from pathlib import Path # Crossplatform pathing
 import vtk # Use other 3D-visualization features
 import time # Tracking the execution time
+import sys # Command line arguments
 
 # Own core modules
 import modules.settings as cfg # Settings defenition
@@ -17,10 +18,12 @@ import modules.earth # Read raster and DEM data and generate the earth's surface
 import modules.buildings # Generate voxels for earth ground vector buildings
 import modules.megaphones # Load megaphones points and calculate audibility level
 import modules.audibility # Multiprocessing audibility calculation
+import modules.estimate # Quick estimate of audibility by the random sample
 
 # Only for main process
 if __name__ == '__main__':
     start_time = time.time() # Record the start time
+    env.flagResume = '--resume' in sys.argv[1:] # Continue audibility calculation from the checkpoint
 
     # Delete all files in folderOUTPUT directory
     # ============================================
@@ -35,9 +38,12 @@ if __name__ == '__main__':
     modules.earth.PrepareLivingBuffer() # Calculate buffer zones around living buildings if ShowSquares mode is 'buffer'
     modules.megaphones.LoadMegaphones() # Load megaphones points
     env.clearMemory() # Clear memory from unused variables
-    modules.audibility.CalculateAudibility() # Calculate audibility of squares and voxels
-    modules.earth.VizualizeAllSquares() # Generate squares of the earth's surface vizualization
-    modules.buildings.VizualizeAllVoxels() # Generate voxels of buildings vizualiztion
+    if cfg.countEstimateSamples > 0:
+        modules.estimate.EstimateAudibility() # Estimate shares of audible flats and squares by the random sample
+    else:
+        modules.audibility.CalculateAudibility() # Calculate audibility of squares and voxels
+        modules.earth.VizualizeAllSquares() # Generate squares of the earth's surface vizualization
+        modules.buildings.VizualizeAllVoxels() # Generate voxels of buildings vizualiztion
     modules.megaphones.VizualizeAllMegaphones() # Generate cones and spheres for megaphones vizualization
 
     # Prepare VTK-window for view and interact
@@ -117,22 +117,22 @@ planeSquare.SetPoint2(0, 0, cfg.sizeVoxel)
 VizualizePoints('sq_no.csv', planeSquare, env.Colors.GetColor3d("Tomato"), 0.5)
 cubeVoxel = vtk.vtkCubeSource()
 cubeVoxel.SetXLength(cfg.sizeVoxel-cfg.gapVoxel)
-cubeVoxel.SetYLength(cfg.sizeVoxel-cfg.gapVoxel)
+cubeVoxel.SetYLength(cfg.sizeFloor-cfg.gapVoxel)
 cubeVoxel.SetZLength(cfg.sizeVoxel-cfg.gapVoxel)
 VizualizePoints('vox_yes.csv', cubeVoxel, env.Colors.GetColor3d("Green"), 1.0)
 cubeVoxel = vtk.vtkCubeSource()
 cubeVoxel.SetXLength(cfg.sizeVoxel-cfg.gapVoxel)
-cubeVoxel.SetYLength(cfg.sizeVoxel-cfg.gapVoxel)
+cubeVoxel.SetYLength(cfg.sizeFloor-cfg.gapVoxel)
 cubeVoxel.SetZLength(cfg.sizeVoxel-cfg.gapVoxel)
 VizualizePoints('vox_no.csv', cubeVoxel, env.Colors.GetColor3d("Tomato"), 1.0)
 cubeVoxel = vtk.vtkCubeSource()
 cubeVoxel.SetXLength(cfg.sizeVoxel-cfg.gapVoxel)
-cubeVoxel.SetYLength(cfg.sizeVoxel-cfg.gapVoxel)
+cubeVoxel.SetYLength(cfg.sizeFloor-cfg.gapVoxel)
 cubeVoxel.SetZLength(cfg.sizeVoxel-cfg.gapVoxel)
 VizualizePoints('vox_industrial.csv', cubeVoxel, env.Colors.GetColor3d("Gray"), 1.0)
 coneMegaphone = vtk.vtkConeSource()
 coneMegaphone.SetDirection(0, 1, 0)
-coneMegaphone.SetHeight(cfg.sizeVoxel)
+coneMegaphone.SetHeight(cfg.sizeFloor)
 coneMegaphone.SetRadius(cfg.sizeVoxel/4)
 VizualizePoints('mgphn_buildings.csv', coneMegaphone, env.Colors.GetColor3d("GreenYellow"), 1.0)
 coneMegaphone = vtk.vtkConeSource()